@@ -0,0 +1,355 @@
+import heapq
+
+import numpy as np
+
+import correlator
+import fengine
+import profiling
+from frame import frame_dtype
+
+#Precision of the running sums. Blocks of up to EXACT_BLOCK frames are
+#correlated exactly by every backend, so int64 and complex128 sums are exact.
+PRECISIONS = ('complex64', 'complex128', 'int64')
+
+#Type of the output products; the integer types carry a power of two scale per baseline.
+OUTPUT_TYPES = ('complex64', 'int32', 'int16')
+
+EXACT_BLOCK = 512 #frames whose products sum to at most 2**24, exact in float32
+
+
+def correlation_dtype(number_channels, n_acc, output='complex64', number_frequencies=correlator.NUMBER_FREQUENCIES,
+                      number_baselines=None):
+    '''
+    Return the compound dtype of one record of the output 'correlations' dataset,
+    with number_frequencies output frequency channels (see correlator.FrequencySelection)
+    and number_baselines channel pairs (see correlator.BaselineSelection; all pairs by default).
+
+    With an integer output type the real and imaginary parts of the products
+    are in the last axis, and scale holds the factor restoring those of each
+    baseline (see decode_products()).
+    '''
+
+    n_corr = number_baselines if number_baselines is not None else number_channels * (number_channels + 1) // 2
+
+    if output == 'complex64':
+        return np.dtype([('index', 'int64'),
+                         ('timestamp', '|S30'),
+                         ('products', 'complex64', (n_corr, number_frequencies)),
+                         #('frame_indices', 'int32', (n_acc, )),
+                         ('frame_numbers', 'uint32', (n_acc, )),
+                        ])
+
+    if output not in OUTPUT_TYPES:
+        raise ValueError("Unknown output type '{0:s}'; choose from {1:s}.".format(output, ", ".join(OUTPUT_TYPES)))
+
+    return np.dtype([('index', 'int64'),
+                     ('timestamp', '|S30'),
+                     ('products', output, (n_corr, number_frequencies, 2)),
+                     ('scale', 'float64', (n_corr, )),
+                     ('frame_numbers', 'uint32', (n_acc, )),
+                    ])
+
+
+def quantize(products, output):
+    '''
+    Scale complex products (n_corr, ...) into the integer type output.
+
+    Each baseline (first axis) has its own scale, the smallest power of two
+    that makes its real and imaginary parts fit. Scales below 1 keep the full
+    resolution of the type for small or fractional (e.g. averaged) products,
+    and integer sums are stored exactly whenever their scale is at most 1.
+
+    returns (values with the parts in the last axis, scales with shape (n_corr, )).
+    '''
+
+    limit = np.iinfo(output).max
+    peaks = np.maximum(np.abs(products.real), np.abs(products.imag)).reshape(products.shape[0], -1).max(axis=1)
+
+    scales = np.ones(peaks.shape)
+    nonzero = peaks > 0
+    scales[nonzero] = 2. ** np.ceil(np.log2(peaks[nonzero] / float(limit)))
+
+    scale = scales.reshape((-1, ) + (1, ) * (products.ndim - 1))
+    values = np.empty(products.shape + (2, ), dtype=output)
+    values[..., 0] = np.rint(products.real / scale)
+    values[..., 1] = np.rint(products.imag / scale)
+    return values, scales
+
+
+def decode_products(records):
+    '''
+    Return the complex products of 'correlations' records of any output type.
+    '''
+
+    if 'scale' not in records.dtype.names:
+        return records['products']
+
+    values = records['products'].astype(np.float64)
+    scale = np.asarray(records['scale'])[..., np.newaxis] #per baseline, over frequency
+    return (values[..., 0] + 1j * values[..., 1]) * scale
+
+
+class Accumulator(object):
+
+    '''
+    Sum the correlation products of n_acc frames and stage each completed
+    accumulation in an h5output.BatchWriter.
+
+    Frames are copied into a staging block of block_frames frames, which is
+    correlated by backend when it fills, so the raw frames held at any time
+    are bounded by block_frames rather than n_acc. Block products are added
+    to running sums of the given precision; complex128 and int64 sums are
+    exact as long as block_frames is at most EXACT_BLOCK.
+
+    Raw ADC frames for a time-domain backend are held back in a buffer of
+    the backend's fengine.reorder_frames frames and staged in frame-number
+    order, so that the filter bank sees them in sequence; flush() stages the
+    frames still held at the end of a run.
+
+    Staging frames, decoding and correlating are timed as the accumulate,
+    decode and correlate stages of profiler, if given.
+
+    params:
+        number_channels, n_acc: channels per frame and frames per accumulation.
+        precision: precision of the running sums, one of PRECISIONS.
+        output: type of the output products, one of OUTPUT_TYPES; the output
+                dataset must have correlation_dtype(..., output).
+        block_frames: frames per correlated block; min(n_acc, EXACT_BLOCK) by default.
+        backend: correlator.Backend; NumPy by default. With a time-domain
+                 backend (fengine.FXBackend) the frames hold raw ADC samples.
+        frequencies: correlator.FrequencySelection of the frequency channels
+                     staged and correlated; all channels by default.
+        baselines: correlator.BaselineSelection of the channel pairs
+                   correlated; all pairs by default.
+    '''
+
+    def __init__(self, number_channels, n_acc, precision='complex64', output='complex64', block_frames=None,
+                 backend=None, profiler=None, frequencies=None, baselines=None):
+
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision '{0:s}'; choose from {1:s}.".format(precision, ", ".join(PRECISIONS)))
+        if output not in OUTPUT_TYPES:
+            raise ValueError("Unknown output type '{0:s}'; choose from {1:s}.".format(output, ", ".join(OUTPUT_TYPES)))
+
+        if block_frames is None:
+            block_frames = min(n_acc, EXACT_BLOCK)
+
+        self.number_channels = number_channels
+        self.n_acc = n_acc
+        self.precision = precision
+        self.output = output
+        self.block_frames = block_frames
+        self.backend = backend if backend is not None else correlator.NumpyBackend()
+        self.profiler = profiler if profiler is not None else profiling.Profiler(enabled=False)
+        self.frequencies = frequencies if frequencies is not None else correlator.FrequencySelection()
+        self.baselines = baselines if baselines is not None else correlator.BaselineSelection(number_channels)
+
+        n_corr = len(self.baselines)
+
+        n_freq = self.frequencies.channels.shape[0] #selected channels, before averaging
+
+        if precision == 'int64':
+            self.sums = np.zeros((2, n_corr, n_freq), dtype=np.int64) #real and imaginary parts
+        else:
+            self.sums = np.zeros((n_corr, n_freq), dtype=precision)
+
+        #Raw ADC frames are staged whole and cut down once channelized.
+        n_samples = 2048 if self.backend.time_domain else 2 * n_freq
+        self.frames = np.zeros((block_frames, number_channels, n_samples), dtype=np.int8) #staging block
+        self.staged = 0 #frames in the staging block
+        self.frame_indices = np.zeros((n_acc, ), dtype=np.int)
+        self.frame_numbers = np.zeros((n_acc, ), dtype=np.uint32)
+        self.filled = 0 #frames in the current accumulation
+        self.write_index = 0 #accumulations written
+        self.rescaled = 0 #accumulations with a baseline quantized with a scale above 1
+        self.timestamp = ""
+        self.index = -1
+
+        self.reorder_frames = self.backend.fengine.reorder_frames if self.backend.time_domain else 0
+        self.waiting = [] #heap of (order, arrival, frame record) of the frames held back for reordering
+        self.arrivals = 0 #frames held back so far, to keep equal frame numbers in arrival order
+        self.last_held = None #(frame number, order) of the last frame held back
+
+    def add_frame(self, writer, frame):
+        '''
+        Add a data frame to the accumulation, staging the accumulation in
+        writer once n_acc frames have been added.
+        '''
+
+        with self.profiler.stage('accumulate', 1):
+            if self.reorder_frames > 0:
+                self.hold(frame.array()[0])
+                if len(self.waiting) > self.reorder_frames:
+                    self.stage_record(writer, heapq.heappop(self.waiting)[2])
+            else:
+                self.stage(writer, frame.index, frame.frame_number, frame.packet_timestamps[0], frame.frame_data)
+
+    def hold(self, record):
+        '''
+        Hold back a frame record (see frame.frame_dtype) to be staged in frame-number order.
+        '''
+
+        number = int(record['frame_number'])
+        order = 0 if self.last_held is None else self.last_held[1] + fengine.frame_offset(self.last_held[0], number)
+
+        heapq.heappush(self.waiting, (order, self.arrivals, record))
+        self.arrivals += 1
+        self.last_held = (number, order)
+
+    def flush(self, writer):
+        '''
+        Stage the frames held back for reordering, e.g. at the end of a run.
+        '''
+
+        with self.profiler.stage('accumulate', len(self.waiting)):
+            while self.waiting:
+                self.stage_record(writer, heapq.heappop(self.waiting)[2])
+
+    def stage_record(self, writer, record):
+        '''
+        Stage a frame record (see frame.frame_dtype).
+        '''
+        self.stage(writer, record['index'], record['frame_number'], record['packet_timestamps'][0], record['frame_data'])
+
+    def stage(self, writer, index, frame_number, timestamp, frame_data):
+        '''
+        Copy a frame into the staging block, correlating the block when it
+        is full and writing the accumulation once it holds n_acc frames.
+        '''
+
+        if self.filled == 0:
+            self.timestamp = timestamp
+            self.index = index
+
+        if self.backend.time_domain:
+            self.frames[self.staged] = frame_data
+        else:
+            self.frames[self.staged] = self.frequencies.select(frame_data)
+        self.frame_indices[self.filled] = index
+        self.frame_numbers[self.filled] = frame_number
+        self.staged += 1
+        self.filled += 1
+
+        if self.staged == self.block_frames or self.filled == self.n_acc:
+            self.reduce()
+
+        if self.filled == self.n_acc:
+            self.write(writer)
+            self.write_index += 1
+            self.reset()
+
+    def reduce(self):
+        '''
+        Correlate the staging block and add its products to the running sums.
+        '''
+
+        if self.staged == 0:
+            return
+
+        with self.profiler.stage('decode', self.staged):
+            if self.backend.time_domain:
+                #Raw frames are filtered with the frames before them by frame number.
+                datum = self.backend.convert(self.frames[:self.staged], 
+                                             self.frame_numbers[self.filled - self.staged:self.filled])
+                datum = self.frequencies.select_spectra(datum)
+            else:
+                datum = self.backend.convert(self.frames[:self.staged])
+        with self.profiler.stage('correlate', self.staged):
+            block = self.backend.correlate_pairs(datum, self.baselines)
+
+        if self.precision == 'int64':
+            self.sums[0] += block.real.astype(np.int64)
+            self.sums[1] += block.imag.astype(np.int64)
+        else:
+            self.sums += block
+
+        self.staged = 0
+
+    def products(self):
+        '''
+        Return the products of the reduced frames as a complex array.
+        '''
+
+        if self.precision == 'int64':
+            return self.sums[0] + 1j * self.sums[1].astype(np.float64)
+
+        return self.sums
+
+    def write(self, writer):
+        '''
+        Stage the current accumulation in writer.
+        '''
+
+        record = writer.next_record()
+        record['index'] = self.index
+        record['timestamp'] = self.timestamp
+
+        products = self.frequencies.reduce(self.products())
+
+        if self.output == 'complex64':
+            record['products'] = products
+        else:
+            record['products'], record['scale'] = quantize(products, self.output)
+            if np.any(record['scale'] > 1):
+                self.rescaled += 1
+
+        #record['frame_indices'] = self.frame_indices
+        record['frame_numbers'] = self.frame_numbers
+        writer.commit()
+
+    def reset(self):
+        '''
+        Start a new accumulation.
+        '''
+
+        self.sums[...] = 0
+        self.frame_indices[:] = 0
+        self.frame_numbers[:] = 0
+        self.staged = 0
+        self.filled = 0
+
+    def state(self):
+        '''
+        Return the partial accumulation as a dictionary of arrays and numbers, e.g. for a checkpoint.
+        '''
+
+        state = {'sums': self.sums,
+                 'staged_frames': self.frames[:self.staged],
+                 'staged_frame_indices': self.frame_indices[:self.filled],
+                 'staged_frame_numbers': self.frame_numbers[:self.filled],
+                 'waiting_frames': np.array([item[2] for item in sorted(self.waiting)], 
+                                            dtype=frame_dtype(self.number_channels)),
+                 'filled': self.filled,
+                 'timestamp': self.timestamp,
+                 'index': self.index,
+                 'write_index': self.write_index,
+                 'rescaled': self.rescaled}
+
+        if self.backend.time_domain:
+            state['fengine_history'] = self.backend.fengine.history #raw frames kept from earlier blocks
+            state['fengine_history_numbers'] = self.backend.fengine.history_numbers
+
+        return state
+
+    def restore(self, state):
+        '''
+        Continue a partial accumulation returned by state().
+        '''
+
+        self.sums[...] = state['sums']
+        self.staged = state['staged_frames'].shape[0]
+        self.frames[:self.staged] = state['staged_frames']
+        self.filled = int(state['filled'])
+        self.frame_indices[:self.filled] = state['staged_frame_indices']
+        self.frame_numbers[:self.filled] = state['staged_frame_numbers']
+        self.timestamp = state['timestamp']
+        self.index = int(state['index'])
+        self.write_index = int(state['write_index'])
+        self.rescaled = int(state.get('rescaled', 0))
+
+        self.waiting = []
+        self.last_held = None
+        for record in state.get('waiting_frames', []):
+            self.hold(record)
+        if 'fengine_history' in state:
+            self.backend.fengine.restore(state['fengine_history'], state['fengine_history_numbers'])
@@ -0,0 +1,407 @@
+'''
+Correlate every capture under one or more directories in parallel.
+
+Raw binary captures (.bin, suit_binary_receiver) are run through
+binary_analyse.py and HDF5 packet tables (.h5, suit_timestream_receiver)
+through process_and_correlate.py, one subprocess per file. Up to a given
+number of files run at once, largest first, within an optional memory
+budget. Files whose output is complete and newer than the input are
+skipped, and interrupted runs are resumed from their checkpoint.
+
+A JSON manifest records the outcome of every file.
+'''
+
+# pylint: disable=C0103, W1202, line-too-long
+
+import os
+import sys
+import time
+import json
+import getopt
+import logging
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import h5py
+
+import checkpoint
+import h5output
+import packet_reader
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DIRECTORY = os.path.join(SCRIPT_DIRECTORY, "streamer", "dataOut")
+
+#Correlation script for each capture extension.
+SCRIPTS = {'.bin': "binary_analyse.py",
+           '.h5': "process_and_correlate.py"}
+
+#Subdirectories the scripts write their outputs to (correlate_data.py writes next to its input).
+OUTPUT_DIRECTORIES = ("correlated", "processed")
+
+BASE_MEMORY = 64 * 1024 * 1024 #interpreter, NumPy and HDF5 of one job
+CLEANING_THRESH = 1000 #open frames held by the FrameAssembler of the scripts
+SETTLE_TIME = 60. #seconds since the last change before a capture is considered finished
+POLL_INTERVAL = 0.5 #seconds between checks on the running jobs
+
+logger = logging.getLogger(__name__) # pylint: disable=locally-disabled, invalid-name
+
+
+def output_filename(input_filename):
+    '''
+    Return the output file the correlation scripts write for an input file.
+    '''
+
+    source_filename = os.path.split(input_filename)
+    return source_filename[0] + "/correlated/PC_" + source_filename[1]
+
+
+def is_capture(filename):
+    '''
+    Return True if a file is a capture rather than the output of one of the
+    scripts: a .bin file that is not HDF5 (correlation outputs keep the
+    input name), or a .h5 file holding ADC_Timestream_Data and its
+    Number_packets attribute (not a pr_ frame table or cr_ correlation).
+    HDF5 files that cannot be opened yet, e.g. while still being written,
+    are kept so that their job reports them.
+    '''
+
+    extension = os.path.splitext(filename)[1]
+
+    if extension not in SCRIPTS:
+        return False
+
+    try:
+        if not h5py.is_hdf5(filename):
+            return True
+        if extension == '.bin':
+            return False
+        with h5py.File(filename, 'r') as data_in_handle:
+            return 'ADC_Timestream_Data' in data_in_handle and 'Number_packets' in data_in_handle.attrs
+    except IOError:
+        return True
+
+
+def discover_captures(directories):
+    '''
+    Return the capture files under the directories, sorted by name.
+    Subdirectories of OUTPUT_DIRECTORIES and outputs of the scripts (see
+    is_capture) are ignored.
+    '''
+
+    captures = []
+
+    for directory in directories:
+        for root, subdirectories, filenames in os.walk(directory):
+            subdirectories[:] = [name for name in subdirectories if name not in OUTPUT_DIRECTORIES]
+            captures += [os.path.join(root, name) for name in filenames
+                         if is_capture(os.path.join(root, name))]
+
+    return sorted(captures)
+
+
+def number_channels(input_filename):
+    '''
+    Return the number of channels recorded in a capture file.
+    '''
+
+    if input_filename.endswith(".bin"):
+        return int(packet_reader.read_binary_header(input_filename)['number_channels'])
+
+    with h5py.File(input_filename, 'r') as file_handle:
+        return int(file_handle.attrs['Number_channels'])
+
+
+def estimate_memory(input_filename, channels, n_acc, block_size=packet_reader.DEFAULT_BLOCK_SIZE):
+    '''
+    Return an estimate of the peak memory, in bytes, of correlating one capture.
+
+    Counts the packet blocks in flight (two for HDF5 input, which is prefetched),
+    the frame pool of the assembler, the staged frames of an accumulation and
+    the intermediate arrays of correlating them, and the output staging buffer.
+    '''
+
+    blocks = (1 if input_filename.endswith(".bin") else 2) * block_size * packet_reader.PACKET_DTYPE.itemsize
+    frames = (CLEANING_THRESH + 2 + n_acc) * channels * 2048
+    correlation = 4 * n_acc * channels * 1024 * 8
+
+    return BASE_MEMORY + blocks + frames + correlation + h5output.FLUSH_BYTES
+
+
+def output_state(input_filename, n_acc):
+    '''
+    Return 'complete' if the output of a capture is complete, was made with
+    n_acc frames per accumulation and is newer than the capture; 'resumable'
+    if it has a checkpoint for the same n_acc; otherwise 'missing'.
+    '''
+
+    output = output_filename(input_filename)
+
+    if not os.path.isfile(output):
+        return 'missing'
+
+    try:
+        with h5py.File(output, 'r') as file_handle:
+            complete = bool(file_handle.attrs.get('complete', False))
+            same_n_acc = file_handle.attrs.get('number_accumulations') == n_acc
+    except IOError:
+        return 'missing'
+
+    if not same_n_acc:
+        return 'missing'
+    if complete and os.path.getmtime(output) >= os.path.getmtime(input_filename):
+        return 'complete'
+    if not complete and os.path.isfile(checkpoint.checkpoint_filename(output)):
+        return 'resumable'
+
+    return 'missing'
+
+
+def plan_jobs(captures, n_acc, output_profile=h5output.DEFAULT_PROFILE, settle_time=SETTLE_TIME, force=False):
+    '''
+    Return (jobs, entries): the jobs to run and a manifest entry for every capture.
+    Each job is a dictionary with the command line, log file and memory estimate.
+    '''
+
+    jobs = []
+    entries = []
+    now = time.time()
+
+    for input_filename in captures:
+        entry = {'input': input_filename,
+                 'output': output_filename(input_filename),
+                 'input_bytes': os.path.getsize(input_filename)}
+        entries += [entry]
+
+        if now - os.path.getmtime(input_filename) < settle_time:
+            entry['status'] = 'busy'
+            continue
+
+        state = 'missing' if force else output_state(input_filename, n_acc)
+        if state == 'complete':
+            entry['status'] = 'up to date'
+            continue
+
+        try:
+            channels = number_channels(input_filename)
+        except (IOError, KeyError) as err:
+            entry['status'] = 'failed'
+            entry['error'] = str(err)
+            continue
+
+        script = os.path.join(SCRIPT_DIRECTORY, SCRIPTS[os.path.splitext(input_filename)[1]])
+        command = [sys.executable, script,
+                   "-i", input_filename,
+                   "-n", str(n_acc),
+                   "-o", output_profile]
+        if state == 'resumable':
+            command += ["-r"]
+
+        entry['resumed'] = state == 'resumable'
+        entry['log'] = entry['output'] + ".log"
+        jobs += [{'entry': entry,
+                  'command': command,
+                  'memory': estimate_memory(input_filename, channels, n_acc)}]
+
+    return jobs, entries
+
+
+def _start_job(job):
+    '''
+    Launch a job with its output going to its log file.
+    '''
+
+    entry = job['entry']
+    directory = os.path.dirname(entry['log'])
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    job['log_handle'] = open(entry['log'], 'w')
+    job['start_time'] = time.time()
+    job['process'] = subprocess.Popen(job['command'], stdout=job['log_handle'], stderr=subprocess.STDOUT)
+    logger.info("Started '{0:s}' ({1:.0f} MB estimated).".format(entry['input'], job['memory'] / 1048576.))
+
+
+def _finish_job(job):
+    '''
+    Record the outcome of a job that has exited.
+    '''
+
+    entry = job['entry']
+    job['log_handle'].close()
+
+    entry['returncode'] = job['process'].returncode
+    entry['seconds'] = time.time() - job['start_time']
+
+    try:
+        with h5py.File(entry['output'], 'r') as file_handle:
+            complete = bool(file_handle.attrs.get('complete', False))
+            entry['accumulations'] = int(file_handle.attrs.get('true_number_entries', 0))
+    except IOError:
+        complete = False
+
+    entry['status'] = 'processed' if entry['returncode'] == 0 and complete else 'failed'
+    logger.info("Finished '{0:s}': {1:s} in {2:.1f} s.".format(entry['input'], entry['status'], entry['seconds']))
+
+
+def run_jobs(jobs, n_workers, memory_budget=None):
+    '''
+    Run jobs, at most n_workers at a time, largest memory estimate first.
+
+    With a memory_budget in bytes, a job only starts while the estimates of
+    the running jobs leave room for it; a job larger than the whole budget
+    runs on its own.
+    '''
+
+    pending = sorted(jobs, key=lambda job: (job['memory'], job['entry']['input_bytes']), reverse=True)
+    running = []
+
+    while pending or running:
+        for job in [job for job in running if job['process'].poll() is not None]:
+            running.remove(job)
+            _finish_job(job)
+
+        while pending and len(running) < n_workers:
+            in_use = sum(job['memory'] for job in running)
+            fitting = [job for job in pending
+                       if memory_budget is None or not running or in_use + job['memory'] <= memory_budget]
+            if not fitting:
+                break
+            pending.remove(fitting[0])
+            running += [fitting[0]]
+            _start_job(fitting[0])
+
+        if running:
+            time.sleep(POLL_INTERVAL)
+
+
+def write_manifest(filename, entries, **extra):
+    '''
+    Write the manifest: a count of files by status, the extra fields and an entry per capture.
+    '''
+
+    statuses = {}
+    for entry in entries:
+        statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+
+    manifest = {'files': entries, 'status_counts': statuses}
+    manifest.update(extra)
+
+    with open(filename, 'w') as file_handle:
+        json.dump(manifest, file_handle, indent=2, sort_keys=True)
+
+
+def usage():
+    '''
+    Usage function.
+    '''
+
+    print "Usage: {0:s} [options] [directory ...]\n\
+         \t Directories are searched recursively (default: {1:s}).\n\
+         \t -h/--help: This message.\n\
+         \t -w/--workers: Number of files processed at once (default: number of CPUs).\n\
+         \t -m/--memory: Memory budget in MB for the running jobs.\n\
+         \t -n/--nacc: Number of frames to accumulate.\n\
+         \t -o/--output-profile: Output compression (none/lzf/gzip-1/shuffle+lzf/gzip-9).\n\
+         \t -s/--settle: Seconds since a capture last changed before it is processed.\n\
+         \t -f/--force: Reprocess captures whose output is up to date.\n\
+         \t -M/--manifest: Manifest file (default: batch_manifest.json in the first directory).\n\
+         \t -l/--log: Log level".format(sys.argv[0], DEFAULT_DIRECTORY)
+
+
+if __name__ == "__main__":
+
+    N_WORKERS = multiprocessing.cpu_count()
+    MEMORY_BUDGET = None
+    N_ACC = 100
+    OUTPUT_PROFILE = h5output.DEFAULT_PROFILE
+    SETTLE = SETTLE_TIME
+    FORCE = False
+    MANIFEST_FILENAME = None
+    LOG_LEVEL = "INFO"
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:],
+                                   "hw:m:n:o:s:fM:l:",
+                                   ["help",
+                                    "workers=",
+                                    "memory=",
+                                    "nacc=",
+                                    "output-profile=",
+                                    "settle=",
+                                    "force",
+                                    "manifest=",
+                                    "log=",
+                                   ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in OPTS:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-w", "--workers"):
+            N_WORKERS = max(1, int(arg))
+        elif opt in ("-m", "--memory"):
+            MEMORY_BUDGET = int(float(arg) * 1024 * 1024)
+        elif opt in ("-n", "--nacc"):
+            N_ACC = int(arg)
+        elif opt in ("-o", "--output-profile"):
+            OUTPUT_PROFILE = arg
+        elif opt in ("-s", "--settle"):
+            SETTLE = float(arg)
+        elif opt in ("-f", "--force"):
+            FORCE = True
+        elif opt in ("-M", "--manifest"):
+            MANIFEST_FILENAME = arg
+        elif opt in ("-l", "--log"):
+            LOG_LEVEL = arg
+
+    if OUTPUT_PROFILE not in h5output.OUTPUT_PROFILES:
+        usage()
+        sys.exit(2)
+
+    DIRECTORIES = ARGS if ARGS else [DEFAULT_DIRECTORY]
+    if MANIFEST_FILENAME is None:
+        MANIFEST_FILENAME = os.path.join(DIRECTORIES[0], "batch_manifest.json")
+
+    numeric_level = getattr(logging, LOG_LEVEL.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % LOG_LEVEL)
+
+    logger.setLevel(numeric_level)
+    ch = logging.StreamHandler()
+    ch.setLevel(numeric_level)
+    ch.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(ch)
+
+    START_DATE = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    START_TIME = time.time()
+
+    CAPTURES = discover_captures(DIRECTORIES)
+    JOBS, ENTRIES = plan_jobs(CAPTURES, N_ACC, OUTPUT_PROFILE, SETTLE, FORCE)
+
+    logger.info("{0:d} captures found; {1:d} to process with {2:d} workers{3:s}."\
+        .format(len(CAPTURES), len(JOBS), N_WORKERS,
+                "" if MEMORY_BUDGET is None else " in {0:.0f} MB".format(MEMORY_BUDGET / 1048576.)))
+
+    try:
+        run_jobs(JOBS, N_WORKERS, MEMORY_BUDGET)
+    finally:
+        #Jobs still running after an interrupt have checkpoints and are resumed by the next batch.
+        for JOB in JOBS:
+            if 'status' not in JOB['entry']:
+                JOB['entry']['status'] = 'interrupted'
+
+        write_manifest(MANIFEST_FILENAME, ENTRIES,
+                       directories=DIRECTORIES,
+                       start_date=START_DATE,
+                       seconds=time.time() - START_TIME,
+                       workers=N_WORKERS,
+                       memory_budget=MEMORY_BUDGET,
+                       n_acc=N_ACC,
+                       output_profile=OUTPUT_PROFILE)
+
+    logger.info("Manifest written to '{0:s}'.".format(MANIFEST_FILENAME))
+    sys.exit(0 if all(entry['status'] != 'failed' for entry in ENTRIES) else 1)
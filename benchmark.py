@@ -0,0 +1,489 @@
+'''
+Throughput benchmark of the analysis entry points on synthetic IceBoard data.
+
+Writes a synthetic capture in both the raw binary format of
+suit_binary_receiver and the HDF5 packet-table format of
+suit_timestream_receiver, then times
+
+    binary_analyse.parse_raw_data
+    binary_analyse.run_split (checked against the output of parse_raw_data)
+    pipeline.run_pipeline (likewise, also at an n_acc on the other side of
+                           accumulator.EXACT_BLOCK)
+    process_and_correlate.parse_raw_data
+    process_raw_timestream.parse_and_write_data
+    correlate_data.main (on the output of process_raw_timestream)
+
+and reports packets/s and MB/s of packet records for each. Finally, it
+checks that batch_process.discover_captures picks up the two captures and
+none of the outputs written next to them.
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import getopt
+import logging
+import platform
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+
+import numpy as np
+import h5py
+
+import accumulator as acc
+import packet_reader
+import h5output
+from frame import frame_dtype
+
+SAMPLE_POOL = 256 #distinct random timestreams reused by the generator
+FRAME_PERIOD = 2048 * 2.56e-6 #seconds per frame
+START_DATE = datetime(2017, 4, 27, 10, 0, 0)
+SPLIT_RANGES = 4 #packet ranges of the binary_analyse_split benchmark
+PIPELINE_WORKERS = 2 #correlator processes of the binary_analyse_pipeline benchmark
+BENCHMARKS = ('binary_analyse', 'binary_analyse_split', 'binary_analyse_pipeline', 'process_and_correlate', 
+              'process_raw_timestream', 'correlate_data')
+
+
+class _Quiet(object):
+
+    '''
+    Context manager discarding standard output, for the scripts that print progress.
+    '''
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        return self
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+
+def generate_packets(number_channels, number_frames, out_of_order=0., drop=0., max_displacement=12, seed=0):
+    '''
+    Generate a synthetic packet stream as PACKET_DTYPE records.
+
+    params:
+        number_channels, number_frames: size of the stream before drops.
+        out_of_order: fraction of packets swapped with a later packet up to
+                      max_displacement positions ahead.
+        drop: fraction of packets removed.
+        seed: random seed; the same arguments give the same stream.
+    '''
+
+    rng = np.random.RandomState(seed)
+    number_packets = number_channels * number_frames
+
+    packets = np.zeros((number_packets, ), dtype=packet_reader.PACKET_DTYPE)
+    packets['timestamp'] = np.repeat(np.arange(number_frames, dtype=np.uint32), number_channels)
+    packets['antenna'] = np.tile(np.arange(number_channels, dtype=np.int8), number_frames)
+
+    pool = rng.randint(-128, 128, (SAMPLE_POOL, 2048)).astype(np.int8)
+    packets['timestream'] = pool[rng.randint(0, SAMPLE_POOL, number_packets)]
+
+    stamps = np.array([(START_DATE + timedelta(seconds=frame * FRAME_PERIOD)).strftime("%Y-%m-%d %H:%M:%S.%f")
+                       for frame in xrange(number_frames)], dtype='S26')
+    packets['comp_timestamp'] = np.repeat(stamps, number_channels)
+
+    if drop > 0:
+        packets = packets[rng.random_sample(number_packets) >= drop]
+
+    if out_of_order > 0:
+        last = packets.shape[0] - 1
+        moved = np.nonzero(rng.random_sample(packets.shape[0]) < out_of_order)[0]
+        targets = np.minimum(last, moved + rng.randint(1, max_displacement + 1, moved.shape[0]))
+        for i, j in zip(moved, targets):
+            packets[[i, j]] = packets[[j, i]]
+
+    return packets
+
+
+def write_binary_capture(filename, packets, number_channels):
+    '''
+    Write packets in the raw binary format of suit_binary_receiver.
+    '''
+
+    header = np.zeros((1, ), dtype=packet_reader.HEADER_DTYPE)
+    header['number_packets'] = packets.shape[0]
+    header['number_channels'] = number_channels
+    header['date'] = START_DATE.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    with open(filename, 'wb') as file_handle:
+        header.tofile(file_handle)
+        packets.tofile(file_handle)
+
+
+def write_hdf5_capture(filename, packets, number_channels, chunk_size=1, block_size=packet_reader.DEFAULT_BLOCK_SIZE):
+    '''
+    Write packets as the ADC_Timestream_Data packet table of suit_timestream_receiver,
+    which uses one packet per chunk.
+    '''
+
+    table_dtype = np.dtype([('comp_timestamp', h5py.special_dtype(vlen=str)),
+                            ('timestamp', '<u4'),
+                            ('antenna', 'u1'),
+                            ('timestream', 'i1', 2048)])
+
+    with h5py.File(filename, 'w') as file_handle:
+        table = file_handle.create_dataset('ADC_Timestream_Data', (packets.shape[0], ), dtype=table_dtype,
+                                           chunks=(chunk_size, ), maxshape=(None, ))
+
+        for start in xrange(0, packets.shape[0], block_size):
+            block = packets[start:start + block_size]
+            rows = np.zeros(block.shape, dtype=table_dtype)
+            for name in table_dtype.names:
+                rows[name] = block[name]
+            table[start:start + block.shape[0]] = rows
+
+        file_handle.attrs['Number_channels'] = number_channels
+        file_handle.attrs['Number_packets'] = packets.shape[0]
+        file_handle.attrs['Date'] = START_DATE.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _correlation_writer(filename, number_channels, number_packets, n_acc):
+    '''
+    Open an output file with a 'correlations' dataset and return (file, BatchWriter).
+    '''
+
+    out_data = h5py.File(filename, 'w')
+    dataset = h5output.create_dataset(out_data, "correlations",
+                                      (h5output.expected_records(number_packets, number_channels, n_acc), ),
+                                      dtype=acc.correlation_dtype(number_channels, n_acc))
+    return out_data, h5output.BatchWriter(dataset)
+
+
+def run_binary_analyse(paths, number_channels, number_packets, n_acc):
+    '''
+    Correlate the binary capture with binary_analyse.parse_raw_data.
+    '''
+    import binary_analyse
+
+    packets = packet_reader.open_binary_packets(paths['binary'])
+    out_data, writer = _correlation_writer(paths['binary_out'], number_channels, number_packets, n_acc)
+    binary_analyse.parse_raw_data(packets, writer, number_channels, packets.shape[0], n_acc)
+    writer.close()
+    out_data.close()
+    del packets
+
+
+def run_binary_analyse_split(paths, number_channels, number_packets, n_acc):
+    '''
+    Correlate the binary capture in SPLIT_RANGES packet ranges with binary_analyse.run_split.
+    '''
+    import binary_analyse
+
+    out_data, writer = _correlation_writer(paths['split_out'], number_channels, number_packets, n_acc)
+    binary_analyse.run_split(paths['binary'], writer, number_channels, n_acc, SPLIT_RANGES)
+    writer.close()
+    out_data.close()
+
+
+def run_binary_analyse_pipeline(paths, number_channels, number_packets, n_acc):
+    '''
+    Correlate the binary capture with pipeline.run_pipeline and PIPELINE_WORKERS correlator processes.
+    '''
+    import pipeline
+
+    def open_blocks():
+        '''
+        Iterate over the mapped packets in the reader process.
+        '''
+        return packet_reader.iterate_blocks(packet_reader.open_binary_packets(paths['binary']))
+
+    out_data, writer = _correlation_writer(paths['pipeline_out'], number_channels, number_packets, n_acc)
+    pipeline.run_pipeline(open_blocks, writer, number_channels, n_acc, PIPELINE_WORKERS)
+    writer.close()
+    out_data.close()
+
+
+def outputs_equal(filename, reference_filename):
+    '''
+    Return True if the 'correlations' datasets of two files hold the same records.
+    '''
+
+    with h5py.File(filename, 'r') as file_handle, h5py.File(reference_filename, 'r') as reference_handle:
+        records = file_handle['correlations'][...]
+        reference = reference_handle['correlations'][...]
+
+    return records.shape == reference.shape and all(np.array_equal(records[name], reference[name])
+                                                    for name in records.dtype.names)
+
+
+def run_process_and_correlate(paths, number_channels, number_packets, n_acc):
+    '''
+    Correlate the HDF5 capture with process_and_correlate.parse_raw_data.
+    '''
+    import process_and_correlate
+
+    in_data = h5py.File(paths['hdf5'], 'r')
+    out_data, writer = _correlation_writer(paths['hdf5_out'], number_channels, number_packets, n_acc)
+    process_and_correlate.parse_raw_data(in_data, writer, number_channels, number_packets, n_acc)
+    writer.close()
+    out_data.close()
+    in_data.close()
+
+
+def run_process_raw_timestream(paths, number_channels, number_packets, n_acc): # pylint: disable=unused-argument
+    '''
+    Assemble the HDF5 capture into frames with process_raw_timestream.parse_and_write_data.
+    '''
+    import process_raw_timestream
+
+    in_data = h5py.File(paths['hdf5'], 'r')
+    out_data = h5py.File(paths['frames'], 'w')
+    for key in in_data.attrs.keys():
+        out_data.attrs[key] = in_data.attrs[key]
+
+    dataset = h5output.create_dataset(out_data, "frame_timestream",
+                                      (h5output.expected_records(number_packets, number_channels), ),
+                                      dtype=frame_dtype(number_channels),
+                                      chunk_records=16)
+    writer = h5output.BatchWriter(dataset)
+    with _Quiet():
+        process_raw_timestream.parse_and_write_data(in_data, writer, number_channels)
+    out_data.attrs['true_number_entries'] = writer.close()
+    out_data.close()
+    in_data.close()
+
+
+def run_correlate_data(paths, number_channels, number_packets, n_acc): # pylint: disable=unused-argument
+    '''
+    Correlate the frames written by process_raw_timestream with correlate_data.main.
+    '''
+    import correlate_data
+
+    with _Quiet():
+        correlate_data.main([paths['frames'], str(n_acc)])
+
+
+RUNNERS = {'binary_analyse': run_binary_analyse,
+           'binary_analyse_split': run_binary_analyse_split,
+           'binary_analyse_pipeline': run_binary_analyse_pipeline,
+           'process_and_correlate': run_process_and_correlate,
+           'process_raw_timestream': run_process_raw_timestream,
+           'correlate_data': run_correlate_data}
+
+
+def run_benchmarks(directory, number_channels=4, number_frames=20000, out_of_order=0.05, drop=0.01,
+                   n_acc=100, repeats=1, seed=0, benchmarks=BENCHMARKS):
+    '''
+    Generate a synthetic capture in directory and time each benchmark.
+
+    correlate_data needs the output of process_raw_timestream, which is run
+    first if it is not selected; likewise binary_analyse_split and
+    binary_analyse_pipeline are checked against the output of
+    binary_analyse, and the result of the check is in their matches_serial
+    entry. The pipeline sums blocks of accumulator.EXACT_BLOCK frames as the
+    serial path does, so it is also checked at an n_acc on the other side
+    of EXACT_BLOCK; the values checked are in its checked_n_acc entry. Whether batch_process.discover_captures
+    finds only the captures among the outputs is in discovers_captures.
+
+    returns a dictionary of the configuration and, per benchmark, the best
+    time over repeats with packets/s and MB/s of packet records.
+    '''
+
+    packets = generate_packets(number_channels, number_frames, out_of_order, drop, seed=seed)
+    number_packets = packets.shape[0]
+
+    paths = {'binary': os.path.join(directory, "bench.bin"),
+             'hdf5': os.path.join(directory, "bench.h5"),
+             'binary_out': os.path.join(directory, "PC_bench.bin"),
+             'split_out': os.path.join(directory, "PC_split_bench.bin"),
+             'pipeline_out': os.path.join(directory, "PC_pipeline_bench.bin"),
+             'hdf5_out': os.path.join(directory, "PC_bench.h5"),
+             'frames': os.path.join(directory, "pr_bench.h5")}
+
+    write_binary_capture(paths['binary'], packets, number_channels)
+    write_hdf5_capture(paths['hdf5'], packets, number_channels)
+    del packets
+
+    if 'correlate_data' in benchmarks and 'process_raw_timestream' not in benchmarks:
+        run_process_raw_timestream(paths, number_channels, number_packets, n_acc)
+
+    if ('binary_analyse_split' in benchmarks or 'binary_analyse_pipeline' in benchmarks) \
+        and 'binary_analyse' not in benchmarks:
+        run_binary_analyse(paths, number_channels, number_packets, n_acc)
+
+    megabytes = number_packets * packet_reader.PACKET_DTYPE.itemsize / 1e6
+    results = {'number_channels': number_channels,
+               'number_frames': number_frames,
+               'number_packets': number_packets,
+               'out_of_order': out_of_order,
+               'drop': drop,
+               'n_acc': n_acc,
+               'repeats': repeats,
+               'seed': seed,
+               'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'cpus': multiprocessing.cpu_count(),
+               'benchmarks': {}}
+
+    for name in BENCHMARKS:
+        if name not in benchmarks:
+            continue
+
+        best = None
+        for _ in xrange(repeats):
+            start_time = time.time()
+            RUNNERS[name](paths, number_channels, number_packets, n_acc)
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+
+        results['benchmarks'][name] = {'seconds': best,
+                                       'packets_per_second': number_packets / best,
+                                       'megabytes_per_second': megabytes / best}
+
+    for name, output in (('binary_analyse_split', 'split_out'), ('binary_analyse_pipeline', 'pipeline_out')):
+        if name in results['benchmarks']:
+            results['benchmarks'][name]['matches_serial'] = outputs_equal(paths[output], paths['binary_out'])
+
+    if 'binary_analyse_pipeline' in results['benchmarks']:
+        #Sums of a few EXACT_BLOCK blocks of synthetic frames are long enough to round in complex64.
+        check_n_acc = 4 * acc.EXACT_BLOCK if n_acc <= acc.EXACT_BLOCK else acc.EXACT_BLOCK // 2
+        run_binary_analyse(paths, number_channels, number_packets, check_n_acc)
+        run_binary_analyse_pipeline(paths, number_channels, number_packets, check_n_acc)
+
+        result = results['benchmarks']['binary_analyse_pipeline']
+        result['matches_serial'] = result['matches_serial'] and outputs_equal(paths['pipeline_out'], paths['binary_out'])
+        result['checked_n_acc'] = sorted([n_acc, check_n_acc])
+
+    import batch_process
+    results['discovers_captures'] = batch_process.discover_captures([directory]) == sorted([paths['binary'],
+                                                                                           paths['hdf5']])
+
+    return results
+
+
+def format_results(results):
+    '''
+    Return the benchmark results as a text table.
+    '''
+
+    lines = ["{0:d} channels, {1:d} packets ({2:.1f}% out of order, {3:.1f}% dropped), {4:d} frames per accumulation"\
+             .format(results['number_channels'], results['number_packets'],
+                     100 * results['out_of_order'], 100 * results['drop'], results['n_acc']),
+             "{0:<24s} {1:>10s} {2:>14s} {3:>10s}".format("benchmark", "seconds", "packets/s", "MB/s")]
+
+    for name in BENCHMARKS:
+        if name in results['benchmarks']:
+            result = results['benchmarks'][name]
+            lines += ["{0:<24s} {1:>10.3f} {2:>14.0f} {3:>10.1f}".format(name, result['seconds'],
+                                                                       result['packets_per_second'],
+                                                                       result['megabytes_per_second'])]
+            if 'matches_serial' in result:
+                lines[-1] += "  (output {0:s} serial".format("matches" if result['matches_serial'] else "DIFFERS FROM")
+                if 'checked_n_acc' in result:
+                    lines[-1] += " at n_acc " + " and ".join(str(value) for value in result['checked_n_acc'])
+                lines[-1] += ")"
+
+    if 'discovers_captures' in results:
+        lines += ["batch_process discovery: {0:s}".format("captures only" if results['discovers_captures']
+                                                          else "PICKS UP OUTPUTS")]
+
+    return "\n".join(lines)
+
+
+def usage():
+    '''
+    Usage function.
+    '''
+
+    print "Usage: {0:s} [options]\n\
+         \t -h/--help: This message.\n\
+         \t -c/--channels: Number of channels.\n\
+         \t -f/--frames: Number of frames to generate.\n\
+         \t -r/--out-of-order: Fraction of packets out of order.\n\
+         \t -d/--drop: Fraction of packets dropped.\n\
+         \t -n/--nacc: Number of frames to accumulate.\n\
+         \t -R/--repeats: Number of runs of each benchmark; the best is reported.\n\
+         \t -s/--seed: Random seed.\n\
+         \t -b/--benchmarks: Comma-separated benchmarks to run ({1:s}).\n\
+         \t -w/--workdir: Directory for the generated files (default: temporary, removed afterwards).\n\
+         \t -J/--json: Write the results as JSON to this file.".format(sys.argv[0], ",".join(BENCHMARKS))
+
+
+if __name__ == "__main__":
+
+    N_CHANNELS = 4
+    N_FRAMES = 20000
+    OUT_OF_ORDER = 0.05
+    DROP = 0.01
+    N_ACC = 100
+    REPEATS = 1
+    SEED = 0
+    SELECTED = BENCHMARKS
+    WORKDIR = None
+    JSON_FILENAME = None
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:],
+                                   "hc:f:r:d:n:R:s:b:w:J:",
+                                   ["help",
+                                    "channels=",
+                                    "frames=",
+                                    "out-of-order=",
+                                    "drop=",
+                                    "nacc=",
+                                    "repeats=",
+                                    "seed=",
+                                    "benchmarks=",
+                                    "workdir=",
+                                    "json=",
+                                   ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in OPTS:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-c", "--channels"):
+            N_CHANNELS = int(arg)
+        elif opt in ("-f", "--frames"):
+            N_FRAMES = int(arg)
+        elif opt in ("-r", "--out-of-order"):
+            OUT_OF_ORDER = float(arg)
+        elif opt in ("-d", "--drop"):
+            DROP = float(arg)
+        elif opt in ("-n", "--nacc"):
+            N_ACC = int(arg)
+        elif opt in ("-R", "--repeats"):
+            REPEATS = int(arg)
+        elif opt in ("-s", "--seed"):
+            SEED = int(arg)
+        elif opt in ("-b", "--benchmarks"):
+            SELECTED = tuple(arg.split(","))
+        elif opt in ("-w", "--workdir"):
+            WORKDIR = arg
+        elif opt in ("-J", "--json"):
+            JSON_FILENAME = arg
+
+    if any(name not in BENCHMARKS for name in SELECTED):
+        usage()
+        sys.exit(2)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    DIRECTORY = WORKDIR if WORKDIR is not None else tempfile.mkdtemp(prefix="suit_benchmark_")
+    if not os.path.exists(DIRECTORY):
+        os.makedirs(DIRECTORY)
+
+    try:
+        RESULTS = run_benchmarks(DIRECTORY, N_CHANNELS, N_FRAMES, OUT_OF_ORDER, DROP,
+                                 N_ACC, REPEATS, SEED, SELECTED)
+    finally:
+        if WORKDIR is None:
+            shutil.rmtree(DIRECTORY)
+
+    print format_results(RESULTS)
+
+    if JSON_FILENAME is not None:
+        with open(JSON_FILENAME, 'w') as file_handle:
+            json.dump(RESULTS, file_handle, indent=2, sort_keys=True)
@@ -4,213 +4,117 @@ import os
 import time
 import sys
 from datetime import datetime
-#import multiprocessing
+import multiprocessing
 import getopt
 import logging
 
 import numpy as np
+import accumulator as acc
 import correlator
+import fengine
+import checkpoint
+import packet_reader
+import pipeline
+import profiling
+import reintegrate
+import h5output
 
-from frame import Frame
-
-import struct
+from frame import Frame, FrameAssembler, frame_dtype
 
 import h5py
 
 sys.path.append('~/work/code/h5view/')
 import h5view as h5v
+
+#Handlers are set up under __main__; when imported, the caller configures logging.
+logger = logging.getLogger(__name__) # pylint: disable=locally-disabled, invalid-name
+
+RANGE_MARGIN_FRAMES = 1001 #frames of overlap assembled before a packet range (cleaning threshold + 1)
+MERGE_BLOCK = 64 #accumulations copied at a time when merging packet ranges
   
 
     
-def accumulate_frame(handler, acc_dict, frame):
+def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=None, n_acc = 1000, 
+                   profiler=None, checkpointer=None, state=None, backend=None, 
+                   precision='complex64', output='complex64', frequencies=None, baselines=None):
     '''
-    Calculate the correlation products of a data frame and 
-    add it to an accumulator. If the accumulator is full, 
-    then write the data to disk.
+    Parse hdf5 file from packets into frames and accumulate them. 
+    The stages of the run are timed with profiler, if given, and frames are
+    correlated with backend (a correlator.Backend). Products of the channels
+    of frequencies and the pairs of baselines are summed in precision and
+    written as output (see accumulator.Accumulator).
+
+    With a checkpoint.Checkpointer, the run state is saved between blocks
+    when a checkpoint is due; a state loaded from a checkpoint resumes the run.
     '''
 
-    if acc_dict['filled'] == 0:
-        acc_dict['timestamp'] = frame.packet_timestamps[0]
-        acc_dict['index'] = frame.index
-#        print frame.index
-#        for i in xrange(4):
-#            print frame.packet_timestamps[i]
+    total_packets = to_parse    
+    
+    if profiler is None:
+        profiler = profiling.Profiler(enabled=False)
 
+    accumulator = acc.Accumulator(number_channels, n_acc, precision, output, backend=backend, profiler=profiler, 
+                                  frequencies=frequencies, baselines=baselines)
 
-    datum = correlator.convert_frame_multiple_channels(frame.frame_data)
+    start_time = time.time()
+    
+    cleaning_thresh = 1000
+    DISPLAY_THRESH = 20000
 
-    acc_dict['accumulator'] += correlator.return_triangle_array(correlator.correlate(datum))
-    acc_dict['frame_indices'][acc_dict['filled']] = frame.index
-    acc_dict['frame_numbers'][acc_dict['filled']] = frame.frame_number
-    acc_dict['filled'] += 1
+    assembler = FrameAssembler(number_channels, cleaning_thresh)
 
-    if acc_dict['filled'] == acc_dict['n_acc']:
-        write_to_disk(handler, acc_dict)
-        acc_dict['write_index'] += 1
-        acc_dict['accumulator'] *= 0
-        acc_dict['frame_indices'] *= 0
-        acc_dict['frame_numbers'] *= 0
-        acc_dict['filled'] = 0
+    packet_index = 0
+    if state is not None:
+        packet_index = checkpoint.restore(state, assembler, accumulator)
+        logger.info("Resuming at packet {0:d} with {1:d} accumulations written."\
+            .format(packet_index, accumulator.write_index))
+    first_packet = packet_index
 
+    packet_blocks = packet_reader.iterate_blocks(data_in_handle, start=packet_index, stop=total_packets)
 
+    for block in profiler.timed(packet_blocks, 'read'):
+        with profiler.stage('assembly', block.shape[0]):
+            for packet in block:
+                if packet_index % DISPLAY_THRESH == 0 and packet_index != first_packet:    
+                    logger.info("-+-+-+-+-+-+-+-+-+-+-+-+-+-")
+                    run_time = (time.time() - start_time) / 60.
+                    logger.info("Run time: {0:.3f} minutes.".format(run_time))
+                    logger.info("Estimated time remaining: {0:.2f} minutes."\
+                    .format((total_packets - packet_index) / ((packet_index - first_packet) / run_time)))
+                    logger.info("Packets analysed: {0:6g}/{1:6g}".format(packet_index, total_packets))
+                    logger.debug("Completed frames to date: {0:6g}".format(assembler.completed_frame_total))
+                    logger.info("Completed accumulations to date: {0:6g}".format(accumulator.write_index+1))
+                    logger.debug("Packet-to-frame ratio: {0:.4f}".format(float(packet_index)/assembler.completed_frame_total))
+                    logger.debug("Number of incomplete frames: {0:d}".format(assembler.number_incomplete_frames))
+                    logger.debug("Number of forgotten packets: {0:d}".format(assembler.number_forgotten_packets))
+                    logger.info("Number of mailboxes: {0:d}".format(len(assembler)))
 
-def write_to_disk(dataset_handler, acc_dict):
-    '''
-    Write a completed accumulation to disk.
-    '''
+                frame = assembler.add_packet(packet)
 
-    dataset_handler[acc_dict['write_index']] = (acc_dict['index'], 
-                                                acc_dict['timestamp'], 
-                                                acc_dict['accumulator'], 
-                                                #acc_dict['frame_indices'],
-                                                acc_dict['frame_numbers']
-                                               )
+                if frame is not None:
+                    accumulator.add_frame(data_out_handle, frame)
+                    assembler.release(frame)
 
-def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=None, n_acc = 1000):
-    '''
-    Parse hdf5 file from packets into frames and accumulate them. 
-    '''
+                packet_index += 1
 
-    total_packets = to_parse    
-    n_corr = number_channels * (number_channels + 1) / 2
-    
-    accumulator = {
-        'accumulator': np.zeros((n_corr, 1024), dtype=np.complex64), 
-        'frame_indices': np.zeros((n_acc, ), dtype=np.int),         
-        'frame_numbers': np.zeros((n_acc, ), dtype=np.uint32),                 
-        'filled': 0,
-        'write_index': 0,
-        'n_acc': n_acc,
-        'timestamp': "",
-        'index': -1
-    }
-
-    mailbox = []
-    frame_index = 0
-    need_new = True
-
-    old_frames = []
-    write_frames = []
-   
-    completed_frame_total = 0
-    number_incomplete_frames = 0
-    number_forgotten_packets = 0
-
-    current_time = time.time()
-    start_time = current_time
-#    last_time = current_time
-    
-    cleaning_thresh = 1000
-    DISPLAY_THRESH = 20000
+        if checkpointer is not None and checkpointer.due():
+            checkpointer.save(packet_index, assembler, accumulator, data_out_handle)
+            logger.info("Checkpoint saved at packet {0:d}.".format(packet_index))
+
+    accumulator.flush(data_out_handle)
 
-    struct_fmt = 'Ib2048b26c' # int[5], float, byte[255]
-    struct_len = struct.calcsize(struct_fmt)
-    struct_unpack = struct.Struct(struct_fmt).unpack_from
-
-    struct_array_type = np.dtype([('timestamp', 'uint32'),
-                                  ('antenna', 'int8'),
-                                  ('comp_timestamp', '|S30'), 
-                                  ('timestream', 'int8', 2048)])
-
-    #blank_packet = {'timestamp':}
-
-    for packet_index in xrange(total_packets):
-
-        current_time = time.time()
-        #packet = data_in_handle['ADC_Timestream_Data'][packet_index]
-        packet_stream = data_in_handle.read(struct_len)
-        
-        if not packet_stream: 
-            logger.error("Error with the packet stream.")
-            break
-
-        unpacked_stream = struct_unpack(packet_stream)
-        packet = np.array((unpacked_stream[0], 
-                           unpacked_stream[1], 
-                           ''.join(map(str, unpacked_stream[-26::])),
-                           unpacked_stream[2:-26]), dtype=struct_array_type)
-
-        #if current_time - last_time > 6:
-        if len(mailbox) > 100 or (packet_index % DISPLAY_THRESH == 0 and packet_index != 0):    
-            #last_time = current_time
-            logger.info("-+-+-+-+-+-+-+-+-+-+-+-+-+-")
-            run_time = (time.time() - start_time) / 60.
-            logger.info("Run time: {0:.3f} minutes.".format(run_time))
-            logger.info("Estimated time remaining: {0:.2f} minutes."\
-            .format(total_packets / (packet_index / run_time) - run_time))
-            logger.info("Packets analysed: {0:6g}/{1:6g}".format(packet_index, total_packets))
-            logger.debug("Completed frames to date: {0:6g}".format(completed_frame_total))
-            logger.info("Completed accumulations to date: {0:6g}".format(accumulator['write_index']+1))
-            logger.debug("Packet-to-frame ratio: {0:.4f}".format(float(packet_index)/completed_frame_total))
-            logger.debug("Number of incomplete frames: {0:d}".format(number_incomplete_frames))
-            logger.debug("Number of forgotten packets: {0:d}".format(number_forgotten_packets))
-            logger.info("Number of mailboxes: {0:d}".format(len(mailbox)))
-
-
-            if len(mailbox) > 0 and frame_index - mailbox[0].index > cleaning_thresh:
-                logger.info("Oldest mailbox has an index out of bounds: {0:d}:{1:d}."\
-                .format(packet_index, mailbox[0].index))
-
-                for mailbox_number, frame in enumerate(mailbox):
-                    if frame_index - frame.index > cleaning_thresh:
-                        old_frames += [mailbox_number]
-                        logger.debug("Incomplete frame:")
-                        logger.debug("\n\n" + str(frame) + "\n")
-                        
-                        number_forgotten_packets += frame.number_packets()
-                
-                logger.debug("Removed mailboxes: " + str(old_frames))
-                
-                if len(old_frames) > 0:
-                    number_incomplete_frames += len(old_frames)
-                    mailbox = [i for j, i in enumerate(mailbox) if j not in old_frames]
-                    old_frames = []
-                        
-
-                logger.info("Updated number of mailboxes: {0:d}".format(len(mailbox)))
-
-        for mailbox_number, frame in enumerate(mailbox):
-            if frame.frame_number == packet['timestamp']:
-                
-                if frame.add_packet(packet): #Returns true if the packet is full, false otherwise.
-                    write_frames += [mailbox_number]                        
-                    accumulate_frame(data_out_handle, accumulator, frame)
-                    completed_frame_total += 1 
-
-                    mailbox = [i for j, i in enumerate(mailbox) if j not in write_frames]
-                    write_frames = []
-
-                break
-            elif mailbox_number == len(mailbox) -1:
-                #No mailboxes have matching frames. 
-                need_new = True
-                
-        if need_new:
-            new_frame = Frame(number_channels, packet, frame_index)
-            frame_index += 1
-            mailbox += [new_frame]
-            need_new = False
-        elif len(mailbox) == 0:
-            need_new = True
-
-                
     logger.info("++++++++++++++++++++++++++++++++++++++++")
     logger.info("At end of datafile; final results:")
-    logger.info("Mailbox size: {0:d}\n".format(len(mailbox)))
-    for mailbox_number, frame in enumerate(mailbox):
-        if frame.is_full():
-            #This should never happen.
-            print "Complete frame:"
-            print frame
-            print "\n"
-            completed_frame_total += 1
-        else:
-            logger.info("Incomplete frame:")
-            logger.info("\n" + str(frame) + "\n")
-            number_incomplete_frames += 1
-            number_forgotten_packets += frame.number_packets()
+    logger.info("Mailbox size: {0:d}\n".format(len(assembler)))
+    for frame in assembler.flush():
+        logger.info("Incomplete frame:")
+        logger.info("\n" + str(frame) + "\n")
 
     logger.info("++++++++++++++++++++++++++++++++++++++++")
+    completed_frame_total = assembler.completed_frame_total
+    number_incomplete_frames = assembler.number_incomplete_frames
+    number_forgotten_packets = assembler.number_forgotten_packets
+
     logger.info("Final completed frames: {0:d}".format(completed_frame_total))
     if completed_frame_total != 0:
         logger.info("Packet-to-frame ratio: {0:.4f}".format(float(total_packets)/completed_frame_total))
@@ -223,8 +127,231 @@ def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=No
     logger.info("Ideal frame total: {0:d}".format(completed_frame_total\
                                          + int(np.ceil(number_forgotten_packets/float(number_channels)))))
 
+    if accumulator.rescaled:
+        logger.warning("Accumulations with baselines quantized with a scale above 1: {0:d}".format(accumulator.rescaled))
+
     logger.info("\n")
-    return accumulator['write_index']
+    return accumulator.write_index
+
+def split_ranges(number_packets, n_ranges):
+    '''
+    Return up to n_ranges contiguous (start, stop) packet ranges covering number_packets packets.
+    '''
+
+    bounds = np.linspace(0, number_packets, n_ranges + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in xrange(n_ranges) if bounds[i + 1] > bounds[i]]
+
+
+def _assemble_packets(packets, assembler, start, stop):
+    '''
+    Yield the frames completed by the packets in [start, stop), releasing
+    each frame to the assembler once the caller is done with it.
+    '''
+
+    for block in packet_reader.iterate_blocks(packets, start=start, stop=stop):
+        for packet in block:
+            frame = assembler.add_packet(packet)
+
+            if frame is not None:
+                yield frame
+                assembler.release(frame)
+
+
+def _range_assembler(packets, number_channels, start, margin, cleaning_thresh):
+    '''
+    Return a FrameAssembler holding the frames open at packet start, 
+    assembled from the margin packets before it.
+    '''
+
+    assembler = FrameAssembler(number_channels, cleaning_thresh)
+    for _ in _assemble_packets(packets, assembler, max(0, start - margin), start):
+        pass
+
+    return assembler
+
+
+def count_range(input_filename, number_channels, start, stop, number_packets=None, margin=None, cleaning_thresh=1000):
+    '''
+    Assemble one packet range of a raw binary capture without correlating it.
+
+    returns (frames opened by the packets in [start, stop), frames completed by them).
+    '''
+
+    packets = packet_reader.open_binary_packets(input_filename, number_packets)
+
+    if margin is None:
+        margin = RANGE_MARGIN_FRAMES * number_channels
+
+    assembler = _range_assembler(packets, number_channels, start, margin, cleaning_thresh)
+    first_index = assembler.frame_index
+    completed = sum(1 for _ in _assemble_packets(packets, assembler, start, stop))
+    opened = assembler.frame_index - first_index
+    del packets
+
+    return opened, completed
+
+
+def correlate_range(input_filename, range_filename, number_channels, n_acc, start, stop, number_frames, 
+                    frames_before=0, number_packets=None, margin=None, cleaning_thresh=1000, backend_name='numpy', 
+                    precision='complex64', output='complex64', frequencies=None, baselines=None):
+    '''
+    Correlate the frames owned by one packet range of a raw binary capture
+    and write the accumulations to a 'correlations' dataset in range_filename.
+
+    A frame is owned by the range if it is completed by a packet in
+    [start, stop), so the owned frames of consecutive ranges follow each
+    other in the order of a serial run. The assembler first reads margin
+    packets (by default RANGE_MARGIN_FRAMES frames) before start, so that
+    its open frames match those of a serial run.
+
+    The range owns number_frames frames (see count_range), after 
+    frames_before owned by the preceding ranges. Accumulations are aligned
+    as in a serial run: the owned frames before the first accumulation
+    boundary and after the last one are not correlated but saved as
+    'head_frames' and 'tail_frames' records (see frame.frame_dtype), to be
+    accumulated with the frames of the neighbouring ranges by run_split.
+    The index fields count frames from the start of the range.
+
+    returns a dictionary with the number of accumulations written and the
+    assembler index of the first frame opened in [start, stop).
+    '''
+
+    packets = packet_reader.open_binary_packets(input_filename, number_packets)
+
+    if margin is None:
+        margin = RANGE_MARGIN_FRAMES * number_channels
+
+    assembler = _range_assembler(packets, number_channels, start, margin, cleaning_thresh)
+    first_index = assembler.frame_index
+    accumulator = acc.Accumulator(number_channels, n_acc, precision, output, backend=correlator.get_backend(backend_name), 
+                                  frequencies=frequencies, baselines=baselines)
+
+    range_file = h5py.File(range_filename, 'w')
+    writer = h5output.BatchWriter(h5output.create_dataset(range_file, "correlations", 
+                                                          (h5output.expected_records(stop - start, number_channels, n_acc), ), 
+                                                          dtype=acc.correlation_dtype(number_channels, n_acc, output, 
+                                                                                        len(accumulator.frequencies), 
+                                                                                        len(accumulator.baselines)), 
+                                                          profile='none'))
+
+    head_stop = min(-frames_before % n_acc, number_frames) #owned frames completing the accumulation of the preceding ranges
+    tail_start = head_stop + (number_frames - head_stop) // n_acc * n_acc #owned frames after the last accumulation boundary
+    head_frames = []
+    tail_frames = []
+
+    for owned, frame in enumerate(_assemble_packets(packets, assembler, start, stop)):
+        if owned < head_stop:
+            head_frames += [frame.array()]
+        elif owned < tail_start:
+            accumulator.add_frame(writer, frame)
+        else:
+            tail_frames += [frame.array()]
+
+    written = writer.close()
+
+    for name, records in (('head_frames', head_frames), ('tail_frames', tail_frames)):
+        range_file.create_dataset(name, data=np.concatenate(records) if records 
+                                  else np.zeros((0, ), dtype=frame_dtype(number_channels)))
+
+    range_file.close()
+    del packets
+
+    return {'first_index': first_index, 
+            'accumulations': written}
+
+
+def _accumulate_records(accumulator, writer, records, index_offset, number_channels):
+    '''
+    Add frame_dtype records to accumulator, offsetting their frame indices.
+    '''
+
+    frame = Frame(number_channels)
+
+    for record in records:
+        frame.index = int(record['index']) + index_offset
+        frame.frame_number = int(record['frame_number'])
+        frame.packet_timestamps[:] = record['packet_timestamps']
+        frame.frame_data[:] = record['frame_data']
+        accumulator.add_frame(writer, frame)
+
+
+def run_split(input_filename, writer, number_channels, n_acc, n_ranges, number_packets=None, margin=None, 
+              backend_name='numpy', precision='complex64', output='complex64', frequencies=None, baselines=None):
+    '''
+    Correlate a raw binary capture as n_ranges packet ranges in separate
+    processes (see correlate_range) and merge the accumulations into writer.
+
+    The ranges are first assembled without correlating them (see 
+    count_range), so that each range knows where the accumulation 
+    boundaries of a serial run fall in it. Each range is then correlated
+    into a temporary file next to the output, and the ranges are merged in
+    file order with the frame indices offset by the frames opened in the
+    preceding ranges. Accumulations spanning a range boundary are summed
+    here from the frames either side of it, so the output is the same as
+    that of a serial run and does not depend on which process finishes first.
+
+    returns (number of accumulations written, completed frames, incomplete frames, frames left over).
+    '''
+
+    if number_packets is None:
+        number_packets = packet_reader.open_binary_packets(input_filename).shape[0]
+
+    ranges = split_ranges(number_packets, n_ranges)
+    range_filenames = ["{0:s}.range{1:03d}".format(writer.dataset.file.filename, i) for i in xrange(len(ranges))]
+
+    pool = multiprocessing.Pool(len(ranges))
+
+    try:
+        counts = [pool.apply_async(count_range, (input_filename, number_channels, start, stop, number_packets, margin)) 
+                  for start, stop in ranges]
+        counts = [result.get() for result in counts]
+        opened = [count[0] for count in counts]
+        completed = [count[1] for count in counts]
+
+        results = [pool.apply_async(correlate_range, (input_filename, range_filename, number_channels, n_acc, 
+                                                      start, stop, completed[i], sum(completed[:i]), number_packets, 
+                                                      margin), 
+                                     {'backend_name': backend_name, 'precision': precision, 'output': output, 
+                                      'frequencies': frequencies, 'baselines': baselines})
+                   for i, ((start, stop), range_filename) in enumerate(zip(ranges, range_filenames))]
+        pool.close()
+
+        #Accumulations spanning range boundaries.
+        accumulator = acc.Accumulator(number_channels, n_acc, precision, output, 
+                                      backend=correlator.get_backend(backend_name), 
+                                      frequencies=frequencies, baselines=baselines)
+
+        for i, ((start, stop), result, range_filename) in enumerate(zip(ranges, results, range_filenames)):
+            summary = result.get()
+            index_offset = sum(opened[:i]) - summary['first_index']
+
+            with h5py.File(range_filename, 'r') as range_file:
+                logger.info("Packets {0:d}-{1:d}: {2:d} accumulations, {3:d} frames merged at the boundaries."\
+                    .format(start, stop, summary['accumulations'], 
+                            range_file['head_frames'].shape[0] + range_file['tail_frames'].shape[0]))
+
+                _accumulate_records(accumulator, writer, range_file['head_frames'][...], index_offset, number_channels)
+
+                dataset = range_file['correlations']
+                for block_start in xrange(0, dataset.shape[0], MERGE_BLOCK):
+                    records = dataset[block_start:block_start + MERGE_BLOCK]
+                    records['index'] += index_offset
+                    for record in records:
+                        writer.append(record)
+
+                _accumulate_records(accumulator, writer, range_file['tail_frames'][...], index_offset, number_channels)
+
+            os.remove(range_filename)
+
+    finally:
+        pool.terminate()
+        pool.join()
+        for range_filename in range_filenames:
+            if os.path.isfile(range_filename):
+                os.remove(range_filename)
+
+    return len(writer), sum(completed), sum(opened) - sum(completed), accumulator.filled
+
 
 def usage():
     '''
@@ -236,6 +363,27 @@ def usage():
          \t -f/--file: Input file name.\n\
          \t -p/--packets: Number of packets to analyse.\n\
          \t -n/--nacc: Number of frames to accumulate.\n\
+         \t -j/--workers: Number of correlator processes (0: single process).\n\
+         \t -s/--split: Number of packet ranges correlated in separate processes.\n\
+         \t -c/--correlator: Correlator backend (auto/reference/numpy/threaded/integer).\n\
+         \t -X/--fx: Raw ADC input: channelize with a PFB of this many taps (1: plain FFT; not with -j/-s or -a int64).\n\
+         \t -W/--window: PFB window (rectangular/hamming/hanning/blackman; default rectangular for 1 tap, else hamming).\n\
+         \t -T/--fft-threads: Number of threads channelizing each block of frames.\n\
+         \t --frame-step: Frame number step between consecutive raw ADC frames (default 1).\n\
+         \t -a/--precision: Precision of the accumulated sums (complex64/complex128/int64; complex64 with -j).\n\
+         \t -q/--quantize: Store products as scaled integers (int32/int16; not with -j).\n\
+         \t -F/--frequencies: Frequency channel ranges to correlate, e.g. 100:200,300:400 (default: all).\n\
+         \t -M/--frequency-mask: File of 1024 values, nonzero for the frequency channels to correlate.\n\
+         \t -D/--decimate: Correlate every Nth of the selected frequency channels.\n\
+         \t -A/--average: Average the products of N consecutive selected frequency channels.\n\
+         \t -B/--baselines: Channel pairs to correlate: all, autos, cross or a list such as 0-0,0-1 (default: all).\n\
+         \t -L/--levels: Also store integrations of these multiples of nacc, e.g. 10,100 (see reintegrate.py).\n\
+         \t -o/--output-profile: Output compression (none/lzf/gzip-1/shuffle+lzf/gzip-9).\n\
+         \t -k/--chunk: Number of accumulations per output chunk.\n\
+         \t -r/--resume: Continue an interrupted run from its checkpoint.\n\
+         \t -C/--checkpoint: Seconds between checkpoints (0: no checkpoints).\n\
+         \t -P/--profile: Write per-stage timings as JSON to this file ('-': standard output).\n\
+         \t --profile-interval: Seconds between logged timing summaries.\n\
          \t -l/--log: Log level".format(sys.argv[0])
 
 
@@ -245,6 +393,27 @@ if __name__ == "__main__":
     INPUT_FILENAME = "EMPTY"
     N_TO_ANALYSE = None
     N_ACC = 100
+    N_WORKERS = 0
+    CORRELATOR = 'numpy'
+    FX_TAPS = 0
+    WINDOW = None
+    FFT_THREADS = 1
+    FRAME_STEP = fengine.FRAME_STEP
+    PRECISION = 'complex64'
+    OUTPUT_TYPE = 'complex64'
+    LEVELS = []
+    FREQUENCY_RANGES = ""
+    MASK_FILENAME = None
+    DECIMATION = 1
+    AVERAGE = 1
+    BASELINES = 'all'
+    N_SPLIT = 1
+    OUTPUT_PROFILE = h5output.DEFAULT_PROFILE
+    CHUNK_RECORDS = 1
+    PROFILE_FILENAME = None
+    PROFILE_INTERVAL = None
+    RESUME = False
+    CHECKPOINT_INTERVAL = checkpoint.CHECKPOINT_INTERVAL
     LOG_LEVEL = "INFO"
 
 
@@ -256,11 +425,32 @@ if __name__ == "__main__":
     try:
     #print sys.argv
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "hi:p:n:l:",
+                                   "hi:p:n:j:s:c:X:W:T:a:q:F:M:D:A:B:L:o:k:rC:P:l:",
                                    ["help",
                                     "infile=", 
                                     "packets=", 
                                     "nacc=", 
+                                    "workers=", 
+                                    "split=", 
+                                    "correlator=", 
+                                    "fx=", 
+                                    "window=", 
+                                    "fft-threads=", 
+                                    "frame-step=", 
+                                    "precision=", 
+                                    "quantize=", 
+                                    "frequencies=", 
+                                    "frequency-mask=", 
+                                    "decimate=", 
+                                    "average=", 
+                                    "baselines=", 
+                                    "levels=", 
+                                    "output-profile=", 
+                                    "chunk=", 
+                                    "resume", 
+                                    "checkpoint=", 
+                                    "profile=", 
+                                    "profile-interval=", 
                                     "log=", 
                                    ])
     #print opts
@@ -281,6 +471,55 @@ if __name__ == "__main__":
             LOG_LEVEL = arg
         elif opt in ("-n", "--nacc"):
             N_ACC = int(arg)
+        elif opt in ("-j", "--workers"):
+            N_WORKERS = int(arg)
+        elif opt in ("-s", "--split"):
+            N_SPLIT = int(arg)
+        elif opt in ("-c", "--correlator"):
+            CORRELATOR = arg
+        elif opt in ("-X", "--fx"):
+            FX_TAPS = int(arg)
+        elif opt in ("-W", "--window"):
+            WINDOW = arg
+        elif opt in ("-T", "--fft-threads"):
+            FFT_THREADS = int(arg)
+        elif opt == "--frame-step":
+            FRAME_STEP = int(arg)
+        elif opt in ("-a", "--precision"):
+            PRECISION = arg
+        elif opt in ("-q", "--quantize"):
+            OUTPUT_TYPE = arg
+        elif opt in ("-F", "--frequencies"):
+            FREQUENCY_RANGES = arg
+        elif opt in ("-M", "--frequency-mask"):
+            MASK_FILENAME = arg
+        elif opt in ("-D", "--decimate"):
+            DECIMATION = int(arg)
+        elif opt in ("-A", "--average"):
+            AVERAGE = int(arg)
+        elif opt in ("-B", "--baselines"):
+            BASELINES = arg
+        elif opt in ("-L", "--levels"):
+            LEVELS = reintegrate.parse_factors(arg)
+        elif opt in ("-o", "--output-profile"):
+            OUTPUT_PROFILE = arg
+        elif opt in ("-k", "--chunk"):
+            CHUNK_RECORDS = int(arg)
+        elif opt in ("-P", "--profile"):
+            PROFILE_FILENAME = arg
+        elif opt == "--profile-interval":
+            PROFILE_INTERVAL = float(arg)
+        elif opt in ("-r", "--resume"):
+            RESUME = True
+        elif opt in ("-C", "--checkpoint"):
+            CHECKPOINT_INTERVAL = float(arg)
+
+    if OUTPUT_PROFILE not in h5output.OUTPUT_PROFILES or (N_SPLIT > 1 and N_WORKERS > 0) \
+        or PRECISION not in acc.PRECISIONS or OUTPUT_TYPE not in acc.OUTPUT_TYPES \
+        or (N_WORKERS > 0 and (PRECISION, OUTPUT_TYPE) != ('complex64', 'complex64')) \
+        or (FX_TAPS > 0 and (N_WORKERS > 0 or N_SPLIT > 1 or PRECISION == 'int64')):
+        usage()
+        sys.exit(2)
 
 
     # create logger
@@ -307,45 +546,71 @@ if __name__ == "__main__":
 
     START_TIME = time.time()
 
-    #Open up the input file. 
+    #Read the file header and map the packet records.
     try:
-        INPUT_FILE = open(INPUT_FILENAME, 'rb')
+        HEADER = packet_reader.read_binary_header(INPUT_FILENAME)
+        INPUT_PACKETS = packet_reader.open_binary_packets(INPUT_FILENAME, HEADER['number_packets'])
     except IOError:
         logger.critical("Error opening input file; exiting.")
-        #INPUT_FILE.close()       
         sys.exit()
 
     logger.info("{0:s}\tFile size: {1:s}"\
-        .format(INPUT_FILE, h5v.format_size(os.path.getsize(INPUT_FILENAME))))
-
-    #Set up header reader and read the file header.
-    header_fmt = 'II26c'
-    header_len = struct.calcsize(header_fmt)
-    header_unpack = struct.Struct(header_fmt).unpack_from
+        .format(INPUT_FILENAME, h5v.format_size(os.path.getsize(INPUT_FILENAME))))
 
-    header_read = INPUT_FILE.read(header_len)
-    header_data = header_unpack(header_read)
+    TOT_PACKETS = np.int(HEADER['number_packets'])
+    N_CHANNELS = np.int(HEADER['number_channels'])
+    input_start_date = HEADER['date']
 
-    TOT_PACKETS = np.int(header_data[0])
-    N_CHANNELS = np.int(header_data[1])
-    input_start_date = ''.join(map(str, header_data[-26::]))
+    if INPUT_PACKETS.shape[0] < TOT_PACKETS:
+        logger.warning("File holds only {0:d} of {1:d} packets."\
+        .format(INPUT_PACKETS.shape[0], TOT_PACKETS))
 
     logger.info("Input file attributes: ")
     logger.info("\tStart date: {0:s}".format(input_start_date))
     logger.info("\tNumber channels: {0:d}".format(N_CHANNELS))
     logger.info("\tTotal packets:   {0:d}".format(TOT_PACKETS))
 
-    MAX_FRAMES = int(TOT_PACKETS / 4) + 10 if int(TOT_PACKETS / 4) > 1000 else 1010
     #Compute number unique correlations
     NUMBER_CORRELATIONS = N_CHANNELS * (N_CHANNELS + 1) / 2
 
     logger.info("Total packets in file: {0:d}".format(TOT_PACKETS))
-    logger.info("Maximum number frames: {0:d}".format(MAX_FRAMES))
+
+    #Initial output size; the dataset grows if this turns out to be too small.
+    ANALYSED_PACKETS = N_TO_ANALYSE if N_TO_ANALYSE is not None and N_TO_ANALYSE > 0 else TOT_PACKETS
+    EXPECTED_ACCUMULATIONS = h5output.expected_records(ANALYSED_PACKETS, N_CHANNELS, N_ACC)
+    logger.info("Expected number accumulations: {0:d}".format(EXPECTED_ACCUMULATIONS))
 
     if N_TO_ANALYSE is not None:
         logger.info("Number of frames to analyse: {0:d}".format(N_TO_ANALYSE))
 
     logger.info("Number of frames per accumulation: {0:d}".format(N_ACC))
+
+    try:
+        if FX_TAPS > 0:
+            #Raw ADC frames are channelized into complex spectra, which the int8 correlators cannot take.
+            BACKEND = fengine.FXBackend(fengine.FEngine(N_CHANNELS, FX_TAPS, WINDOW, FFT_THREADS, FRAME_STEP), 
+                                        correlator.get_backend(CORRELATOR, N_CHANNELS, N_ACC, 
+                                                               [name for name in correlator.BACKENDS 
+                                                                if not correlator.BACKENDS[name].integer]))
+        else:
+            BACKEND = correlator.get_backend(CORRELATOR, N_CHANNELS, N_ACC)
+        FREQUENCIES = correlator.FrequencySelection(correlator.load_frequency_mask(MASK_FILENAME) if MASK_FILENAME else None, 
+                                                    correlator.parse_frequency_ranges(FREQUENCY_RANGES), 
+                                                    DECIMATION, AVERAGE)
+        BASELINE_SELECTION = correlator.BaselineSelection(N_CHANNELS, correlator.parse_baselines(BASELINES))
+    except (ValueError, IOError) as err:
+        logger.critical("{0:s} Exiting.".format(str(err)))
+        sys.exit(2)
+
+    if BACKEND.timings is not None:
+        logger.info("Correlator trial times: " + ", ".join("{0:s} {1:.4f} s".format(name, BACKEND.timings[name])
+                                                         for name in sorted(BACKEND.timings)))
+    logger.info("Correlator: {0:s}".format(BACKEND.name))
+    if BACKEND.time_domain:
+        logger.info("F-engine: {0:s}, {1:d} thread(s).".format(BACKEND.fengine, FFT_THREADS))
+    logger.info("Frequency channels: {0:d} of {1:d} correlated, {2:d} stored."\
+        .format(FREQUENCIES.channels.shape[0], correlator.NUMBER_FREQUENCIES, len(FREQUENCIES)))
+    logger.info("Baselines: {0:d} of {1:d} channel pairs.".format(len(BASELINE_SELECTION), NUMBER_CORRELATIONS))
     logger.info("Logging level: {0:s}".format(LOG_LEVEL))
 
     #Set up and open output file
@@ -355,49 +620,147 @@ if __name__ == "__main__":
     if not os.path.exists(os.path.dirname(OUTPUT_FILENAME)):
         os.makedirs(os.path.dirname(OUTPUT_FILENAME))
 
-    if os.path.isfile(OUTPUT_FILENAME):
-        logger.info("Target file '{0:s}' exists; overwriting.".format(OUTPUT_FILENAME))
-        os.remove(OUTPUT_FILENAME)
-        logger.info("Deleted '{0:s}'".format(OUTPUT_FILENAME))
+    #A checkpoint is only valid for the same input and accumulation settings.
+    CHECKPOINTER = checkpoint.Checkpointer(checkpoint.checkpoint_filename(OUTPUT_FILENAME), 
+                                           CHECKPOINT_INTERVAL if N_WORKERS == 0 and N_SPLIT <= 1 else None, 
+                                           input_file=os.path.abspath(INPUT_FILENAME), 
+                                           number_channels=N_CHANNELS, 
+                                           n_acc=N_ACC, 
+                                           precision=PRECISION, 
+                                           products_type=OUTPUT_TYPE, 
+                                           frequencies=FREQUENCIES.digest(), 
+                                           baselines=BASELINE_SELECTION.digest(), 
+                                           fengine=str(BACKEND.fengine) if BACKEND.time_domain else 'none', 
+                                           packets=ANALYSED_PACKETS)
+    STATE = None
+
+    if RESUME:
+        if N_WORKERS > 0 or N_SPLIT > 1:
+            logger.critical("Runs with -j or -s are not checkpointed and cannot be resumed; exiting.")
+            sys.exit(2)
 
-    #Open up output file and assign attributes.
-    OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'w')    
-    OUTPUT_FILE.attrs['process_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-    OUTPUT_FILE.attrs['number_accumulations'] = N_ACC
-    OUTPUT_FILE.attrs['Date'] = input_start_date
-    OUTPUT_FILE.attrs['Number_channels'] = N_CHANNELS
-    OUTPUT_FILE.attrs['Number_packets'] = TOT_PACKETS
-    OUTPUT_FILE.attrs['Truncated_analysis'] = bool(N_TO_ANALYSE is not None and N_TO_ANALYSE > 0)        
+        if os.path.isfile(OUTPUT_FILENAME):
+            with h5py.File(OUTPUT_FILENAME, 'r') as EXISTING_FILE:
+                if EXISTING_FILE.attrs.get('complete', False):
+                    logger.info("Target file '{0:s}' is complete; nothing to resume.".format(OUTPUT_FILENAME))
+                    sys.exit()
+            try:
+                STATE = CHECKPOINTER.load()
+            except ValueError as err:
+                logger.critical("{0:s} Exiting.".format(str(err)))
+                sys.exit(2)
+
+        if STATE is None:
+            logger.warning("No checkpoint for '{0:s}'; starting from the beginning.".format(OUTPUT_FILENAME))
+
+    if STATE is not None:
+        #Records after the checkpoint's write_index are overwritten as the run continues.
+        OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'r+')
+        OUTPUT_FILE.attrs['resume_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        OUTPUT_HANDLER = OUTPUT_FILE['correlations']
+        logger.info("Resuming '{0:s}' from checkpoint of {1:s}.".format(OUTPUT_FILENAME, STATE['save_date']))
+    else:
+        if os.path.isfile(OUTPUT_FILENAME):
+            logger.info("Target file '{0:s}' exists; overwriting.".format(OUTPUT_FILENAME))
+            os.remove(OUTPUT_FILENAME)
+            logger.info("Deleted '{0:s}'".format(OUTPUT_FILENAME))
+        CHECKPOINTER.remove()
+
+        #Open up output file and assign attributes.
+        OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'w')    
+        OUTPUT_FILE.attrs['process_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        OUTPUT_FILE.attrs['number_accumulations'] = N_ACC
+        OUTPUT_FILE.attrs['Date'] = input_start_date
+        OUTPUT_FILE.attrs['Number_channels'] = N_CHANNELS
+        OUTPUT_FILE.attrs['Number_packets'] = TOT_PACKETS
+        OUTPUT_FILE.attrs['Truncated_analysis'] = bool(N_TO_ANALYSE is not None and N_TO_ANALYSE > 0)        
+        OUTPUT_FILE.attrs['complete'] = False
+
+        OUTPUT_FILE.attrs['accumulator_precision'] = PRECISION
+        OUTPUT_FILE.attrs['products_type'] = OUTPUT_TYPE
+        if BACKEND.time_domain:
+            OUTPUT_FILE.attrs['pfb_taps'] = BACKEND.fengine.taps
+            OUTPUT_FILE.attrs['pfb_window'] = BACKEND.fengine.window
+
+        COMP_TYPE = acc.correlation_dtype(N_CHANNELS, N_ACC, OUTPUT_TYPE, len(FREQUENCIES), len(BASELINE_SELECTION))
+
+        OUTPUT_HANDLER = h5output.create_dataset(OUTPUT_FILE, "correlations", 
+                                                 (EXPECTED_ACCUMULATIONS,), 
+                                                 dtype=COMP_TYPE, 
+                                                 maxshape=(None,), 
+                                                 profile=OUTPUT_PROFILE, 
+                                                 chunk_records=CHUNK_RECORDS)
+        FREQUENCIES.write_attrs(OUTPUT_HANDLER)
+        BASELINE_SELECTION.write_attrs(OUTPUT_HANDLER)
 
     logger.info("Output file attributes: ")
     for k in OUTPUT_FILE.attrs.keys():
         logger.info("\t{0:s} : {1:s}".format(k, str(OUTPUT_FILE.attrs[k])))
-    
-
-    COMP_TYPE = np.dtype([('index', 'int64'), 
-                          ('timestamp', '|S30'), 
-                          ('products', 'complex64', (NUMBER_CORRELATIONS, 1024)),
-                          #('frame_indices', 'int32', (N_ACC, )),
-                          ('frame_numbers', 'uint32', (N_ACC, )),                          
-                         ])
 
-    OUTPUT_HANDLER = OUTPUT_FILE.create_dataset("correlations", 
-                                                (MAX_FRAMES,), 
-                                                dtype=COMP_TYPE, 
-                                                maxshape=(MAX_FRAMES,), 
-                                                compression="gzip", 
-                                                compression_opts=9)
+    logger.info("Output profile: {0:s}, {1:d} accumulation(s) per chunk."\
+        .format(OUTPUT_FILE.attrs['output_profile'], OUTPUT_HANDLER.chunks[0]))
+
+    #With -j, only the output writes happen in this process and are timed.
+    PROFILER = profiling.Profiler(enabled=PROFILE_FILENAME is not None or PROFILE_INTERVAL is not None, 
+                                  log_interval=PROFILE_INTERVAL, logger=logger)
+    OUTPUT_WRITER = h5output.BatchWriter(OUTPUT_HANDLER, 
+                                         start_index=STATE['write_index'] if STATE is not None else 0, 
+                                         profiler=PROFILER)
+
+    if N_TO_ANALYSE is None or N_TO_ANALYSE > INPUT_PACKETS.shape[0]:
+        N_TO_ANALYSE = INPUT_PACKETS.shape[0]
+
+    if N_WORKERS > 0:
+        logger.info("Running pipeline with {0:d} correlator processes.".format(N_WORKERS))
+
+        def open_blocks():
+            '''
+            Iterate over the mapped packets in the reader process.
+            '''
+            return packet_reader.iterate_blocks(INPUT_PACKETS, stop=N_TO_ANALYSE)
+
+        (CORRELATION_TOTAL, COMPLETED_FRAMES, INCOMPLETE_FRAMES, FORGOTTEN_PACKETS) = \
+            pipeline.run_pipeline(open_blocks, OUTPUT_WRITER, N_CHANNELS, N_ACC, N_WORKERS, BACKEND.name, FREQUENCIES, 
+                                  BASELINE_SELECTION)
+
+        logger.info("Final completed frames: {0:d}".format(COMPLETED_FRAMES))
+        logger.info("Number of incomplete frames: {0:d}".format(INCOMPLETE_FRAMES))
+        logger.info("Number of forgotten packets: {0:d}".format(FORGOTTEN_PACKETS))
+    elif N_SPLIT > 1:
+        logger.info("Correlating {0:d} packet ranges in separate processes.".format(N_SPLIT))
+
+        (CORRELATION_TOTAL, COMPLETED_FRAMES, INCOMPLETE_FRAMES, LEFT_OVER_FRAMES) = \
+            run_split(INPUT_FILENAME, OUTPUT_WRITER, N_CHANNELS, N_ACC, N_SPLIT, N_TO_ANALYSE, 
+                      backend_name=BACKEND.name, precision=PRECISION, output=OUTPUT_TYPE, frequencies=FREQUENCIES, 
+                      baselines=BASELINE_SELECTION)
+
+        logger.info("Final completed frames: {0:d}".format(COMPLETED_FRAMES))
+        logger.info("Number of incomplete frames: {0:d}".format(INCOMPLETE_FRAMES))
+        logger.info("Frames left over after the last accumulation: {0:d}".format(LEFT_OVER_FRAMES))
+    else:
+        CORRELATION_TOTAL = parse_raw_data(INPUT_PACKETS, OUTPUT_WRITER, 
+                                           N_CHANNELS, N_TO_ANALYSE, N_ACC, PROFILER, 
+                                           CHECKPOINTER, STATE, BACKEND, PRECISION, OUTPUT_TYPE, FREQUENCIES, 
+                                           BASELINE_SELECTION)
 
-    if N_TO_ANALYSE is None:
-        N_TO_ANALYSE = TOT_PACKETS
 
-    CORRELATION_TOTAL = parse_raw_data(INPUT_FILE, OUTPUT_HANDLER, 
-                                       N_CHANNELS, N_TO_ANALYSE, N_ACC)
+    CORRELATION_TOTAL = OUTPUT_WRITER.close()
 
+    if PROFILE_FILENAME is not None:
+        PROFILER.write_json(PROFILE_FILENAME, 
+                            input_file=INPUT_FILENAME, 
+                            packets=int(N_TO_ANALYSE), 
+                            input_bytes=int(N_TO_ANALYSE) * packet_reader.PACKET_DTYPE.itemsize, 
+                            accumulations=CORRELATION_TOTAL, 
+                            workers=N_WORKERS)
 
     OUTPUT_FILE.attrs['number_correlations'] = CORRELATION_TOTAL
     OUTPUT_FILE.attrs['true_number_entries'] = CORRELATION_TOTAL
-    OUTPUT_HANDLER.resize((CORRELATION_TOTAL,))
+
+    if LEVELS:
+        reintegrate.build_pyramid(OUTPUT_FILE, LEVELS)
+
+    OUTPUT_FILE.attrs['complete'] = True
 
     logger.info("Number of accumulations in output file: {0:d}".format(CORRELATION_TOTAL))
 #    print "Printing first three entries: "
@@ -405,8 +768,9 @@ if __name__ == "__main__":
 #        print "Frame index: {0:6g}\tFrame timestamp: {1}".format(dataset_handler[i]['index'], 
 #            np.uint32(dataset_handler[i]['frame_number']))
     #print OUTPUT_FILE
-    INPUT_FILE.close()    
+    del INPUT_PACKETS
     OUTPUT_FILE.close()
+    CHECKPOINTER.remove()
     logger.info("----------------------------------------")
     logger.info("Run time: {0:.3f}".format(time.time() - START_TIME))
     logger.info("Number accumulations: {0:d}".format(CORRELATION_TOTAL))
@@ -0,0 +1,159 @@
+import os
+import time
+
+import numpy as np
+import h5py
+
+from frame import frame_dtype
+
+CHECKPOINT_INTERVAL = 300. #seconds between checkpoints
+
+#FrameAssembler attributes saved with its open frames.
+ASSEMBLER_COUNTERS = ('frame_index',
+                      'completed_frame_total',
+                      'number_incomplete_frames',
+                      'number_forgotten_packets')
+
+#Accumulator.state() entries saved as attributes and as datasets (fengine_* only for raw ADC frames).
+ACCUMULATOR_ATTRIBUTES = ('filled', 'timestamp', 'index', 'rescaled')
+ACCUMULATOR_DATASETS = ('sums', 'staged_frames', 'staged_frame_indices', 'staged_frame_numbers', 'waiting_frames', 
+                        'fengine_history', 'fengine_history_numbers')
+
+
+def checkpoint_filename(output_filename):
+    '''
+    Return the name of the checkpoint file kept next to an output file.
+    '''
+    return output_filename + ".checkpoint"
+
+
+class Checkpointer(object):
+
+    '''
+    Periodically save the state of a correlation run so that an interrupted
+    run can be resumed.
+
+    A checkpoint holds the index of the next input packet, the open frames
+    and counters of the FrameAssembler, the partial sums and staged frames of
+    the Accumulator and the number of records written. The output records are flushed before
+    the checkpoint is saved, and the checkpoint is written under a temporary
+    name and renamed into place, so the checkpoint on disk always matches the
+    first write_index records of the output file.
+
+    params:
+        filename: checkpoint file, usually checkpoint_filename(output file).
+        interval: seconds between checkpoints; None or 0 disables them.
+        identity: run parameters (e.g. input_file, number_channels, n_acc)
+                  that must match when the checkpoint is loaded.
+    '''
+
+    def __init__(self, filename, interval=CHECKPOINT_INTERVAL, **identity):
+
+        self.filename = filename
+        self.interval = interval
+        self.identity = identity
+        self.last_save = time.time()
+
+    def due(self):
+        '''
+        Check if the checkpoint interval has passed since the last save.
+        '''
+        return bool(self.interval) and time.time() - self.last_save > self.interval
+
+    def save(self, packet_index, assembler, accumulator, writer):
+        '''
+        Flush the output records and save the run state.
+
+        params:
+            packet_index: index of the next packet to be read from the input.
+            assembler: FrameAssembler of the run.
+            accumulator: accumulator.Accumulator of the run.
+            writer: BatchWriter of the output dataset.
+        '''
+
+        writer.flush()
+
+        frames = assembler.open_frames()
+        records = np.zeros((len(frames), ), dtype=frame_dtype(assembler.num_channels))
+        trace_masks = np.zeros((len(frames), ), dtype=np.int64)
+
+        for i, frame in enumerate(frames):
+            records[i] = frame.array()[0]
+            trace_masks[i] = frame.trace_mask
+
+        state = accumulator.state()
+        temporary = self.filename + ".tmp"
+
+        with h5py.File(temporary, 'w') as file_handle:
+            for key, value in self.identity.items():
+                file_handle.attrs[key] = value
+
+            file_handle.attrs['packet_index'] = packet_index
+            file_handle.attrs['write_index'] = len(writer)
+            for name in ASSEMBLER_COUNTERS:
+                file_handle.attrs[name] = getattr(assembler, name)
+
+            for name in ACCUMULATOR_ATTRIBUTES:
+                file_handle.attrs[name] = state[name]
+            file_handle.attrs['save_date'] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+            file_handle.create_dataset('open_frames', data=records)
+            file_handle.create_dataset('trace_masks', data=trace_masks)
+            for name in ACCUMULATOR_DATASETS:
+                if name in state:
+                    file_handle.create_dataset(name, data=state[name])
+
+        with open(temporary, 'rb') as file_handle:
+            os.fsync(file_handle.fileno())
+        os.rename(temporary, self.filename)
+
+        self.last_save = time.time()
+
+    def load(self):
+        '''
+        Read the saved checkpoint.
+
+        returns a dictionary of the checkpoint attributes and datasets, or None
+        if there is no checkpoint. Raises ValueError if the checkpoint was
+        written by a run with different parameters.
+        '''
+
+        if not os.path.isfile(self.filename):
+            return None
+
+        with h5py.File(self.filename, 'r') as file_handle:
+            for key, value in self.identity.items():
+                if file_handle.attrs.get(key) != value:
+                    raise ValueError("Checkpoint '{0:s}' was written with {1:s} = {2:s}, not {3:s}."\
+                        .format(self.filename, key, str(file_handle.attrs.get(key)), str(value)))
+
+            state = dict(file_handle.attrs.items())
+            for name in file_handle:
+                state[name] = file_handle[name][...]
+
+        return state
+
+    def remove(self):
+        '''
+        Delete the checkpoint, e.g. once the run has completed.
+        '''
+
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+def restore(state, assembler, accumulator):
+    '''
+    Restore a FrameAssembler and an Accumulator, both newly created, from a
+    checkpoint returned by Checkpointer.load().
+
+    returns the index of the next packet to be read from the input.
+    '''
+
+    assembler.restore_frames(state['open_frames'], state['trace_masks'])
+    for name in ASSEMBLER_COUNTERS:
+        setattr(assembler, name, int(state[name]))
+
+    accumulator.restore(state)
+
+    return int(state['packet_index'])
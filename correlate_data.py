@@ -1,6 +1,7 @@
 import os
 import time
 import sys
+import getopt
 from datetime import datetime
 
 #import multiprocessing
@@ -13,6 +14,7 @@ import h5view as h5v
 import h5py
 
 from correlator import *
+import h5output
 
 def now_str():
     '''
@@ -33,19 +35,88 @@ def return_slice(dataset_handler, index):
     '''
     return dataset_handler[index]
 
-def main():
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print "Usage: {0:s} <filename> [number integrations == 100]"
+def usage():
+    '''
+    Usage function.
+    '''
+
+    print "Usage: {0:s} [options] <filename> [number integrations == 100]\n\
+         \t -c/--correlator: Correlator backend (auto/reference/numpy/threaded).\n\
+         \t -F/--frequencies: Frequency channel ranges to correlate, e.g. 100:200,300:400 (default: all).\n\
+         \t -M/--frequency-mask: File of 1024 values, nonzero for the frequency channels to correlate.\n\
+         \t -D/--decimate: Correlate every Nth of the selected frequency channels.\n\
+         \t -A/--average: Average the products of N consecutive selected frequency channels.\n\
+         \t -B/--baselines: Channel pairs to correlate: all, autos, cross or a list such as 0-0,0-1 (default: all).\n\
+         \t -o/--output-profile: Output compression (none/lzf/gzip-1/shuffle+lzf/gzip-9).\n\
+         \t -k/--chunk: Number of accumulations per output chunk.".format(sys.argv[0])
+
+def main(argv=None):
+    '''
+    Run with command-line arguments argv (default sys.argv[1:]).
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    try:
+        opts, args = getopt.getopt(argv, "c:F:M:D:A:B:o:k:", ["correlator=", "frequencies=", "frequency-mask=", 
+                                                              "decimate=", "average=", "baselines=", 
+                                                              "output-profile=", "chunk="])
+    except getopt.GetoptError:
+        usage()
         return
 
-    
+    if len(args) < 1 or len(args) > 2:
+        usage()
+        return
+
+    output_profile = h5output.DEFAULT_PROFILE
+    chunk_records = 1
+    correlator_name = 'numpy'
+    frequency_ranges = ""
+    mask_filename = None
+    decimation = 1
+    average = 1
+    baseline_text = 'all'
+
+    for opt, arg in opts:
+        if opt in ("-c", "--correlator"):
+            correlator_name = arg
+        elif opt in ("-F", "--frequencies"):
+            frequency_ranges = arg
+        elif opt in ("-M", "--frequency-mask"):
+            mask_filename = arg
+        elif opt in ("-D", "--decimate"):
+            decimation = int(arg)
+        elif opt in ("-A", "--average"):
+            average = int(arg)
+        elif opt in ("-B", "--baselines"):
+            baseline_text = arg
+        elif opt in ("-o", "--output-profile"):
+            output_profile = arg
+        elif opt in ("-k", "--chunk"):
+            chunk_records = int(arg)
+
+    #Gains are applied to the complex samples, so only backends taking complex values apply.
+    complex_backends = sorted(name for name in BACKENDS if not BACKENDS[name].integer)
+
+    if output_profile not in h5output.OUTPUT_PROFILES or correlator_name not in ['auto'] + complex_backends:
+        usage()
+        return
+
+    try:
+        frequencies = FrequencySelection(load_frequency_mask(mask_filename) if mask_filename else None, 
+                                         parse_frequency_ranges(frequency_ranges), decimation, average)
+    except (ValueError, IOError) as err:
+        print str(err)
+        usage()
+        return
 
-    data_file = sys.argv[1] #"/home/sean/work/cosmology/ice/ch_acq/chrx/v1/dataOut/messy.0000"
+    data_file = args[0] #"/home/sean/work/cosmology/ice/ch_acq/chrx/v1/dataOut/messy.0000"
     
     n_acc = 100
 
-    if len(sys.argv) == 3:
-        n_acc = int(sys.argv[2])
+    if len(args) == 2:
+        n_acc = int(args[1])
 
 
 
@@ -55,6 +126,13 @@ def main():
     in_data = h5py.File(data_file, "r")
     print "{0:s}\n\tFile size: {1:s}\n".format(in_data, h5v.format_size(os.path.getsize(data_file)))
 
+    try:
+        baselines = BaselineSelection(in_data.attrs['Number_channels'], parse_baselines(baseline_text))
+    except ValueError as err:
+        print str(err)
+        usage()
+        return
+
 
 
 
@@ -79,69 +157,62 @@ def main():
 
 
 
-    number_frequencies = 1024
     number_channels = in_data.attrs['Number_channels']    
     number_entries = in_data.attrs['true_number_entries']    
-    number_correlations = number_channels * (number_channels + 1) / 2
+    number_correlations = len(baselines)
  
+    backend = get_backend(correlator_name, number_channels, n_acc, complex_backends)
+    print "Correlator: {0:s}".format(backend.name)
+
 
     comp_type = np.dtype([('index', 'int64'), 
                           ('timestamp', '|S30'), 
-                          ('products', 'complex64', (number_correlations, number_frequencies))
+                          ('products', 'complex64', (number_correlations, len(frequencies)))
                           ])
-    dataset_handler = out_data.create_dataset("correlations", 
-                                              (number_entries,), 
+    dataset_handler = h5output.create_dataset(out_data, "correlations", 
+                                              (max(1, number_entries // n_acc),), 
                                               dtype=comp_type, 
-                                              maxshape=(number_entries,), 
-                                              compression="gzip", compression_opts=9)
+                                              maxshape=(None,), 
+                                              profile=output_profile, 
+                                              chunk_records=chunk_records)
+    frequencies.write_attrs(dataset_handler)
+    baselines.write_attrs(dataset_handler)
+
+    writer = h5output.BatchWriter(dataset_handler)
 
-    gains = np.ones((number_channels, number_frequencies), dtype=int)
+    #Complex gains per channel and selected frequency, applied in place to each block of samples.
+    gains = np.ones((number_channels, frequencies.channels.shape[0]), dtype=np.complex64)
     
 
     print "Start  {0:s}".format(now_str())
 
     frame_timestream = in_data['frame_timestream']
 
-    accumulator = return_triangle_array(correlate(convert_frame_multiple_channels(return_slice(frame_timestream, 0)['frame_data'])))
+    #One read and one reduction per accumulation; records left over after the last full accumulation are not used.
+    records = np.empty((n_acc, ), dtype=frame_timestream.dtype)
     
-    acc_index = 0
     #n_acc = int(1000) 
     out_data.attrs['accumulations_per_measurement'] = n_acc
 
-
-    accumulator = accumulator*0.
     write_index = 0
 
-    for i in xrange(number_entries):
-        sliced_data = frame_timestream[i]
-
-        if acc_index == 0:
-            frame_index = sliced_data['index']
-            timestamp = sliced_data['packet_timestamps'][0]
-            #print frame_index, timestamp
-
-        datum = convert_frame_multiple_channels(sliced_data['frame_data'])*gains
-
-        accumulator += return_triangle_array(correlate(datum))
-
-        if acc_index == n_acc -1:
+    for start in xrange(0, number_entries - n_acc + 1, n_acc):
+        frame_timestream.read_direct(records, np.s_[start:start + n_acc])
 
-            #print "Writing accumulation to disk."
-            dataset_handler[write_index] = (frame_index, timestamp, accumulator)
+        frame_index = records[0]['index']
+        timestamp = records[0]['packet_timestamps'][0]
 
-            write_index += 1
+        datum = backend.convert(frequencies.select(records['frame_data']))
+        datum *= gains
 
-            acc_index = 0
-            accumulator = 0.*accumulator
-            
-        else:
-            acc_index += 1
+        writer.append((frame_index, timestamp, frequencies.reduce(backend.correlate_pairs(datum, baselines))))
+        write_index += 1
 
-        if i > 0 and i%1000 == 0:
-            print "[{2:s}] At {0:d}/{1:d}".format(i, number_entries, now_str())
+        if start // 1000 != (start + n_acc) // 1000:
+            print "[{2:s}] At {0:d}/{1:d}".format(start + n_acc, number_entries, now_str())
             print "\tCurrent packet information: {0:5d}; {1:30s}".format(frame_index, timestamp)
 
-    dataset_handler.resize((write_index,))
+    write_index = writer.close()
     out_data.attrs['true_number_entries'] = write_index
     out_data.close()
     print "\nFinished {0:s}".format(now_str())
@@ -1,3 +1,8 @@
+import hashlib
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 
 
@@ -41,4 +46,538 @@ def convert_frame_multiple_channels(data):
     '''
 
     return data[:, ::2] + 1.0*1j*data[:, 1::2]
-    
\ No newline at end of file
+    
+
+
+def convert_frame_block(data):
+    '''
+    Convert a block of IceBoard frames with shape (N_frames, N_channels, 2048) 
+    into complex64 values with shape (N_frames, N_channels, 1024).
+    '''
+
+    block = np.empty(data.shape[:-1] + (data.shape[-1] // 2,), dtype=np.complex64)
+    block.real = data[..., ::2]
+    block.imag = data[..., 1::2]
+    return block
+
+
+def correlate_block(fourier):
+    '''
+    Correlate a block of frames and sum the products over the frames.
+
+    params:
+        fourier: FFTs with shape (N_frames, N_channels, N_frequency_channels)
+
+    returns the summed upper-triangle products with shape (N_correlations, N_frequency_channels),
+    in the same order as return_triangle_array(correlate(...)).
+    '''
+
+    rows, cols = np.triu_indices(fourier.shape[1])
+
+    #Stack one (N_frames, N_channels) matrix per frequency channel so a single
+    #batched matrix product sums conj(f_i) * f_j over all frames.
+    stack = np.ascontiguousarray(fourier.transpose(2, 0, 1))
+    products = np.matmul(stack.conj().transpose(0, 2, 1), stack)
+
+    return products[:, rows, cols].T.astype(np.complex64)
+
+
+class Backend(object):
+
+    '''
+    Correlator backend interface.
+
+    A backend turns a block of raw IceBoard frames into summed upper-triangle
+    products in two steps, so that the steps can be timed separately:
+    convert() decodes the int8 frames and correlate() sums the products over
+    the frames. Subclasses override correlate(), and convert() if they work
+    on another representation of the samples.
+    '''
+
+    name = None
+    integer = False #correlate() takes int8 samples from convert() rather than complex values
+    time_domain = False #convert() channelizes raw ADC samples (see fengine.FXBackend)
+    timings = None
+
+    def convert(self, frames):
+        '''
+        Decode frames with shape (N_frames, N_channels, 2048) for correlate().
+        '''
+        return convert_frame_block(frames)
+
+    def correlate(self, fourier):
+        '''
+        Return the products of converted frames summed over the frames, as
+        complex64 with shape (N_correlations, N_frequency_channels).
+        '''
+        raise NotImplementedError
+
+    def correlate_pairs(self, fourier, baselines=None):
+        '''
+        Return the products of the pairs of baselines (a BaselineSelection)
+        summed over the frames, with shape (N_pairs, N_frequency_channels).
+
+        All pairs are computed with correlate(); a subset is computed pair
+        by pair, so that only the selected products are computed.
+        '''
+
+        if baselines is None or baselines.all_pairs:
+            return self.correlate(fourier)
+
+        return self.correlate_subset(fourier, baselines.pairs[:, 0], baselines.pairs[:, 1])
+
+    def correlate_subset(self, fourier, rows, cols):
+        '''
+        Return the products conj(f_i) f_j of the channel pairs (rows[k], cols[k])
+        of converted frames, summed over the frames.
+        '''
+
+        conjugate = fourier.conj()
+        products = np.empty((rows.shape[0], fourier.shape[2]), dtype=np.complex64)
+
+        for pair, (i, j) in enumerate(zip(rows, cols)):
+            products[pair] = np.einsum('fk,fk->k', conjugate[:, i], fourier[:, j])
+
+        return products
+
+    def correlate_raw(self, frames, baselines=None):
+        '''
+        Decode and correlate a block of raw frames.
+        '''
+        return self.correlate_pairs(self.convert(frames), baselines)
+
+
+class ReferenceBackend(Backend):
+
+    '''
+    Pair-by-pair products of each frame with correlate(), summed in complex64.
+    '''
+
+    name = 'reference'
+
+    def correlate(self, fourier):
+        accumulator = np.zeros((fourier.shape[1] * (fourier.shape[1] + 1) // 2, fourier.shape[2]), dtype=np.complex64)
+
+        for frame in fourier:
+            accumulator += return_triangle_array(correlate(frame))
+
+        return accumulator
+
+
+class NumpyBackend(Backend):
+
+    '''
+    One batched matrix product over all frequency channels (correlate_block).
+    '''
+
+    name = 'numpy'
+
+    def correlate(self, fourier):
+        return correlate_block(fourier)
+
+
+class ThreadedBackend(Backend):
+
+    '''
+    Blocked matrix products run on a pool of threads.
+
+    The frequency channels are split into blocks and the channels into tiles
+    of tile_channels; each task is one frequency block of one tile pair on or
+    above the diagonal, so tiles below the diagonal are never computed. NumPy
+    releases the GIL in the matrix products, so the tasks run in parallel.
+    '''
+
+    name = 'threaded'
+
+    def __init__(self, n_threads=None, tile_channels=8, frequency_blocks=None):
+
+        if n_threads is None:
+            n_threads = multiprocessing.cpu_count()
+
+        self.n_threads = n_threads
+        self.tile_channels = tile_channels
+        self.frequency_blocks = frequency_blocks if frequency_blocks is not None else 2 * n_threads
+        self.pool = None #created on first use, so that the backend can be passed to forked processes
+
+    def correlate(self, fourier):
+
+        if self.pool is None:
+            self.pool = ThreadPool(self.n_threads)
+
+        number_channels = fourier.shape[1]
+        number_frequencies = fourier.shape[2]
+
+        stack = np.ascontiguousarray(fourier.transpose(2, 0, 1))
+        products = np.empty((number_frequencies, number_channels, number_channels), dtype=np.complex64)
+
+        tiles = [(start, min(start + self.tile_channels, number_channels))
+                 for start in xrange(0, number_channels, self.tile_channels)]
+        bounds = np.linspace(0, number_frequencies, min(self.frequency_blocks, number_frequencies) + 1).astype(int)
+
+        def multiply(task):
+            '''
+            Products of one tile pair over one frequency block.
+            '''
+            (f_start, f_stop), (i_start, i_stop), (j_start, j_stop) = task
+            products[f_start:f_stop, i_start:i_stop, j_start:j_stop] = \
+                np.matmul(stack[f_start:f_stop, :, i_start:i_stop].conj().transpose(0, 2, 1),
+                          stack[f_start:f_stop, :, j_start:j_stop])
+
+        tasks = [((bounds[k], bounds[k + 1]), tiles[i], tiles[j])
+                 for k in xrange(len(bounds) - 1)
+                 for i in xrange(len(tiles))
+                 for j in xrange(i, len(tiles))]
+        self.pool.map(multiply, tasks)
+
+        rows, cols = np.triu_indices(number_channels)
+        return products[:, rows, cols].T.copy()
+
+
+EXACT_FRAMES = 1024 #frames per float32 product; every partial sum stays within 2**24
+INT32_FRAMES = 131071 #frames whose sums of int8 products fit in int32
+
+
+class IntegerBackend(Backend):
+
+    '''
+    Exact correlation of the int8 samples.
+
+    convert() keeps the samples as int8 and stacks the real and imaginary
+    parts of each frequency channel into one (N_frames, 2 N_channels) matrix
+    X, so that X^T X holds every sum re_i re_j, re_i im_j, im_i re_j and
+    im_i im_j, and conj(f_i) f_j = (re_i re_j + im_i im_j) + i (re_i im_j - im_i re_j).
+
+    The sums are accumulated exactly in int32 (int64 beyond INT32_FRAMES
+    frames) and converted to complex64 only when returned. With blas, the
+    products of up to EXACT_FRAMES frames at a time are computed as float32
+    matrix products, which are exact because every partial sum is an integer
+    of at most 2**24; otherwise integer matrix products are used throughout.
+
+    correlate() only accepts the output of convert(); frames that have been
+    scaled (e.g. by gains) are not integers and need another backend.
+    '''
+
+    name = 'integer'
+    integer = True
+
+    def __init__(self, blas=True):
+        self.blas = blas
+
+    def convert(self, frames):
+        number_channels = frames.shape[1]
+        planes = np.empty((frames.shape[2] // 2, frames.shape[0], 2 * number_channels), dtype=np.int8)
+        planes[:, :, :number_channels] = frames[..., ::2].transpose(2, 0, 1)
+        planes[:, :, number_channels:] = frames[..., 1::2].transpose(2, 0, 1)
+        return planes
+
+    def correlate(self, planes):
+
+        number_frequencies, number_frames, width = planes.shape
+        number_channels = width // 2
+        sum_type = np.int32 if number_frames <= INT32_FRAMES else np.int64
+
+        sums = np.zeros((number_frequencies, width, width), dtype=sum_type)
+
+        for start in xrange(0, number_frames, EXACT_FRAMES):
+            block = planes[:, start:start + EXACT_FRAMES].astype(np.float32 if self.blas else sum_type)
+            sums += np.matmul(block.transpose(0, 2, 1), block).astype(sum_type, copy=False)
+
+        rows, cols = np.triu_indices(number_channels)
+
+        products = np.empty((rows.shape[0], number_frequencies), dtype=np.complex64)
+        products.real = (sums[:, rows, cols].astype(np.int64) + sums[:, rows + number_channels, cols + number_channels]).T
+        products.imag = (sums[:, rows, cols + number_channels].astype(np.int64) - sums[:, rows + number_channels, cols]).T
+        return products
+
+    def correlate_subset(self, planes, rows, cols):
+
+        number_frequencies, number_frames, width = planes.shape
+        number_channels = width // 2
+
+        real = np.zeros((rows.shape[0], number_frequencies), dtype=np.int64)
+        imag = np.zeros((rows.shape[0], number_frequencies), dtype=np.int64)
+
+        def dot(block, i, j):
+            '''
+            Sums of the products of two planes over the frames of a block, as int64.
+            '''
+            return np.einsum('kf,kf->k', block[:, :, i], block[:, :, j]).astype(np.int64)
+
+        for start in xrange(0, number_frames, EXACT_FRAMES):
+            block = planes[:, start:start + EXACT_FRAMES].astype(np.float32 if self.blas else np.int64)
+
+            for pair, (i, j) in enumerate(zip(rows, cols)):
+                real[pair] += dot(block, i, j) + dot(block, i + number_channels, j + number_channels)
+                imag[pair] += dot(block, i, j + number_channels) - dot(block, i + number_channels, j)
+
+        products = np.empty((rows.shape[0], number_frequencies), dtype=np.complex64)
+        products.real = real
+        products.imag = imag
+        return products
+
+
+BACKENDS = {'reference': ReferenceBackend,
+            'numpy': NumpyBackend,
+            'threaded': ThreadedBackend,
+            'integer': IntegerBackend}
+
+BENCHMARK_FRAMES = 32 #frames per trial of the auto selection
+BENCHMARK_REPEATS = 3
+
+
+def benchmark_backends(number_channels, n_frames=BENCHMARK_FRAMES, repeats=BENCHMARK_REPEATS, names=None):
+    '''
+    Time correlate_raw of each backend on random frames.
+
+    returns a dictionary of the best time in seconds for each backend name.
+    '''
+
+    frames = np.random.RandomState(0).randint(-128, 128, (n_frames, number_channels, 2048)).astype(np.int8)
+    timings = {}
+
+    for name in (names if names is not None else sorted(BACKENDS)):
+        backend = BACKENDS[name]()
+        best = None
+        for _ in xrange(repeats):
+            start_time = time.time()
+            backend.correlate_raw(frames)
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+
+    return timings
+
+
+def get_backend(name, number_channels=None, n_frames=BENCHMARK_FRAMES, names=None):
+    '''
+    Return a backend instance by name. 'auto' benchmarks the backends named
+    in names (default: all) on number_channels channels and returns the 
+    fastest, with the trial times in its timings attribute.
+    '''
+
+    timings = None
+
+    if name == 'auto':
+        timings = benchmark_backends(number_channels, min(n_frames, BENCHMARK_FRAMES), names=names)
+        name = min(timings, key=timings.get)
+
+    if name not in BACKENDS or (names is not None and name not in names):
+        raise ValueError("Unknown correlator '{0:s}'; choose from auto, {1:s}."\
+            .format(name, ", ".join(sorted(names if names is not None else BACKENDS))))
+
+    backend = BACKENDS[name]()
+    backend.timings = timings #seconds per trial of each backend, if chosen by 'auto'
+    return backend
+
+
+NUMBER_FREQUENCIES = 1024 #frequency channels of an IceBoard frame
+
+
+def parse_frequency_ranges(text):
+    '''
+    Parse frequency channel ranges such as "100:200,512,600:700" into a
+    list of (start, stop) pairs, with stop exclusive as for slices.
+    '''
+
+    ranges = []
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        if ":" in item:
+            start, stop = item.split(":")
+            ranges.append((int(start), int(stop)))
+        else:
+            ranges.append((int(item), int(item) + 1))
+
+    return ranges
+
+
+class FrequencySelection(object):
+
+    '''
+    Frequency channels kept by a correlation run.
+
+    select() cuts the raw frames down to the selected channels before they
+    are converted and multiplied, so the correlation work and the output
+    scale with the selection. reduce() then averages the products of every
+    average consecutive selected channels.
+
+    params:
+        mask: boolean array of NUMBER_FREQUENCIES channels to keep.
+        ranges: (start, stop) channel ranges to keep (see parse_frequency_ranges).
+        decimation: keep every decimation-th of the channels left by mask and ranges.
+        average: number of selected channels averaged into each output channel;
+                 must divide the number of selected channels.
+    '''
+
+    def __init__(self, mask=None, ranges=None, decimation=1, average=1):
+
+        keep = np.ones((NUMBER_FREQUENCIES, ), dtype=bool)
+
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != keep.shape:
+                raise ValueError("Frequency mask has {0:d} channels, not {1:d}.".format(mask.size, NUMBER_FREQUENCIES))
+            keep &= mask
+
+        if ranges:
+            in_ranges = np.zeros_like(keep)
+            for start, stop in ranges:
+                if not 0 <= start < stop <= NUMBER_FREQUENCIES:
+                    raise ValueError("Frequency range {0:d}:{1:d} is outside 0:{2:d}.".format(start, stop, NUMBER_FREQUENCIES))
+                in_ranges[start:stop] = True
+            keep &= in_ranges
+
+        self.channels = np.flatnonzero(keep)[::decimation] #selected channel indices
+        self.decimation = decimation
+        self.average = average
+
+        if self.channels.shape[0] == 0 or average < 1 or self.channels.shape[0] % average != 0:
+            raise ValueError("Cannot average {0:d} selected frequency channels in groups of {1:d}."\
+                .format(self.channels.shape[0], average))
+
+        self.all_channels = self.channels.shape[0] == NUMBER_FREQUENCIES
+
+    def __len__(self):
+        '''
+        Return the number of output frequency channels.
+        '''
+        return self.channels.shape[0] // self.average
+
+    def select(self, frames):
+        '''
+        Return raw frames (..., 2048) cut down to the selected channels,
+        with shape (..., 2 * selected channels). Without a selection the
+        frames are returned as they are.
+        '''
+
+        if self.all_channels:
+            return frames
+
+        pairs = frames.reshape(frames.shape[:-1] + (NUMBER_FREQUENCIES, 2))
+        return pairs[..., self.channels, :].reshape(frames.shape[:-1] + (2 * self.channels.shape[0], ))
+
+    def select_spectra(self, fourier):
+        '''
+        Return spectra (..., 1024) cut down to the selected channels, e.g.
+        after channelizing raw ADC frames.
+        '''
+
+        if self.all_channels:
+            return fourier
+
+        return fourier[..., self.channels]
+
+    def reduce(self, products):
+        '''
+        Average the products (..., selected channels) of every average consecutive channels.
+        '''
+
+        if self.average == 1:
+            return products
+
+        return products.reshape(products.shape[:-1] + (len(self), self.average)).mean(axis=-1)
+
+    def digest(self):
+        '''
+        Return a short string identifying the selection, e.g. for a checkpoint.
+        '''
+        return "{0:s}/{1:d}".format(hashlib.md5(self.channels.astype(np.int64).tostring()).hexdigest(), self.average)
+
+    def write_attrs(self, dataset):
+        '''
+        Record the selection in the attributes of an output dataset.
+        '''
+
+        dataset.attrs['frequency_channels'] = self.channels
+        dataset.attrs['frequency_average'] = self.average
+
+
+BASELINE_SETS = ('all', 'autos', 'cross')
+
+
+def parse_baselines(text):
+    '''
+    Parse a baseline selection: 'all', 'autos', 'cross', or channel pairs
+    such as "0-0,0-1,2-3".
+    '''
+
+    if text in BASELINE_SETS:
+        return text
+
+    pairs = []
+    for item in text.split(","):
+        if item.strip():
+            i, j = item.split("-")
+            pairs.append((int(i), int(j)))
+
+    return pairs
+
+
+class BaselineSelection(object):
+
+    '''
+    Channel pairs whose products are computed and stored, in output order.
+
+    params:
+        number_channels: channels per frame.
+        pairs: 'all' (the N(N+1)/2 pairs of return_triangle_array, in its
+               order), 'autos' (the N pairs (i, i)), 'cross' (the pairs
+               i < j) or a list of (i, j) pairs. A pair is stored as
+               (min, max), so its product is conj(f_min) f_max.
+    '''
+
+    def __init__(self, number_channels, pairs='all'):
+
+        rows, cols = np.triu_indices(number_channels)
+        every_pair = np.column_stack((rows, cols))
+
+        if pairs == 'all':
+            selected = every_pair
+        elif pairs == 'autos':
+            selected = every_pair[rows == cols]
+        elif pairs == 'cross':
+            selected = every_pair[rows != cols]
+        else:
+            selected = np.sort(np.array(pairs, dtype=np.int64).reshape(-1, 2), axis=1)
+            if selected.shape[0] == 0 or selected.min() < 0 or selected.max() >= number_channels:
+                raise ValueError("Baselines must be pairs of channels 0-{0:d}.".format(number_channels - 1))
+            if len(set(map(tuple, selected))) != selected.shape[0]:
+                raise ValueError("Baselines are repeated.")
+
+        if selected.shape[0] == 0:
+            raise ValueError("No baselines selected of {0:d} channels.".format(number_channels))
+
+        self.pairs = selected.astype(np.int64) #(N_pairs, 2) channel pairs
+        self.all_pairs = np.array_equal(self.pairs, every_pair)
+
+    def __len__(self):
+        '''
+        Return the number of pairs.
+        '''
+        return self.pairs.shape[0]
+
+    def digest(self):
+        '''
+        Return a short string identifying the selection, e.g. for a checkpoint.
+        '''
+        return hashlib.md5(self.pairs.tostring()).hexdigest()
+
+    def write_attrs(self, dataset):
+        '''
+        Record the pairs in the 'baselines' attribute of an output dataset,
+        so that products[k] is the product of channels baselines[k].
+        '''
+        dataset.attrs['baselines'] = self.pairs
+
+
+def load_frequency_mask(filename):
+    '''
+    Read a frequency mask of NUMBER_FREQUENCIES values, nonzero for the channels
+    to keep, from a text file (whitespace or one per line) or a .npy file.
+    '''
+
+    if filename.endswith(".npy"):
+        return np.load(filename).astype(bool).ravel()
+
+    return np.loadtxt(filename).astype(bool).ravel()
@@ -0,0 +1,260 @@
+'''
+Software F-engine for captures taken with the IceBoard in raw ADC mode.
+
+In raw ADC mode the 2048 int8 values of each channel of a frame are real
+time samples rather than interleaved real/imaginary pairs of channelized
+data. FEngine turns blocks of such frames into the (N_channels, 1024)
+complex spectra the correlators take, with a real FFT batched over every
+channel and frame of a block, optionally preceded by a polyphase filter
+bank (PFB). FXBackend wraps an FEngine and a correlator backend so the
+accumulators can correlate raw frames like channelized ones.
+'''
+
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import correlator
+
+FRAME_SAMPLES = 2048 #real samples per channel of a raw ADC frame
+FRAME_STEP = 1 #frame number step between consecutive raw ADC frames
+REORDER_FRAMES = 64 #frames kept beyond the PFB taps, so that frames completed late find the frames before them
+
+#Window functions of the PFB, taking the number of coefficients.
+WINDOWS = {'rectangular': np.ones,
+           'hamming': np.hamming,
+           'hanning': np.hanning,
+           'blackman': np.blackman}
+
+_COEFFICIENTS = {} #(taps, window): filter coefficients, shared by every FEngine
+
+
+def pfb_coefficients(taps, window):
+    '''
+    Return the float32 filter coefficients of a PFB with shape (taps, FRAME_SAMPLES).
+
+    With more than one tap, the window is applied to a sinc spanning the
+    taps with one lobe per frame; a single tap is a windowed FFT.
+    Coefficients are computed once per (taps, window) and cached.
+    '''
+
+    key = (taps, window)
+
+    if key not in _COEFFICIENTS:
+        if window not in WINDOWS:
+            raise ValueError("Unknown window '{0:s}'; choose from {1:s}.".format(window, ", ".join(sorted(WINDOWS))))
+        if taps < 1:
+            raise ValueError("A PFB needs at least one tap, not {0:d}.".format(taps))
+
+        length = taps * FRAME_SAMPLES
+        coefficients = WINDOWS[window](length)
+        if taps > 1:
+            coefficients = coefficients * np.sinc((np.arange(length) - length / 2.) / FRAME_SAMPLES)
+
+        _COEFFICIENTS[key] = coefficients.astype(np.float32).reshape(taps, FRAME_SAMPLES)
+
+    return _COEFFICIENTS[key]
+
+
+def frame_offset(first, second):
+    '''
+    Return the signed difference second - first of two uint32 frame numbers, allowing for wrapping.
+    '''
+    return (int(second) - int(first) + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+
+class FEngine(object):
+
+    '''
+    Channelize raw ADC frames into complex spectra.
+
+    channelize() weights each frame and the taps - 1 frames before it with
+    the PFB coefficients, sums them and takes one real FFT per channel and
+    frame, keeping the first 1024 of the 1025 bins (the Nyquist bin is
+    dropped). The frames before a frame are found by frame number, among
+    the frames of the block and the most recent taps - 1 + reorder_frames
+    frames kept from earlier blocks, so frames may be passed in the order
+    the assembler completes them. Frames that are not found (dropped,
+    incomplete, not yet completed or older than those kept) count as zeros,
+    so the first frames of a run and the frames after a gap see zeros
+    before them.
+
+    The coefficients are cached per (taps, window) and NumPy reuses its
+    FFT plan (twiddle factors) for the fixed 2048-sample length. With
+    n_threads, the frames of a block are split between threads; the
+    weighting and the FFTs release the GIL.
+
+    params:
+        number_channels: channels per frame.
+        taps: PFB taps; 1 for a plain (windowed) FFT.
+        window: key of WINDOWS; 'rectangular' for one tap and 'hamming'
+                otherwise by default.
+        n_threads: threads per block; 1 transforms in the calling thread.
+        frame_step: frame number step between consecutive frames.
+        reorder_frames: frames kept beyond the taps, for frames completed late;
+                        accumulator.Accumulator also holds back this many
+                        frames to stage them in frame-number order.
+    '''
+
+    def __init__(self, number_channels, taps=1, window=None, n_threads=1, frame_step=FRAME_STEP, 
+                 reorder_frames=REORDER_FRAMES):
+
+        if window is None:
+            window = 'rectangular' if taps == 1 else 'hamming'
+
+        if n_threads is None:
+            n_threads = multiprocessing.cpu_count()
+
+        self.number_channels = number_channels
+        self.taps = taps
+        self.window = window
+        self.n_threads = n_threads
+        self.frame_step = frame_step
+        self.reorder_frames = reorder_frames
+        self.coefficients = pfb_coefficients(taps, window)
+        self.plain = taps == 1 and window == 'rectangular' #no weighting needed
+        self.depth = taps - 1 + reorder_frames if taps > 1 else 0 #frames kept between blocks
+        self.history = np.zeros((0, number_channels, FRAME_SAMPLES), dtype=np.int8) #most recent frames, oldest first
+        self.history_numbers = np.zeros((0, ), dtype=np.uint32) #their frame numbers
+        self.pool = None #created on first use, so that the engine can be passed to forked processes
+
+    def __str__(self):
+        return "{0:d} tap(s), {1:s} window, frame step {2:d}".format(self.taps, self.window, self.frame_step)
+
+    def reset(self):
+        '''
+        Forget the frames of earlier blocks.
+        '''
+        self.restore(self.history[:0], self.history_numbers[:0])
+
+    def restore(self, frames, frame_numbers):
+        '''
+        Keep frames with frame_numbers as the frames of earlier blocks, e.g. from a checkpoint.
+        '''
+        self.history = np.array(frames, dtype=np.int8)
+        self.history_numbers = np.array(frame_numbers, dtype=np.uint32)
+
+    def channelize(self, frames, frame_numbers=None):
+        '''
+        Return the spectra of raw frames (N_frames, N_channels, 2048) as
+        complex64 with shape (N_frames, N_channels, 1024).
+
+        Without frame_numbers, the frames are taken to follow the most
+        recent frame kept, one frame step apart.
+        '''
+
+        number_frames = frames.shape[0]
+        spectra = np.empty((number_frames, frames.shape[1], correlator.NUMBER_FREQUENCIES), dtype=np.complex64)
+
+        if self.taps == 1:
+            samples = frames
+            sources = np.arange(number_frames)[:, np.newaxis]
+        else:
+            if frame_numbers is None:
+                first = int(self.history_numbers[-1]) + self.frame_step if self.history_numbers.shape[0] else 0
+                frame_numbers = (first + self.frame_step * np.arange(number_frames)) % 2 ** 32
+
+            numbers = np.concatenate((self.history_numbers, np.asarray(frame_numbers, dtype=np.uint32)))
+            samples = np.concatenate((self.history, frames, np.zeros((1, ) + frames.shape[1:], dtype=np.int8)))
+            missing = numbers.shape[0] #index of the frame of zeros in samples
+
+            #Position in samples of each frame number, by offset from the first frame of the block.
+            offsets = [frame_offset(numbers[-number_frames], number) for number in numbers]
+            positions = dict((offset, position) for position, offset in enumerate(offsets))
+
+            first = self.history.shape[0]
+            sources = np.array([[positions.get(offset - (self.taps - 1 - tap) * self.frame_step, missing)
+                                 for tap in xrange(self.taps)] for offset in offsets[first:]], dtype=np.intp)
+
+        def transform(bounds):
+            '''
+            Weight, sum and transform the frames in [start, stop).
+            '''
+
+            start, stop = bounds
+
+            if self.plain:
+                weighted = samples[sources[start:stop, 0]].astype(np.float32)
+            else:
+                weighted = samples[sources[start:stop, 0]] * self.coefficients[0]
+                for tap in xrange(1, self.taps):
+                    weighted += samples[sources[start:stop, tap]] * self.coefficients[tap]
+
+            spectra[start:stop] = np.fft.rfft(weighted, axis=-1)[..., :correlator.NUMBER_FREQUENCIES]
+
+        n_tasks = min(self.n_threads, number_frames)
+        bounds = np.linspace(0, number_frames, n_tasks + 1).astype(int)
+        tasks = [(bounds[k], bounds[k + 1]) for k in xrange(n_tasks)]
+
+        if n_tasks > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.n_threads)
+            self.pool.map(transform, tasks)
+        else:
+            for task in tasks:
+                transform(task)
+
+        if self.taps > 1:
+            kept = [positions[offset] for offset in sorted(positions)[-self.depth:]]
+            self.restore(samples[kept], numbers[kept])
+
+        return spectra
+
+
+class FXBackend(correlator.Backend):
+
+    '''
+    Correlator backend for raw ADC frames: convert() channelizes the frames
+    with fengine (an FEngine) and the products of the spectra are computed
+    by backend, a correlator backend taking complex values.
+
+    Frames are staged in the order the assembler completes them; convert()
+    takes their frame numbers so that each frame is filtered with the frames
+    before it (see FEngine).
+    '''
+
+    time_domain = True
+
+    def __init__(self, fengine, backend=None):
+
+        if backend is None:
+            backend = correlator.NumpyBackend()
+
+        if backend.integer:
+            raise ValueError("The {0:s} correlator takes int8 samples, not channelized spectra.".format(backend.name))
+
+        self.fengine = fengine
+        self.backend = backend
+        self.name = "fx+" + backend.name
+        self.timings = backend.timings
+
+    def convert(self, frames, frame_numbers=None):
+        return self.fengine.channelize(frames, frame_numbers)
+
+    def correlate(self, fourier):
+        return self.backend.correlate(fourier)
+
+    def correlate_subset(self, fourier, rows, cols):
+        return self.backend.correlate_subset(fourier, rows, cols)
+
+
+def benchmark_fengine(number_channels, taps=1, window=None, n_threads=1, n_frames=256, repeats=3):
+    '''
+    Time channelize() on random frames.
+
+    returns the best throughput in frames per second.
+    '''
+
+    frames = np.random.RandomState(0).randint(-128, 128, (n_frames, number_channels, FRAME_SAMPLES)).astype(np.int8)
+    fengine = FEngine(number_channels, taps, window, n_threads)
+    best = None
+
+    for _ in xrange(repeats):
+        start_time = time.time()
+        fengine.channelize(frames)
+        elapsed = time.time() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    return n_frames / best
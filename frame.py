@@ -1,3 +1,5 @@
+from collections import deque
+
 import numpy as np
 
 class Error(Exception):
@@ -5,36 +7,59 @@ class Error(Exception):
     pass
 
 
+_FRAME_DTYPES = {}
+
+
+def frame_dtype(num_channels):
+    '''
+    Return the compound dtype of a frame record; one instance is shared
+    by every frame with the same number of channels.
+    '''
+
+    if num_channels not in _FRAME_DTYPES:
+        _FRAME_DTYPES[num_channels] = np.dtype([('index', 'int64'), 
+                                                ('frame_number', 'uint32'),
+                                                ('packet_timestamps', '|S30', num_channels), 
+                                                ('frame_data', 'int8', (num_channels, 2048))])
+
+    return _FRAME_DTYPES[num_channels]
+
+
 class Frame(object):
 
     '''
     Frame class to combine multiple packets into a single frame.
     '''
+
+    __slots__ = ('num_channels', 'frame_data', 'trace_mask', 'full_mask',
+                 'frame_number', 'packet_timestamps', 'index')
         
-    def __init__(self, num_channels, packet, index=None):
+    def __init__(self, num_channels, packet=None, index=None):
         
         self.num_channels = num_channels #number channels 
-        self.frame_data = np.zeros((num_channels, 2048)) #frame payload
-        self.trace_received = np.zeros(num_channels) #flags for which packets are in frame
+        self.frame_data = np.zeros((num_channels, 2048), dtype=np.int8) #frame payload
+        self.trace_mask = 0 #bit i is set once the packet for channel i is in the frame
+        self.full_mask = (1 << num_channels) - 1
         self.frame_number = 0 #Frame number from FPGA (i.e. frame timestamp 32 bit number)
-        #the timestamps for each packet
-        self.packet_timestamps = np.empty(num_channels, dtype=str)
-        #['' for string in xrange(num_channels)] 
-        self.index = 0 #frame indexing number
-
-        self.comp_type = np.dtype([('index', 'int64'), 
-                                   ('frame_number', 'uint32'),
-                                   ('packet_timestamps', '|S30', self.num_channels), 
-                                   ('frame_data', 'int8', (self.num_channels, 2048))])
-
-
-    #if packet is not None:
-        self.frame_number = packet['timestamp']
-        self.frame_data[int(packet['antenna'])] = packet['timestream']
-        self.packet_timestamps[int(packet['antenna'])] = packet['comp_timestamp']
-        self.trace_received[int(packet['antenna'])] = 1
-    #if index is not None:
-        self.index = index
+        self.packet_timestamps = np.zeros(num_channels, dtype='|S30') #the timestamps for each packet
+        self.index = index #frame indexing number
+
+        if packet is not None:
+            self.reset(packet, index)
+
+    @property
+    def comp_type(self):
+        '''
+        Compound dtype of the array representation of the frame.
+        '''
+        return frame_dtype(self.num_channels)
+
+    @property
+    def trace_received(self):
+        '''
+        Flags for which packets are in the frame.
+        '''
+        return [(self.trace_mask >> i) & 1 for i in xrange(self.num_channels)]
     
     def __str__(self):
         '''
@@ -44,43 +69,67 @@ class Frame(object):
         printstr = "Frame index: {0:d}\n".format(self.index)
         printstr += "Frame number: {0:X}\n".format(np.uint32(self.frame_number))
         printstr += "\tTotal number traces: {0:d}\n".format(self.num_channels)
-        printstr += "\tTotal filled traces: {0:d}\n".format(int(np.sum(self.trace_received)))
+        printstr += "\tTotal filled traces: {0:d}\n".format(self.number_packets())
         trace_key = ""
         for i in self.trace_received:
-            trace_key += str(int(i)) 
+            trace_key += str(i) 
         printstr += "\tReceived traces: {0:s}".format(trace_key)
         return printstr
+
+    def reset(self, packet, index):
+        '''
+        Reuse the frame for the frame number of packet, starting with that packet.
+        '''
+
+        self.frame_number = int(packet['timestamp'])
+        self.index = index
+        self.trace_mask = 0
+        self._store(packet)
+
+    def _store(self, packet):
+        '''
+        Copy the payload of a packet into the frame.
+        '''
+
+        antenna = int(packet['antenna'])
+        self.frame_data[antenna] = packet['timestream']
+        self.packet_timestamps[antenna] = packet['comp_timestamp']
+        self.trace_mask |= 1 << antenna
         
     def is_full(self):
         '''
         Check if a frame has been filled.
         '''
-        return int(sum(self.trace_received)) == self.num_channels
+        return self.trace_mask == self.full_mask
 
     def number_packets(self):
         '''
         Return the number of packets in a frame.
         '''
-        return int(sum(self.trace_received))
+        return bin(self.trace_mask).count('1')
 
     def add_packet(self, packet):
         '''
         Add information in a packet to a frame.
         '''
 
-        try:
-            if self.frame_number != packet['timestamp']:
-                raise Error('Mismatched timestamp on add_packet.')
-            else:
-                self.frame_data[int(packet['antenna'])] = packet['timestream']
-                self.packet_timestamps[int(packet['antenna'])] = packet['comp_timestamp']
-                self.trace_received[int(packet['antenna'])] = 1
+        if self.frame_number != packet['timestamp']:
+            raise Error('Mismatched timestamp on add_packet.')
 
-                return self.is_full()
+        self._store(packet)
+        return self.is_full()
 
-        except Error:
-            raise
+    def copy(self):
+        '''
+        Return a copy of the frame with arrays of its own.
+        '''
 
+        frame = Frame(self.num_channels, index=self.index)
+        frame.frame_data[:] = self.frame_data
+        frame.trace_mask = self.trace_mask
+        frame.frame_number = self.frame_number
+        frame.packet_timestamps[:] = self.packet_timestamps
+        return frame
 
     def array(self):
         '''
@@ -92,4 +141,217 @@ class Frame(object):
                           self.frame_number, 
                           self.packet_timestamps, 
                           self.frame_data)], dtype=self.comp_type)
-        
\ No newline at end of file
+
+
+class FramePool(object):
+
+    '''
+    Fixed-size pool of frames that are recycled between frame numbers.
+
+    Frames are allocated on demand until the pool reaches its size, after
+    which acquire() returns None until a frame is released.
+    '''
+
+    def __init__(self, num_channels, size):
+
+        self.num_channels = num_channels #number channels
+        self.size = size #maximum number of frames owned by the pool
+        self.allocated = 0 #number of frames created so far
+        self.free = [] #released frames ready for reuse
+
+    def acquire(self, packet, index):
+        '''
+        Return a frame initialised with packet, or None if the pool is exhausted.
+        With packet None the frame is returned as it was left, to be filled by the caller.
+        '''
+
+        if self.free:
+            frame = self.free.pop()
+        elif self.allocated < self.size:
+            frame = Frame(self.num_channels)
+            self.allocated += 1
+        else:
+            return None
+
+        if packet is not None:
+            frame.reset(packet, index)
+        return frame
+
+    def release(self, frame):
+        '''
+        Return a frame to the pool.
+        '''
+        self.free += [frame]
+
+
+class FrameAssembler(object):
+
+    '''
+    Assemble packets into frames, keyed on the FPGA frame number.
+
+    Open frames are held in a dictionary keyed on frame number, so inserting a
+    packet and completing a frame are O(1). Frames that fall more than 
+    cleaning_thresh frames behind the newest frame are evicted from the front
+    of an age-ordered queue and counted as incomplete.
+
+    Frames come from a FramePool; completed frames returned by add_packet
+    must be handed back with release() once they have been used. If the pool
+    runs dry, the oldest open frame is evicted to make room.
+    '''
+
+    def __init__(self, num_channels, cleaning_thresh=1000, pool_size=None):
+
+        self.num_channels = num_channels #number channels
+        self.cleaning_thresh = cleaning_thresh #age (in frames) at which open frames are dropped
+
+        if pool_size is None:
+            pool_size = cleaning_thresh + 2
+        self.pool = FramePool(num_channels, pool_size)
+
+        self.mailbox = {} #open frames keyed on frame number
+        self.age_order = deque() #(frame number, frame index) of open frames, oldest first
+        self.frame_index = 0 #index assigned to the next new frame
+
+        self.completed_frame_total = 0
+        self.number_incomplete_frames = 0
+        self.number_forgotten_packets = 0
+
+    def __len__(self):
+        '''
+        Return the number of open frames.
+        '''
+        return len(self.mailbox)
+
+    def add_packet(self, packet):
+        '''
+        Add a packet to its frame, opening a new frame if none matches.
+
+        returns the completed Frame if the packet filled it, otherwise None.
+        '''
+
+        frame_number = int(packet['timestamp'])
+        frame = self.mailbox.get(frame_number)
+
+        if frame is None:
+            self.evict_stale()
+            frame = self.pool.acquire(packet, self.frame_index)
+
+            while frame is None:
+                if not self.mailbox:
+                    raise Error('Frame pool exhausted; completed frames must be released.')
+                self._evict_oldest()
+                frame = self.pool.acquire(packet, self.frame_index)
+
+            self.frame_index += 1
+
+            if not frame.is_full():
+                self.mailbox[frame_number] = frame
+                self.age_order.append((frame_number, frame.index))
+                return None
+
+        elif frame.add_packet(packet): #Returns true if the frame is full, false otherwise.
+            del self.mailbox[frame_number]
+
+        else:
+            return None
+
+        self.completed_frame_total += 1
+        return frame
+
+    def evict_stale(self):
+        '''
+        Remove open frames older than the cleaning threshold.
+
+        returns the number of evicted frames; they are back in the pool.
+        '''
+
+        evicted = 0
+
+        while self.age_order:
+            frame_number, index = self.age_order[0]
+            frame = self.mailbox.get(frame_number)
+
+            if frame is None or frame.index != index:
+                #Frame was completed since it was queued.
+                self.age_order.popleft()
+            elif self.frame_index - index > self.cleaning_thresh:
+                self._evict_oldest()
+                evicted += 1
+            else:
+                break
+
+        return evicted
+
+    def _evict_oldest(self):
+        '''
+        Drop the oldest open frame, count it as incomplete and recycle it.
+        '''
+
+        while True:
+            frame_number, index = self.age_order.popleft()
+            frame = self.mailbox.get(frame_number)
+
+            if frame is not None and frame.index == index:
+                break
+
+        del self.mailbox[frame_number]
+        self.number_incomplete_frames += 1
+        self.number_forgotten_packets += frame.number_packets()
+        self.pool.release(frame)
+
+    def release(self, frame):
+        '''
+        Hand a completed frame back to the pool once it has been consumed.
+        '''
+        self.pool.release(frame)
+
+    def open_frames(self):
+        '''
+        Return the open frames, oldest first.
+        '''
+
+        return [self.mailbox[frame_number] for frame_number, index in self.age_order
+                if frame_number in self.mailbox and self.mailbox[frame_number].index == index]
+
+    def restore_frames(self, records, trace_masks):
+        '''
+        Reopen frames saved from open_frames(), e.g. from a checkpoint.
+
+        params:
+            records: frame_dtype records of the open frames, oldest first.
+            trace_masks: trace_mask of each frame.
+        '''
+
+        for record, trace_mask in zip(records, trace_masks):
+            frame = self.pool.acquire(None, None)
+            if frame is None:
+                raise Error('Frame pool too small for the restored frames.')
+
+            frame.index = int(record['index'])
+            frame.frame_number = int(record['frame_number'])
+            frame.packet_timestamps[:] = record['packet_timestamps']
+            frame.frame_data[:] = record['frame_data']
+            frame.trace_mask = int(trace_mask)
+
+            self.mailbox[frame.frame_number] = frame
+            self.age_order.append((frame.frame_number, frame.index))
+
+    def flush(self):
+        '''
+        Remove all open frames at the end of a data file.
+
+        returns copies of the incomplete frames that were still open; the
+        frames themselves are back in the pool.
+        '''
+
+        remaining = []
+
+        for frame in self.open_frames():
+            self.number_incomplete_frames += 1
+            self.number_forgotten_packets += frame.number_packets()
+            remaining += [frame.copy()]
+            self.pool.release(frame)
+
+        self.mailbox = {}
+        self.age_order.clear()
+        return remaining
@@ -0,0 +1,163 @@
+import time
+
+import numpy as np
+
+import profiling
+
+#Filters for each output profile, as keyword arguments to h5py create_dataset.
+OUTPUT_PROFILES = {
+    'none': {},
+    'lzf': {'compression': 'lzf'},
+    'gzip-1': {'compression': 'gzip', 'compression_opts': 1},
+    'shuffle+lzf': {'shuffle': True, 'compression': 'lzf'},
+    'gzip-9': {'compression': 'gzip', 'compression_opts': 9},
+}
+
+DEFAULT_PROFILE = 'lzf'
+
+FLUSH_BYTES = 8 * 1024 * 1024 #staging buffer size of a BatchWriter
+FLUSH_INTERVAL = 10. #seconds between forced flushes of a BatchWriter
+
+
+def expected_records(number_packets, number_channels, n_acc=1):
+    '''
+    Return the number of output records expected from number_packets packets
+    when every record holds n_acc frames of number_channels packets.
+    '''
+
+    return max(1, int(np.ceil(number_packets / float(number_channels * n_acc))))
+
+
+def create_dataset(group, name, shape, dtype, maxshape=(None, ), profile=DEFAULT_PROFILE, chunk_records=1):
+    '''
+    Create a one-dimensional record dataset using an output profile.
+
+    params:
+        group: h5py file or group to create the dataset in.
+        name, shape, dtype: as for h5py create_dataset; shape is the initial size.
+        maxshape: as for h5py create_dataset; unlimited by default so that
+                  a BatchWriter can grow the dataset.
+        profile: key of OUTPUT_PROFILES selecting the compression filters.
+        chunk_records: number of records per HDF5 chunk, e.g. one or a few
+                       accumulations.
+
+    The profile and chunk length are recorded in the file attributes.
+    '''
+
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError("Unknown output profile '{0:s}'; choose from {1:s}."\
+            .format(profile, ", ".join(sorted(OUTPUT_PROFILES))))
+
+    if maxshape[0] is not None:
+        chunk_records = min(chunk_records, maxshape[0])
+    chunk_records = max(1, chunk_records)
+
+    dataset = group.create_dataset(name,
+                                   shape,
+                                   dtype=dtype,
+                                   maxshape=maxshape,
+                                   chunks=(chunk_records, ),
+                                   **OUTPUT_PROFILES[profile])
+
+    group.file.attrs['output_profile'] = profile
+    group.file.attrs['chunk_records'] = chunk_records
+
+    return dataset
+
+
+class BatchWriter(object):
+
+    '''
+    Stage records in a preallocated structured buffer and write them to a
+    dataset with one slice write per flush.
+
+    Records are filled in place: take a record with next_record(), set its
+    fields, then commit(). The buffer is flushed when it is full, when 
+    flush_interval seconds have passed since the last flush, and on close().
+
+    A dataset that is too small is grown geometrically on flush, and close()
+    trims it to the records written. After every flush the 'number_records'
+    attribute of the dataset holds the number of valid records, so the file
+    can be read while the run is in progress.
+
+    Flushes are timed as the 'write' stage of profiler, if given.
+    '''
+
+    def __init__(self, dataset, batch_records=None, flush_interval=FLUSH_INTERVAL, start_index=0, profiler=None):
+
+        if batch_records is None:
+            batch_records = max(1, FLUSH_BYTES // dataset.dtype.itemsize)
+
+        self.dataset = dataset #output dataset
+        self.buffer = np.zeros((batch_records, ), dtype=dataset.dtype) #staged records
+        self.staged = 0 #number of records in the buffer
+        self.write_index = start_index #dataset row of the first staged record
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.profiler = profiler if profiler is not None else profiling.Profiler(enabled=False)
+
+    def __len__(self):
+        '''
+        Return the number of records written or staged so far.
+        '''
+        return self.write_index + self.staged
+
+    def next_record(self):
+        '''
+        Return the next staging record, to be filled in place before commit().
+        '''
+        return self.buffer[self.staged]
+
+    def commit(self):
+        '''
+        Accept the record returned by next_record(), flushing if a threshold is reached.
+        '''
+
+        self.staged += 1
+
+        if self.staged == self.buffer.shape[0] or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def append(self, record):
+        '''
+        Stage a complete record (tuple or structured scalar).
+        '''
+
+        self.buffer[self.staged] = record
+        self.commit()
+
+    def flush(self):
+        '''
+        Write all staged records to the dataset.
+        '''
+
+        if self.staged > 0:
+            with self.profiler.stage('write', self.staged):
+                end_index = self.write_index + self.staged
+
+                if end_index > self.dataset.shape[0]:
+                    self.dataset.resize((max(end_index, 2 * self.dataset.shape[0]), ))
+
+                self.dataset[self.write_index:end_index] = self.buffer[:self.staged]
+                self.write_index = end_index
+                self.staged = 0
+
+                self.dataset.attrs['number_records'] = self.write_index
+                self.dataset.file.flush()
+
+        self.last_flush = time.time()
+
+    def close(self):
+        '''
+        Flush the remaining records and trim the dataset to the records written.
+
+        returns the total number of records written.
+        '''
+
+        self.flush()
+
+        if self.dataset.shape[0] != self.write_index:
+            self.dataset.resize((self.write_index, ))
+        self.dataset.attrs['number_records'] = self.write_index
+
+        return self.write_index
@@ -0,0 +1,580 @@
+# pylint: disable=C0103, W1202, line-too-long
+
+import os
+import time
+import sys
+import errno
+import socket
+import threading
+import Queue
+from datetime import datetime
+import multiprocessing
+import getopt
+import logging
+
+import numpy as np
+import accumulator as acc
+import packet_reader
+import h5output
+import profiling
+
+import h5py
+
+from frame import FrameAssembler
+
+#Handlers are set up under __main__; when imported, the caller configures logging.
+logger = logging.getLogger(__name__) # pylint: disable=locally-disabled, invalid-name
+
+TIMESTREAM_FRAME_ID = 0xA0 #upper nibble of the first byte of a timestream frame
+HEADER_LENGTH = 9 #antenna/frame id, stream id, word length, timestamp
+DATAGRAM_LENGTH = HEADER_LENGTH + 2048
+
+SLOT_BYTES = 2560 #room per received datagram; longer datagrams are truncated
+BATCH_PACKETS = 1024 #datagrams per batch
+RING_BATCHES = 16 #batches in the receive ring
+RCVBUF_BYTES = 64 * 1024 * 1024 #requested socket receive buffer
+POLL_INTERVAL = 0.5 #seconds to wait for a datagram before checking for shutdown
+LOG_INTERVAL = 10. #seconds between progress reports
+
+
+class DatagramRing(object):
+
+    '''
+    Preallocated batches of datagram slots, filled from a UDP socket on a
+    receiver thread and decoded on the consuming thread.
+
+    Python has no recvmmsg, so a batch is one blocking recv_into followed by
+    non-blocking recv_into calls until the socket is empty or the batch is
+    full. Datagrams are received straight into their slots; only batch
+    numbers travel through the queues. The receiver waits for a free batch
+    when the consumer falls behind, leaving the socket buffer to absorb the
+    backlog.
+    '''
+
+    def __init__(self, sock, n_batches=RING_BATCHES, batch_packets=BATCH_PACKETS):
+
+        self.sock = sock
+        self.batch_packets = batch_packets
+        self.datagrams = np.zeros((n_batches, batch_packets, SLOT_BYTES), dtype=np.uint8)
+        self.lengths = np.zeros((n_batches, batch_packets), dtype=np.int64)
+        self.comp_timestamps = [""] * n_batches #reception time of each batch
+        self.slots = [[memoryview(slot) for slot in batch] for batch in self.datagrams]
+
+        self.free = Queue.Queue() #batch numbers available for receiving
+        self.filled = Queue.Queue() #(batch number, datagrams received)
+        for batch in xrange(n_batches):
+            self.free.put(batch)
+
+        self.finished = threading.Event()
+        self.thread = None
+        self.ring_waits = 0 #times the receiver found no free batch
+
+    def _receive(self, batch):
+        '''
+        Fill one batch from the socket.
+
+        returns the number of datagrams received; 0 if none arrived within POLL_INTERVAL.
+        '''
+
+        slots = self.slots[batch]
+        lengths = self.lengths[batch]
+        count = 0
+
+        try:
+            self.sock.settimeout(POLL_INTERVAL)
+            lengths[0] = self.sock.recv_into(slots[0], SLOT_BYTES)
+            count = 1
+
+            self.sock.settimeout(0.)
+            while count < self.batch_packets:
+                lengths[count] = self.sock.recv_into(slots[count], SLOT_BYTES)
+                count += 1
+        except socket.timeout:
+            pass
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        return count
+
+    def _run(self):
+        '''
+        Receiver thread: fill free batches and pass them to the consumer.
+        '''
+
+        try:
+            while not self.finished.is_set():
+                try:
+                    batch = self.free.get(block=False)
+                except Queue.Empty:
+                    self.ring_waits += 1
+                    try:
+                        batch = self.free.get(timeout=POLL_INTERVAL)
+                    except Queue.Empty:
+                        continue
+
+                count = self._receive(batch)
+                if count == 0:
+                    self.free.put(batch)
+                    continue
+
+                self.comp_timestamps[batch] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+                self.filled.put((batch, count))
+        except Exception as err: # pylint: disable=broad-except
+            self.filled.put(err)
+
+    def start(self):
+        '''
+        Start the receiver thread.
+        '''
+
+        self.thread = threading.Thread(target=self._run, name="udp-receiver")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop the receiver thread.
+        '''
+
+        self.finished.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def get(self, timeout=POLL_INTERVAL):
+        '''
+        Return the next filled (batch number, datagrams received), or None if
+        nothing arrived within timeout seconds. The batch must be released
+        once decoded.
+        '''
+
+        try:
+            item = self.filled.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+        if isinstance(item, Exception):
+            raise item
+
+        return item
+
+    def release(self, batch):
+        '''
+        Mark a batch as free for receiving.
+        '''
+        self.free.put(batch)
+
+
+def decode_datagrams(datagrams, lengths, comp_timestamp, packets):
+    '''
+    Decode IceBoard timestream datagrams into PACKET_DTYPE records, as
+    suit_binary_receiver does one datagram at a time.
+
+    params:
+        datagrams: (n, SLOT_BYTES) uint8 array of received datagrams.
+        lengths: received length of each datagram.
+        comp_timestamp: reception time given to every packet.
+        packets: PACKET_DTYPE array of at least n records, filled in place.
+
+    returns the number of packets decoded; datagrams that are not complete
+    timestream frames are skipped.
+    '''
+
+    valid = ((datagrams[:, 0] & 0xF0) == TIMESTREAM_FRAME_ID) & (lengths >= DATAGRAM_LENGTH)
+
+    if not valid.all():
+        datagrams = datagrams[valid]
+
+    count = datagrams.shape[0]
+    decoded = packets[:count]
+
+    decoded['antenna'] = datagrams[:, 0] & 0x0F
+    decoded['timestamp'] = np.ascontiguousarray(datagrams[:, 5:9]).view('>u4')[:, 0]
+    decoded['timestream'] = datagrams[:, HEADER_LENGTH:DATAGRAM_LENGTH].view(np.int8)
+    decoded['comp_timestamp'] = comp_timestamp
+
+    return count
+
+
+def encode_datagrams(packets, datagrams):
+    '''
+    Encode PACKET_DTYPE records as IceBoard timestream datagrams; the inverse
+    of decode_datagrams. The stream id and word length are left at zero.
+    '''
+
+    count = packets.shape[0]
+
+    datagrams[:count, 0] = TIMESTREAM_FRAME_ID | (packets['antenna'].astype(np.uint8) & 0x0F)
+    datagrams[:count, 1:5] = 0
+    datagrams[:count, 5:9] = packets['timestamp'].astype('>u4').view(np.uint8).reshape(-1, 4)
+    datagrams[:count, HEADER_LENGTH:DATAGRAM_LENGTH] = packets['timestream'].view(np.uint8)
+
+
+def replay_capture(filename, address, rate=None, number_packets=None):
+    '''
+    Send the packets of a raw binary capture to a UDP address, e.g. to test
+    the live path over the loopback interface.
+
+    params:
+        filename: raw binary capture written by suit_binary_receiver.
+        address: (host, port) to send to.
+        rate: packets per second; as fast as possible if None.
+        number_packets: number of packets to send; all if None.
+    '''
+
+    packets = packet_reader.open_binary_packets(filename, number_packets)
+    datagrams = np.zeros((BATCH_PACKETS, DATAGRAM_LENGTH), dtype=np.uint8)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start_time = time.time()
+    sent = 0
+
+    for block in packet_reader.iterate_blocks(packets, BATCH_PACKETS):
+        encode_datagrams(block, datagrams)
+
+        for datagram in datagrams[:block.shape[0]]:
+            sock.sendto(datagram, address)
+            sent += 1
+
+            if rate:
+                delay = start_time + sent / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+    sock.close()
+    del packets
+
+
+def open_socket(port, rcvbuf=RCVBUF_BYTES):
+    '''
+    Open and bind a UDP socket with a large receive buffer.
+    '''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind(('', port))
+
+    return sock
+
+
+def correlate_live(ring, data_out_handle, number_channels, n_acc=1000,
+                   to_receive=None, duration=None, idle_timeout=None, profiler=None):
+    '''
+    Assemble frames from received packets and accumulate them as they arrive.
+
+    params:
+        ring: DatagramRing on the input socket; started and stopped here.
+        data_out_handle: h5output.BatchWriter of the output 'correlations' dataset.
+        number_channels: number of channels per frame.
+        n_acc: number of frames per accumulation.
+        to_receive: stop after this many packets.
+        duration: stop after this many seconds.
+        idle_timeout: stop when no packets arrive for this many seconds.
+        profiler: profiling.Profiler timing the stages, if given; 'read' is
+                  the time spent waiting for received batches.
+
+    Receiving also stops on KeyboardInterrupt.
+
+    returns (packets received, accumulations written, assembler).
+    '''
+
+    if profiler is None:
+        profiler = profiling.Profiler(enabled=False)
+
+    assembler = FrameAssembler(number_channels)
+    accumulator = acc.Accumulator(number_channels, n_acc, profiler=profiler)
+    packets = np.zeros((ring.batch_packets, ), dtype=packet_reader.PACKET_DTYPE)
+
+    received = 0
+    skipped = 0
+    start_time = time.time()
+    last_packet = start_time
+    last_log = start_time
+
+    ring.start()
+
+    try:
+        while to_receive is None or received < to_receive:
+            current_time = time.time()
+
+            if duration and current_time - start_time > duration:
+                break
+            if idle_timeout and current_time - last_packet > idle_timeout:
+                logger.info("No packets for {0:.1f} s; stopping.".format(current_time - last_packet))
+                break
+
+            if current_time - last_log > LOG_INTERVAL:
+                last_log = current_time
+                logger.info("-+-+-+-+-+-+-+-+-+-+-+-+-+-")
+                logger.info("Run time: {0:.3f} minutes.".format((current_time - start_time) / 60.))
+                logger.info("Packets received: {0:d} ({1:.0f} packets/s)"\
+                    .format(received, received / (current_time - start_time)))
+                logger.info("Completed accumulations to date: {0:d}".format(accumulator.write_index))
+                logger.debug("Completed frames to date: {0:d}".format(assembler.completed_frame_total))
+                logger.debug("Skipped datagrams: {0:d}".format(skipped))
+                logger.debug("Receive ring waits: {0:d}".format(ring.ring_waits))
+                logger.info("Number of mailboxes: {0:d}".format(len(assembler)))
+
+            with profiler.stage('read'):
+                item = ring.get()
+            if item is None:
+                #Keep the output current while the stream is paused.
+                data_out_handle.flush()
+                continue
+
+            batch, count = item
+            with profiler.stage('decode', count):
+                decoded = decode_datagrams(ring.datagrams[batch][:count], ring.lengths[batch][:count],
+                                           ring.comp_timestamps[batch], packets)
+            ring.release(batch)
+
+            skipped += count - decoded
+            if to_receive is not None:
+                decoded = min(decoded, to_receive - received)
+            received += decoded
+            last_packet = time.time()
+
+            with profiler.stage('assembly', decoded):
+                for packet in packets[:decoded]:
+                    frame = assembler.add_packet(packet)
+
+                    if frame is not None:
+                        accumulator.add_frame(data_out_handle, frame)
+                        assembler.release(frame)
+
+    except KeyboardInterrupt:
+        logger.info("Interrupted; closing output.")
+    finally:
+        ring.stop()
+
+    assembler.flush()
+
+    logger.info("++++++++++++++++++++++++++++++++++++++++")
+    logger.info("Packets received: {0:d}".format(received))
+    logger.info("Skipped datagrams: {0:d}".format(skipped))
+    logger.info("Final completed frames: {0:d}".format(assembler.completed_frame_total))
+    logger.info("Number of incomplete frames: {0:d}".format(assembler.number_incomplete_frames))
+    logger.info("Number of forgotten packets: {0:d}".format(assembler.number_forgotten_packets))
+    logger.info("Receive ring waits: {0:d}".format(ring.ring_waits))
+
+    return received, accumulator.write_index, assembler
+
+def usage():
+    '''
+    Usage function.
+    '''
+
+    print "Usage: {0:s}\n\
+         \t -h/--help: This message.\n\
+         \t -u/--port: UDP port to receive on.\n\
+         \t -c/--channels: Number of channels per frame (read from the capture when replaying).\n\
+         \t -n/--nacc: Number of frames to accumulate.\n\
+         \t -p/--packets: Number of packets to receive.\n\
+         \t -d/--duration: Number of seconds to receive for.\n\
+         \t -t/--idle-timeout: Stop after this many seconds without packets (0: never).\n\
+         \t -R/--replay: Replay a raw binary capture to the port over loopback.\n\
+         \t -r/--rate: Replay rate in packets per second (0: as fast as possible).\n\
+         \t -s/--rcvbuf: Socket receive buffer size in bytes.\n\
+         \t -f/--outfile: Output file name.\n\
+         \t -o/--output-profile: Output compression (none/lzf/gzip-1/shuffle+lzf/gzip-9).\n\
+         \t -k/--chunk: Number of accumulations per output chunk.\n\
+         \t -P/--profile: Write per-stage timings as JSON to this file ('-': standard output).\n\
+         \t --profile-interval: Seconds between logged timing summaries.\n\
+         \t -l/--log: Log level".format(sys.argv[0])
+
+
+if __name__ == "__main__":
+
+
+    PORT = 41000
+    N_CHANNELS = None
+    N_ACC = 100
+    N_TO_RECEIVE = None
+    DURATION = None
+    IDLE_TIMEOUT = None
+    REPLAY_FILENAME = None
+    REPLAY_RATE = 0
+    RCVBUF = RCVBUF_BYTES
+    OUTPUT_FILENAME = None
+    OUTPUT_PROFILE = h5output.DEFAULT_PROFILE
+    CHUNK_RECORDS = 1
+    PROFILE_FILENAME = None
+    PROFILE_INTERVAL = None
+    LOG_LEVEL = "INFO"
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:],
+                                   "hu:c:n:p:d:t:R:r:s:f:o:k:P:l:",
+                                   ["help",
+                                    "port=",
+                                    "channels=",
+                                    "nacc=",
+                                    "packets=",
+                                    "duration=",
+                                    "idle-timeout=",
+                                    "replay=",
+                                    "rate=",
+                                    "rcvbuf=",
+                                    "outfile=",
+                                    "output-profile=",
+                                    "chunk=",
+                                    "profile=",
+                                    "profile-interval=",
+                                    "log=",
+                                   ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in OPTS:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-u", "--port"):
+            PORT = int(arg)
+        elif opt in ("-c", "--channels"):
+            N_CHANNELS = int(arg)
+        elif opt in ("-n", "--nacc"):
+            N_ACC = int(arg)
+        elif opt in ("-p", "--packets"):
+            N_TO_RECEIVE = int(arg)
+        elif opt in ("-d", "--duration"):
+            DURATION = float(arg)
+        elif opt in ("-t", "--idle-timeout"):
+            IDLE_TIMEOUT = float(arg)
+        elif opt in ("-R", "--replay"):
+            REPLAY_FILENAME = arg
+        elif opt in ("-r", "--rate"):
+            REPLAY_RATE = float(arg)
+        elif opt in ("-s", "--rcvbuf"):
+            RCVBUF = int(arg)
+        elif opt in ("-f", "--outfile"):
+            OUTPUT_FILENAME = arg
+        elif opt in ("-o", "--output-profile"):
+            OUTPUT_PROFILE = arg
+        elif opt in ("-k", "--chunk"):
+            CHUNK_RECORDS = int(arg)
+        elif opt in ("-P", "--profile"):
+            PROFILE_FILENAME = arg
+        elif opt == "--profile-interval":
+            PROFILE_INTERVAL = float(arg)
+        elif opt in ("-l", "--log"):
+            LOG_LEVEL = arg
+
+    if OUTPUT_PROFILE not in h5output.OUTPUT_PROFILES:
+        usage()
+        sys.exit(2)
+
+
+    # create logger
+    logger = logging.getLogger(__name__) # pylint: disable=locally-disabled, invalid-name
+
+    numeric_level = getattr(logging, LOG_LEVEL.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % LOG_LEVEL)
+
+    logger.setLevel(numeric_level)
+    ch = logging.StreamHandler()
+    ch.setLevel(numeric_level)
+    formatter = logging.Formatter("%(funcName)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+
+    START_TIME = time.time()
+    START_DATE = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    #When replaying, the capture provides the channel count and packet total.
+    if REPLAY_FILENAME is not None:
+        try:
+            HEADER = packet_reader.read_binary_header(REPLAY_FILENAME)
+        except IOError:
+            logger.critical("Error opening replay file; exiting.")
+            sys.exit()
+
+        N_CHANNELS = np.int(HEADER['number_channels'])
+        REPLAY_PACKETS = packet_reader.open_binary_packets(REPLAY_FILENAME, HEADER['number_packets']).shape[0]
+
+        if N_TO_RECEIVE is None or N_TO_RECEIVE > REPLAY_PACKETS:
+            N_TO_RECEIVE = REPLAY_PACKETS
+        if IDLE_TIMEOUT is None:
+            IDLE_TIMEOUT = 5.
+
+    if N_CHANNELS is None:
+        logger.critical("Number of channels not given; exiting.")
+        usage()
+        sys.exit(2)
+
+    if OUTPUT_FILENAME is None:
+        OUTPUT_FILENAME = "correlated/LC_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".h5"
+
+    if os.path.dirname(OUTPUT_FILENAME) and not os.path.exists(os.path.dirname(OUTPUT_FILENAME)):
+        os.makedirs(os.path.dirname(OUTPUT_FILENAME))
+
+    if os.path.isfile(OUTPUT_FILENAME):
+        logger.info("Target file '{0:s}' exists; overwriting.".format(OUTPUT_FILENAME))
+        os.remove(OUTPUT_FILENAME)
+
+    SOCKET = open_socket(PORT, RCVBUF)
+    logger.info("Listening on port {0:d}; receive buffer {1:d} bytes."\
+        .format(SOCKET.getsockname()[1], SOCKET.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+    logger.info("Number channels: {0:d}".format(N_CHANNELS))
+    logger.info("Number of frames per accumulation: {0:d}".format(N_ACC))
+
+    #Open up output file and assign attributes.
+    OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'w')
+    OUTPUT_FILE.attrs['process_date'] = START_DATE
+    OUTPUT_FILE.attrs['number_accumulations'] = N_ACC
+    OUTPUT_FILE.attrs['Date'] = START_DATE
+    OUTPUT_FILE.attrs['Number_channels'] = N_CHANNELS
+    OUTPUT_FILE.attrs['Source'] = REPLAY_FILENAME if REPLAY_FILENAME is not None else "udp:{0:d}".format(PORT)
+
+    COMP_TYPE = acc.correlation_dtype(N_CHANNELS, N_ACC)
+
+    EXPECTED_ACCUMULATIONS = h5output.expected_records(N_TO_RECEIVE or 0, N_CHANNELS, N_ACC)
+    OUTPUT_HANDLER = h5output.create_dataset(OUTPUT_FILE, "correlations",
+                                             (EXPECTED_ACCUMULATIONS,),
+                                             dtype=COMP_TYPE,
+                                             maxshape=(None,),
+                                             profile=OUTPUT_PROFILE,
+                                             chunk_records=CHUNK_RECORDS)
+    PROFILER = profiling.Profiler(enabled=PROFILE_FILENAME is not None or PROFILE_INTERVAL is not None,
+                                  log_interval=PROFILE_INTERVAL, logger=logger)
+    OUTPUT_WRITER = h5output.BatchWriter(OUTPUT_HANDLER, profiler=PROFILER)
+
+    RING = DatagramRing(SOCKET)
+
+    REPLAY_PROCESS = None
+    if REPLAY_FILENAME is not None:
+        logger.info("Replaying '{0:s}' ({1:d} packets).".format(REPLAY_FILENAME, N_TO_RECEIVE))
+        REPLAY_PROCESS = multiprocessing.Process(target=replay_capture, name="replay",
+                                                 args=(REPLAY_FILENAME, ('127.0.0.1', SOCKET.getsockname()[1]),
+                                                       REPLAY_RATE, N_TO_RECEIVE))
+        REPLAY_PROCESS.daemon = True
+        REPLAY_PROCESS.start()
+
+    PACKETS_RECEIVED, CORRELATION_TOTAL, ASSEMBLER = correlate_live(RING, OUTPUT_WRITER, N_CHANNELS, N_ACC,
+                                                                    N_TO_RECEIVE, DURATION, IDLE_TIMEOUT, PROFILER)
+
+    if REPLAY_PROCESS is not None:
+        REPLAY_PROCESS.join()
+
+    SOCKET.close()
+
+    CORRELATION_TOTAL = OUTPUT_WRITER.close()
+
+    if PROFILE_FILENAME is not None:
+        PROFILER.write_json(PROFILE_FILENAME,
+                            packets=PACKETS_RECEIVED,
+                            input_bytes=PACKETS_RECEIVED * DATAGRAM_LENGTH,
+                            accumulations=CORRELATION_TOTAL)
+
+    OUTPUT_FILE.attrs['Number_packets'] = PACKETS_RECEIVED
+    OUTPUT_FILE.attrs['number_correlations'] = CORRELATION_TOTAL
+    OUTPUT_FILE.attrs['true_number_entries'] = CORRELATION_TOTAL
+    OUTPUT_FILE.close()
+
+    logger.info("----------------------------------------")
+    logger.info("Run time: {0:.3f}".format(time.time() - START_TIME))
+    logger.info("Number accumulations: {0:d}".format(CORRELATION_TOTAL))
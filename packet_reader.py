@@ -0,0 +1,180 @@
+import os
+import threading
+import Queue
+
+import numpy as np
+
+#Layout of the file header written by suit_binary_receiver ('II26c').
+HEADER_DTYPE = np.dtype([('number_packets', '<u4'),
+                         ('number_channels', '<u4'),
+                         ('date', 'S26')])
+
+#Layout of a single packet record written by suit_binary_receiver ('Ib2048b26c').
+#The receiver writes sizeof(singlePacket)-1 bytes, so the records are packed.
+PACKET_DTYPE = np.dtype([('timestamp', '<u4'),
+                         ('antenna', 'i1'),
+                         ('timestream', 'i1', 2048),
+                         ('comp_timestamp', 'S26')])
+
+DEFAULT_BLOCK_SIZE = 65536
+
+
+def read_binary_header(filename):
+    '''
+    Read the file header of a raw binary capture.
+
+    returns a record with number_packets, number_channels and date fields.
+    '''
+
+    with open(filename, 'rb') as file_handle:
+        header = np.fromfile(file_handle, dtype=HEADER_DTYPE, count=1)
+
+    if header.shape[0] != 1:
+        raise IOError("Unable to read header from '{0:s}'.".format(filename))
+
+    return header[0]
+
+
+def open_binary_packets(filename, number_packets=None):
+    '''
+    Memory-map the packet records of a raw binary capture.
+
+    params:
+        filename: raw binary capture written by suit_binary_receiver.
+        number_packets: number of packets to map; limited to the packets
+                        actually present on disk.
+
+    returns a read-only structured np.memmap with PACKET_DTYPE records.
+    '''
+
+    available = (os.path.getsize(filename) - HEADER_DTYPE.itemsize) // PACKET_DTYPE.itemsize
+
+    if number_packets is None or number_packets > available:
+        number_packets = available
+
+    if number_packets <= 0:
+        return np.zeros((0,), dtype=PACKET_DTYPE)
+
+    return np.memmap(filename, dtype=PACKET_DTYPE, mode='r',
+                     offset=HEADER_DTYPE.itemsize, shape=(number_packets,))
+
+
+def iterate_blocks(packets, block_size=DEFAULT_BLOCK_SIZE, start=0, stop=None):
+    '''
+    Yield consecutive blocks of a packet array as zero-copy views.
+    '''
+
+    if stop is None or stop > packets.shape[0]:
+        stop = packets.shape[0]
+
+    for block_start in xrange(start, stop, block_size):
+        yield packets[block_start:min(block_start + block_size, stop)]
+
+
+def _block_bounds(start, stop, block_size, chunk_size=1):
+    '''
+    Return (start, stop) pairs covering [start, stop) in blocks of block_size, 
+    with block boundaries aligned to multiples of chunk_size.
+    '''
+
+    block_size = max(chunk_size, block_size // chunk_size * chunk_size)
+    bounds = []
+
+    block_start = start
+    while block_start < stop:
+        block_stop = min((block_start // block_size + 1) * block_size, stop)
+        bounds += [(block_start, block_stop)]
+        block_start = block_stop
+
+    return bounds
+
+
+def iterate_hdf5_blocks(dataset, block_size=DEFAULT_BLOCK_SIZE, start=0, stop=None, prefetch=True):
+    '''
+    Yield consecutive blocks of an HDF5 packet table (e.g. ADC_Timestream_Data)
+    as NumPy structured arrays.
+
+    params:
+        dataset: h5py dataset holding one packet per row.
+        block_size: number of packets per read; rounded to the dataset chunk length.
+        start, stop: range of packets to read.
+        prefetch: read the next block on a background thread while the 
+                  current block is being processed (double buffering).
+    '''
+
+    if stop is None or stop > dataset.shape[0]:
+        stop = dataset.shape[0]
+
+    chunk_size = dataset.chunks[0] if dataset.chunks is not None else 1
+    bounds = _block_bounds(start, stop, block_size, chunk_size)
+
+    if not prefetch:
+        for block_start, block_stop in bounds:
+            yield dataset[block_start:block_stop]
+        return
+
+    #One block waits in the queue while the consumer works on the previous one.
+    blocks = Queue.Queue(maxsize=1)
+    finished = threading.Event()
+
+    def hand_over(item):
+        '''
+        Queue an item for the consumer; give up if the consumer has stopped.
+        '''
+        while not finished.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def reader():
+        '''
+        Read blocks in order and pass them to the consumer.
+        '''
+        try:
+            for block_start, block_stop in bounds:
+                if not hand_over(dataset[block_start:block_stop]):
+                    return
+            hand_over(None)
+        except Exception as err: # pylint: disable=broad-except
+            hand_over(err)
+
+    reader_thread = threading.Thread(target=reader, name="hdf5-prefetch")
+    reader_thread.daemon = True
+    reader_thread.start()
+
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        finished.set()
+        reader_thread.join()
+
+
+def iterate_packets(blocks):
+    '''
+    Yield packet records one at a time from an iterable of packet blocks.
+    '''
+
+    for block in blocks:
+        for packet in block:
+            yield packet
+
+
+def copy_packets(destination, block):
+    '''
+    Copy a block of packets into a PACKET_DTYPE array field by field.
+
+    HDF5 packet tables use a different field order and a variable-length
+    comp_timestamp, so the records cannot be copied byte for byte.
+    '''
+
+    for name in PACKET_DTYPE.names:
+        destination[name][:block.shape[0]] = block[name]
@@ -0,0 +1,254 @@
+import multiprocessing
+import Queue
+
+import numpy as np
+
+import accumulator
+import correlator
+import packet_reader
+from frame import FrameAssembler
+
+PACKETS_PER_SLOT = 4096 #packets handed from the reader to the assembler at a time
+PACKET_SLOTS = 4 #packet blocks in flight between the reader and the assembler
+
+
+def window_dtype(number_channels, n_acc, frequencies=None, baselines=None):
+    '''
+    Return the compound dtype of one accumulation window: the raw frames of
+    an accumulation, cut down to the channels of frequencies (a 
+    correlator.FrequencySelection), and, once correlated, its products of
+    the pairs of baselines (a correlator.BaselineSelection).
+    '''
+
+    if frequencies is None:
+        frequencies = correlator.FrequencySelection()
+
+    n_corr = len(baselines) if baselines is not None else number_channels * (number_channels + 1) // 2
+
+    return np.dtype([('index', 'int64'),
+                     ('timestamp', '|S30'),
+                     ('frame_numbers', 'uint32', (n_acc, )),
+                     ('frames', 'int8', (n_acc, number_channels, 2 * frequencies.channels.shape[0])),
+                     ('products', 'complex64', (n_corr, len(frequencies)))])
+
+
+class SharedRing(object):
+
+    '''
+    Fixed set of record slots in shared memory.
+
+    Only slot numbers travel through the queues; the records themselves are
+    read and written in place by every process. Slots must be created before
+    the worker processes are forked.
+    '''
+
+    def __init__(self, dtype, n_slots):
+
+        self.n_slots = n_slots #number of records
+        self.buffer = multiprocessing.RawArray('b', dtype.itemsize * n_slots)
+        self.records = np.frombuffer(self.buffer, dtype=dtype) #shared view of the slots
+        self.free = multiprocessing.Queue() #slot numbers available for writing
+
+        for slot in xrange(n_slots):
+            self.free.put(slot)
+
+    def acquire(self):
+        '''
+        Return a free slot number, waiting until one is released.
+        '''
+        return self.free.get()
+
+    def release(self, slot):
+        '''
+        Mark a slot as free for reuse.
+        '''
+        self.free.put(slot)
+
+
+def _read_stage(open_blocks, packet_ring, packet_queue):
+    '''
+    Reader/decoder stage: copy packets from the input file into shared packet slots.
+    '''
+
+    for block in open_blocks():
+        for start in xrange(0, block.shape[0], PACKETS_PER_SLOT):
+            packets = block[start:start + PACKETS_PER_SLOT]
+            slot = packet_ring.acquire()
+            packet_reader.copy_packets(packet_ring.records['packets'][slot], packets)
+            packet_queue.put((slot, packets.shape[0]))
+
+    packet_queue.put(None)
+
+
+def _assemble_stage(number_channels, n_acc, n_workers, packet_ring, packet_queue,
+                    window_ring, task_queue, result_queue, frequencies):
+    '''
+    Frame-assembly stage: build frames from packets and fill accumulation windows.
+    '''
+
+    assembler = FrameAssembler(number_channels)
+    windows = window_ring.records
+
+    sequence = 0
+    filled = 0
+    slot = None
+
+    while True:
+        item = packet_queue.get()
+        if item is None:
+            break
+
+        packet_slot, number_packets = item
+
+        for packet in packet_ring.records['packets'][packet_slot][:number_packets]:
+            frame = assembler.add_packet(packet)
+
+            if frame is None:
+                continue
+
+            if filled == 0:
+                slot = window_ring.acquire()
+                windows['index'][slot] = frame.index
+                windows['timestamp'][slot] = frame.packet_timestamps[0]
+
+            windows['frames'][slot][filled] = frequencies.select(frame.frame_data)
+            windows['frame_numbers'][slot][filled] = frame.frame_number
+            assembler.release(frame)
+            filled += 1
+
+            if filled == n_acc:
+                task_queue.put((sequence, slot))
+                sequence += 1
+                filled = 0
+
+        packet_ring.release(packet_slot)
+
+    #As in the serial path, a final partial accumulation is not written.
+    if filled != 0:
+        window_ring.release(slot)
+
+    assembler.flush()
+
+    for _ in xrange(n_workers):
+        task_queue.put(None)
+
+    result_queue.put(('done', sequence,
+                      assembler.completed_frame_total,
+                      assembler.number_incomplete_frames,
+                      assembler.number_forgotten_packets))
+
+
+def _correlate_stage(window_ring, task_queue, result_queue, backend_name, frequencies, baselines):
+    '''
+    Correlator stage: correlate whole accumulation windows in place.
+
+    As in accumulator.Accumulator, each window is correlated in blocks of
+    accumulator.EXACT_BLOCK frames whose products are summed in complex64
+    in frame order, so that the output is the same as that of the serial path.
+    '''
+
+    windows = window_ring.records
+    backend = correlator.get_backend(backend_name)
+    sums = np.zeros(windows.dtype['products'].shape[:1] + (frequencies.channels.shape[0], ), dtype=np.complex64)
+
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+
+        sequence, slot = item
+        frames = windows['frames'][slot]
+
+        sums[...] = 0
+        for start in xrange(0, frames.shape[0], accumulator.EXACT_BLOCK):
+            sums += backend.correlate_raw(frames[start:start + accumulator.EXACT_BLOCK], baselines)
+
+        windows['products'][slot] = frequencies.reduce(sums)
+        result_queue.put((sequence, slot))
+
+
+def run_pipeline(open_blocks, writer, number_channels, n_acc=1000, n_workers=4, backend_name='numpy', 
+                 frequencies=None, baselines=None):
+    '''
+    Correlate a capture with separate reader, assembly and correlator processes.
+
+    params:
+        open_blocks: callable returning an iterator over packet blocks; it is
+                     called in the reader process, so it should open the input itself.
+        writer: h5output.BatchWriter of the output 'correlations' dataset; 
+                written in order by this process.
+        number_channels: number of channels per frame.
+        n_acc: number of frames per accumulation.
+        n_workers: number of correlator processes.
+        backend_name: correlator backend of the correlator processes (see correlator.BACKENDS).
+        frequencies: correlator.FrequencySelection of the channels correlated; all by default.
+        baselines: correlator.BaselineSelection of the pairs correlated; all by default.
+
+    returns (number of accumulations written, completed frames, incomplete frames, forgotten packets).
+    '''
+
+    if frequencies is None:
+        frequencies = correlator.FrequencySelection()
+
+    packet_ring = SharedRing(np.dtype([('packets', packet_reader.PACKET_DTYPE, (PACKETS_PER_SLOT, ))]),
+                             PACKET_SLOTS)
+    window_ring = SharedRing(window_dtype(number_channels, n_acc, frequencies, baselines), n_workers + 2)
+    windows = window_ring.records
+
+    packet_queue = multiprocessing.Queue()
+    task_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+
+    processes = [multiprocessing.Process(target=_read_stage, name="reader",
+                                         args=(open_blocks, packet_ring, packet_queue)),
+                 multiprocessing.Process(target=_assemble_stage, name="assembler",
+                                         args=(number_channels, n_acc, n_workers,
+                                               packet_ring, packet_queue,
+                                               window_ring, task_queue, result_queue, frequencies))]
+    processes += [multiprocessing.Process(target=_correlate_stage, name="correlator-{0:d}".format(i),
+                                          args=(window_ring, task_queue, result_queue, backend_name, frequencies, baselines))
+                  for i in xrange(n_workers)]
+
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    pending = {} #correlated windows waiting for their turn to be written
+    write_index = 0
+    summary = None
+
+    try:
+        while summary is None or write_index < summary[1]:
+            try:
+                item = result_queue.get(timeout=1.0)
+            except Queue.Empty:
+                failed = [process.name for process in processes if process.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError("Pipeline stage(s) failed: " + ", ".join(failed))
+                continue
+
+            if item[0] == 'done':
+                summary = item
+                continue
+
+            sequence, slot = item
+            pending[sequence] = slot
+
+            while write_index in pending:
+                slot = pending.pop(write_index)
+                record = writer.next_record()
+                record['index'] = windows['index'][slot]
+                record['timestamp'] = windows['timestamp'][slot]
+                record['products'] = windows['products'][slot]
+                record['frame_numbers'] = windows['frame_numbers'][slot]
+                writer.commit()
+                window_ring.release(slot)
+                write_index += 1
+
+    finally:
+        for process in processes:
+            if summary is None and process.is_alive():
+                process.terminate()
+            process.join()
+
+    return (write_index, ) + tuple(summary[2:])
@@ -9,64 +9,39 @@ import getopt
 import logging
 
 import numpy as np
+import accumulator as acc
 import correlator
+import fengine
+import checkpoint
+import packet_reader
+import pipeline
+import profiling
+import reintegrate
+import h5output
 
 import h5py
 
 sys.path.append('~/work/code/h5view/')
 import h5view as h5v
+
+#Handlers are set up under __main__; when imported, the caller configures logging.
+logger = logging.getLogger(__name__) # pylint: disable=locally-disabled, invalid-name
   
-from frame import Frame
+from frame import FrameAssembler
 
  
-def accumulate_frame(handler, acc_dict, frame):
-    '''
-    Calculate the correlation products of a data frame and 
-    add it to an accumulator. If the accumulator is full, 
-    then write the data to disk.
-    '''
-
-    if acc_dict['filled'] == 0:
-        acc_dict['timestamp'] = frame.packet_timestamps[0]
-        acc_dict['index'] = frame.index
-#        print frame.index
-#        for i in xrange(4):
-#            print frame.packet_timestamps[i]
-
-
-    datum = correlator.convert_frame_multiple_channels(frame.frame_data)
-
-    acc_dict['accumulator'] += correlator.return_triangle_array(correlator.correlate(datum))
-    acc_dict['frame_indices'][acc_dict['filled']] = frame.index
-    acc_dict['frame_numbers'][acc_dict['filled']] = frame.frame_number
-    acc_dict['filled'] += 1
-
-    if acc_dict['filled'] == acc_dict['n_acc']:
-        write_to_disk(handler, acc_dict)
-        acc_dict['write_index'] += 1
-        acc_dict['accumulator'] *= 0
-        acc_dict['frame_indices'] *= 0
-        acc_dict['frame_numbers'] *= 0
-        acc_dict['filled'] = 0
-
-
-
-def write_to_disk(dataset_handler, acc_dict):
-    '''
-    Write a completed accumulation to disk.
-    '''
-
-    dataset_handler[acc_dict['write_index']] = (acc_dict['index'], 
-                                                acc_dict['timestamp'], 
-                                                acc_dict['accumulator'], 
-                                                #acc_dict['frame_indices'],
-                                                acc_dict['frame_numbers']
-                                               )
-
-
-def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=None, n_acc = 1000):
+def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=None, n_acc = 1000, 
+                   block_size=packet_reader.DEFAULT_BLOCK_SIZE, profiler=None, checkpointer=None, state=None, backend=None, 
+                   precision='complex64', output='complex64', frequencies=None, baselines=None):
     '''
     Parse hdf5 file from packets into frames and accumulate them. 
+    The stages of the run are timed with profiler, if given, and frames are
+    correlated with backend (a correlator.Backend). Products of the channels
+    of frequencies and the pairs of baselines are summed in precision and
+    written as output (see accumulator.Accumulator).
+
+    With a checkpoint.Checkpointer, the run state is saved between blocks
+    when a checkpoint is due; a state loaded from a checkpoint resumes the run.
     '''
 
     if to_parse is not None and to_parse > 0:
@@ -74,123 +49,73 @@ def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=No
     else:
         total_packets = data_in_handle.attrs['Number_packets']
     
-    n_corr = number_channels * (number_channels + 1) / 2
     
-    accumulator = {
-        'accumulator': np.zeros((n_corr, 1024), dtype=np.complex64), 
-        'frame_indices': np.zeros((n_acc, ), dtype=np.int),         
-        'frame_numbers': np.zeros((n_acc, ), dtype=np.uint32),                 
-        'filled': 0,
-        'write_index': 0,
-        'n_acc': n_acc,
-        'timestamp': "",
-        'index': -1
-    }
-
-    mailbox = []
-    frame_index = 0
-    need_new = True
-
-    old_frames = []
-    write_frames = []
-   
-    completed_frame_total = 0
-    number_incomplete_frames = 0
-    number_forgotten_packets = 0
-
-    current_time = time.time()
-    start_time = current_time
-#    last_time = current_time
+    if profiler is None:
+        profiler = profiling.Profiler(enabled=False)
+
+    accumulator = acc.Accumulator(number_channels, n_acc, precision, output, backend=backend, profiler=profiler, 
+                                  frequencies=frequencies, baselines=baselines)
+
+    start_time = time.time()
     
     cleaning_thresh = 1000
     DISPLAY_THRESH = 20000
 
-    for packet_index in xrange(total_packets):
-
-        current_time = time.time()
-        packet = data_in_handle['ADC_Timestream_Data'][packet_index]
-
-        #if current_time - last_time > 6:
-        if len(mailbox) > 100 or (packet_index % DISPLAY_THRESH == 0 and packet_index != 0):    
-            #last_time = current_time
-            logger.info("-+-+-+-+-+-+-+-+-+-+-+-+-+-")
-            run_time = (time.time() - start_time) / 60.
-            logger.info("Run time: {0:.3f} minutes.".format(run_time))
-            logger.info("Estimated time remaining: {0:.2f} minutes."\
-            .format(total_packets / (packet_index / run_time) - run_time))
-            logger.info("Packets analysed: {0:6g}/{1:6g}".format(packet_index, total_packets))
-            logger.debug("Completed frames to date: {0:6g}".format(completed_frame_total))
-            logger.info("Completed accumulations to date: {0:6g}".format(accumulator['write_index']+1))
-            logger.debug("Packet-to-frame ratio: {0:.4f}".format(float(packet_index)/completed_frame_total))
-            logger.debug("Number of incomplete frames: {0:d}".format(number_incomplete_frames))
-            logger.debug("Number of forgotten packets: {0:d}".format(number_forgotten_packets))
-            logger.info("Number of mailboxes: {0:d}".format(len(mailbox)))
-
-
-            if len(mailbox) > 0 and frame_index - mailbox[0].index > cleaning_thresh:
-                logger.info("Oldest mailbox has an index out of bounds: {0:d}:{1:d}."\
-                .format(packet_index, mailbox[0].index))
-
-                for mailbox_number, frame in enumerate(mailbox):
-                    if frame_index - frame.index > cleaning_thresh:
-                        old_frames += [mailbox_number]
-                        logger.debug("Incomplete frame:")
-                        logger.debug("\n\n" + str(frame) + "\n")
-                        
-                        number_forgotten_packets += frame.number_packets()
-                
-                logger.debug("Removed mailboxes: " + str(old_frames))
-                
-                if len(old_frames) > 0:
-                    number_incomplete_frames += len(old_frames)
-                    mailbox = [i for j, i in enumerate(mailbox) if j not in old_frames]
-                    old_frames = []
-                        
-
-                logger.info("Updated number of mailboxes: {0:d}".format(len(mailbox)))
-
-        for mailbox_number, frame in enumerate(mailbox):
-            if frame.frame_number == packet['timestamp']:
-                
-                if frame.add_packet(packet): #Returns true if the packet is full, false otherwise.
-                    write_frames += [mailbox_number]                        
-                    accumulate_frame(data_out_handle, accumulator, frame)
-                    completed_frame_total += 1 
-
-                    mailbox = [i for j, i in enumerate(mailbox) if j not in write_frames]
-                    write_frames = []
-
-                break
-            elif mailbox_number == len(mailbox) -1:
-                #No mailboxes have matching frames. 
-                need_new = True
-                
-        if need_new:
-            new_frame = Frame(number_channels, packet, frame_index)
-            frame_index += 1
-            mailbox += [new_frame]
-            need_new = False
-        elif len(mailbox) == 0:
-            need_new = True
-
-                
+    assembler = FrameAssembler(number_channels, cleaning_thresh)
+
+    packet_index = 0
+    if state is not None:
+        packet_index = checkpoint.restore(state, assembler, accumulator)
+        logger.info("Resuming at packet {0:d} with {1:d} accumulations written."\
+            .format(packet_index, accumulator.write_index))
+    first_packet = packet_index
+
+    packet_blocks = packet_reader.iterate_hdf5_blocks(data_in_handle['ADC_Timestream_Data'], 
+                                                      block_size, start=packet_index, stop=total_packets)
+
+    for block in profiler.timed(packet_blocks, 'read'):
+        with profiler.stage('assembly', block.shape[0]):
+            for packet in block:
+                if packet_index % DISPLAY_THRESH == 0 and packet_index != first_packet:    
+                    logger.info("-+-+-+-+-+-+-+-+-+-+-+-+-+-")
+                    run_time = (time.time() - start_time) / 60.
+                    logger.info("Run time: {0:.3f} minutes.".format(run_time))
+                    logger.info("Estimated time remaining: {0:.2f} minutes."\
+                    .format((total_packets - packet_index) / ((packet_index - first_packet) / run_time)))
+                    logger.info("Packets analysed: {0:6g}/{1:6g}".format(packet_index, total_packets))
+                    logger.debug("Completed frames to date: {0:6g}".format(assembler.completed_frame_total))
+                    logger.info("Completed accumulations to date: {0:6g}".format(accumulator.write_index+1))
+                    logger.debug("Packet-to-frame ratio: {0:.4f}".format(float(packet_index)/assembler.completed_frame_total))
+                    logger.debug("Number of incomplete frames: {0:d}".format(assembler.number_incomplete_frames))
+                    logger.debug("Number of forgotten packets: {0:d}".format(assembler.number_forgotten_packets))
+                    logger.info("Number of mailboxes: {0:d}".format(len(assembler)))
+
+                frame = assembler.add_packet(packet)
+
+                if frame is not None:
+                    accumulator.add_frame(data_out_handle, frame)
+                    assembler.release(frame)
+
+                packet_index += 1
+
+        if checkpointer is not None and checkpointer.due():
+            checkpointer.save(packet_index, assembler, accumulator, data_out_handle)
+            logger.info("Checkpoint saved at packet {0:d}.".format(packet_index))
+
+    accumulator.flush(data_out_handle)
+
     logger.info("++++++++++++++++++++++++++++++++++++++++")
     logger.info("At end of datafile; final results:")
-    logger.info("Mailbox size: {0:d}\n".format(len(mailbox)))
-    for mailbox_number, frame in enumerate(mailbox):
-        if frame.is_full():
-            #This should never happen.
-            print "Complete frame:"
-            print frame
-            print "\n"
-            completed_frame_total += 1
-        else:
-            logger.info("Incomplete frame:")
-            logger.info("\n" + str(frame) + "\n")
-            number_incomplete_frames += 1
-            number_forgotten_packets += frame.number_packets()
+    logger.info("Mailbox size: {0:d}\n".format(len(assembler)))
+    for frame in assembler.flush():
+        logger.info("Incomplete frame:")
+        logger.info("\n" + str(frame) + "\n")
 
     logger.info("++++++++++++++++++++++++++++++++++++++++")
+    completed_frame_total = assembler.completed_frame_total
+    number_incomplete_frames = assembler.number_incomplete_frames
+    number_forgotten_packets = assembler.number_forgotten_packets
+
     logger.info("Final completed frames: {0:d}".format(completed_frame_total))
     if completed_frame_total != 0:
         logger.info("Packet-to-frame ratio: {0:.4f}".format(float(total_packets)/completed_frame_total))
@@ -203,8 +128,11 @@ def parse_raw_data(data_in_handle, data_out_handle, number_channels, to_parse=No
     logger.info("Ideal frame total: {0:d}".format(completed_frame_total\
                                          + int(np.ceil(number_forgotten_packets/float(number_channels)))))
 
+    if accumulator.rescaled:
+        logger.warning("Accumulations with baselines quantized with a scale above 1: {0:d}".format(accumulator.rescaled))
+
     logger.info("\n")
-    return accumulator['write_index']
+    return accumulator.write_index
 
 def usage():
     '''
@@ -216,6 +144,27 @@ def usage():
          \t -f/--file: Input file name.\n\
          \t -p/--packets: Number of packets to analyse.\n\
          \t -n/--nacc: Number of frames to accumulate.\n\
+         \t -j/--workers: Number of correlator processes (0: single process).\n\
+         \t -c/--correlator: Correlator backend (auto/reference/numpy/threaded/integer).\n\
+         \t -X/--fx: Raw ADC input: channelize with a PFB of this many taps (1: plain FFT; not with -j or -a int64).\n\
+         \t -W/--window: PFB window (rectangular/hamming/hanning/blackman; default rectangular for 1 tap, else hamming).\n\
+         \t -T/--fft-threads: Number of threads channelizing each block of frames.\n\
+         \t --frame-step: Frame number step between consecutive raw ADC frames (default 1).\n\
+         \t -a/--precision: Precision of the accumulated sums (complex64/complex128/int64; complex64 with -j).\n\
+         \t -q/--quantize: Store products as scaled integers (int32/int16; not with -j).\n\
+         \t -F/--frequencies: Frequency channel ranges to correlate, e.g. 100:200,300:400 (default: all).\n\
+         \t -M/--frequency-mask: File of 1024 values, nonzero for the frequency channels to correlate.\n\
+         \t -D/--decimate: Correlate every Nth of the selected frequency channels.\n\
+         \t -A/--average: Average the products of N consecutive selected frequency channels.\n\
+         \t -B/--baselines: Channel pairs to correlate: all, autos, cross or a list such as 0-0,0-1 (default: all).\n\
+         \t -L/--levels: Also store integrations of these multiples of nacc, e.g. 10,100 (see reintegrate.py).\n\
+         \t -o/--output-profile: Output compression (none/lzf/gzip-1/shuffle+lzf/gzip-9).\n\
+         \t -k/--chunk: Number of accumulations per output chunk.\n\
+         \t -b/--block: Number of packets read from the input file at a time.\n\
+         \t -r/--resume: Continue an interrupted run from its checkpoint.\n\
+         \t -C/--checkpoint: Seconds between checkpoints (0: no checkpoints).\n\
+         \t -P/--profile: Write per-stage timings as JSON to this file ('-': standard output).\n\
+         \t --profile-interval: Seconds between logged timing summaries.\n\
          \t -l/--log: Log level".format(sys.argv[0])
 
 
@@ -225,6 +174,27 @@ if __name__ == "__main__":
     INPUT_FILENAME = "EMPTY"
     N_TO_ANALYSE = None
     N_ACC = 100
+    N_WORKERS = 0
+    CORRELATOR = 'numpy'
+    FX_TAPS = 0
+    WINDOW = None
+    FFT_THREADS = 1
+    FRAME_STEP = fengine.FRAME_STEP
+    PRECISION = 'complex64'
+    OUTPUT_TYPE = 'complex64'
+    LEVELS = []
+    FREQUENCY_RANGES = ""
+    MASK_FILENAME = None
+    DECIMATION = 1
+    AVERAGE = 1
+    BASELINES = 'all'
+    OUTPUT_PROFILE = h5output.DEFAULT_PROFILE
+    CHUNK_RECORDS = 1
+    PROFILE_FILENAME = None
+    PROFILE_INTERVAL = None
+    RESUME = False
+    CHECKPOINT_INTERVAL = checkpoint.CHECKPOINT_INTERVAL
+    BLOCK_SIZE = packet_reader.DEFAULT_BLOCK_SIZE
     LOG_LEVEL = "INFO"
 
     if len(sys.argv) == 1:
@@ -234,11 +204,32 @@ if __name__ == "__main__":
     try:
     #print sys.argv
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "hi:p:n:l:",
+                                   "hi:p:n:j:c:X:W:T:a:q:F:M:D:A:B:L:o:k:b:rC:P:l:",
                                    ["help",
                                     "infile=", 
                                     "packets=", 
                                     "nacc=", 
+                                    "workers=", 
+                                    "correlator=", 
+                                    "fx=", 
+                                    "window=", 
+                                    "fft-threads=", 
+                                    "frame-step=", 
+                                    "precision=", 
+                                    "quantize=", 
+                                    "frequencies=", 
+                                    "frequency-mask=", 
+                                    "decimate=", 
+                                    "average=", 
+                                    "baselines=", 
+                                    "levels=", 
+                                    "output-profile=", 
+                                    "chunk=", 
+                                    "block=", 
+                                    "resume", 
+                                    "checkpoint=", 
+                                    "profile=", 
+                                    "profile-interval=", 
                                     "log=", 
                                    ])
     #print opts
@@ -259,6 +250,55 @@ if __name__ == "__main__":
             LOG_LEVEL = arg
         elif opt in ("-n", "--nacc"):
             N_ACC = int(arg)
+        elif opt in ("-j", "--workers"):
+            N_WORKERS = int(arg)
+        elif opt in ("-c", "--correlator"):
+            CORRELATOR = arg
+        elif opt in ("-X", "--fx"):
+            FX_TAPS = int(arg)
+        elif opt in ("-W", "--window"):
+            WINDOW = arg
+        elif opt in ("-T", "--fft-threads"):
+            FFT_THREADS = int(arg)
+        elif opt == "--frame-step":
+            FRAME_STEP = int(arg)
+        elif opt in ("-a", "--precision"):
+            PRECISION = arg
+        elif opt in ("-q", "--quantize"):
+            OUTPUT_TYPE = arg
+        elif opt in ("-F", "--frequencies"):
+            FREQUENCY_RANGES = arg
+        elif opt in ("-M", "--frequency-mask"):
+            MASK_FILENAME = arg
+        elif opt in ("-D", "--decimate"):
+            DECIMATION = int(arg)
+        elif opt in ("-A", "--average"):
+            AVERAGE = int(arg)
+        elif opt in ("-B", "--baselines"):
+            BASELINES = arg
+        elif opt in ("-L", "--levels"):
+            LEVELS = reintegrate.parse_factors(arg)
+        elif opt in ("-o", "--output-profile"):
+            OUTPUT_PROFILE = arg
+        elif opt in ("-k", "--chunk"):
+            CHUNK_RECORDS = int(arg)
+        elif opt in ("-P", "--profile"):
+            PROFILE_FILENAME = arg
+        elif opt == "--profile-interval":
+            PROFILE_INTERVAL = float(arg)
+        elif opt in ("-r", "--resume"):
+            RESUME = True
+        elif opt in ("-C", "--checkpoint"):
+            CHECKPOINT_INTERVAL = float(arg)
+        elif opt in ("-b", "--block"):
+            BLOCK_SIZE = int(arg)
+
+    if OUTPUT_PROFILE not in h5output.OUTPUT_PROFILES \
+        or PRECISION not in acc.PRECISIONS or OUTPUT_TYPE not in acc.OUTPUT_TYPES \
+        or (N_WORKERS > 0 and (PRECISION, OUTPUT_TYPE) != ('complex64', 'complex64')) \
+        or (FX_TAPS > 0 and (N_WORKERS > 0 or PRECISION == 'int64')):
+        usage()
+        sys.exit(2)
 
 
     # create logger
@@ -310,17 +350,47 @@ if __name__ == "__main__":
     #Retrieve some constants
     N_CHANNELS = INPUT_FILE.attrs['Number_channels']     
     TOT_PACKETS = INPUT_FILE.attrs['Number_packets']
-    MAX_FRAMES = int(TOT_PACKETS / 4) + 10 if int(TOT_PACKETS / 4) > 1000 else 1010
     #Compute number unique correlations
     NUMBER_CORRELATIONS = N_CHANNELS * (N_CHANNELS + 1) / 2
 
     logger.info("Total packets in file: {0:d}".format(TOT_PACKETS))
-    logger.info("Maximum number frames: {0:d}".format(MAX_FRAMES))
+
+    #Initial output size; the dataset grows if this turns out to be too small.
+    ANALYSED_PACKETS = N_TO_ANALYSE if N_TO_ANALYSE is not None and N_TO_ANALYSE > 0 else TOT_PACKETS
+    EXPECTED_ACCUMULATIONS = h5output.expected_records(ANALYSED_PACKETS, N_CHANNELS, N_ACC)
+    logger.info("Expected number accumulations: {0:d}".format(EXPECTED_ACCUMULATIONS))
 
     if N_TO_ANALYSE is not None:
         logger.info("Number of frames to analyse: {0:d}".format(N_TO_ANALYSE))
 
     logger.info("Number of frames per accumulation: {0:d}".format(N_ACC))
+
+    try:
+        if FX_TAPS > 0:
+            #Raw ADC frames are channelized into complex spectra, which the int8 correlators cannot take.
+            BACKEND = fengine.FXBackend(fengine.FEngine(N_CHANNELS, FX_TAPS, WINDOW, FFT_THREADS, FRAME_STEP), 
+                                        correlator.get_backend(CORRELATOR, N_CHANNELS, N_ACC, 
+                                                               [name for name in correlator.BACKENDS 
+                                                                if not correlator.BACKENDS[name].integer]))
+        else:
+            BACKEND = correlator.get_backend(CORRELATOR, N_CHANNELS, N_ACC)
+        FREQUENCIES = correlator.FrequencySelection(correlator.load_frequency_mask(MASK_FILENAME) if MASK_FILENAME else None, 
+                                                    correlator.parse_frequency_ranges(FREQUENCY_RANGES), 
+                                                    DECIMATION, AVERAGE)
+        BASELINE_SELECTION = correlator.BaselineSelection(N_CHANNELS, correlator.parse_baselines(BASELINES))
+    except (ValueError, IOError) as err:
+        logger.critical("{0:s} Exiting.".format(str(err)))
+        sys.exit(2)
+
+    if BACKEND.timings is not None:
+        logger.info("Correlator trial times: " + ", ".join("{0:s} {1:.4f} s".format(name, BACKEND.timings[name])
+                                                         for name in sorted(BACKEND.timings)))
+    logger.info("Correlator: {0:s}".format(BACKEND.name))
+    if BACKEND.time_domain:
+        logger.info("F-engine: {0:s}, {1:d} thread(s).".format(BACKEND.fengine, FFT_THREADS))
+    logger.info("Frequency channels: {0:d} of {1:d} correlated, {2:d} stored."\
+        .format(FREQUENCIES.channels.shape[0], correlator.NUMBER_FREQUENCIES, len(FREQUENCIES)))
+    logger.info("Baselines: {0:d} of {1:d} channel pairs.".format(len(BASELINE_SELECTION), NUMBER_CORRELATIONS))
     logger.info("Logging level: {0:s}".format(LOG_LEVEL))
 
     #Set up and open output file
@@ -335,44 +405,134 @@ if __name__ == "__main__":
     #    print "Out data file already open... Closing."
     #    OUTPUT_FILE.close()       
 
-    if os.path.isfile(OUTPUT_FILENAME):
-        logger.info("Target file '{0:s}' exists; overwriting.".format(OUTPUT_FILENAME))
-        os.remove(OUTPUT_FILENAME)
-        logger.info("Deleted '{0:s}'".format(OUTPUT_FILENAME))
+    #A checkpoint is only valid for the same input and accumulation settings.
+    CHECKPOINTER = checkpoint.Checkpointer(checkpoint.checkpoint_filename(OUTPUT_FILENAME), 
+                                           CHECKPOINT_INTERVAL if N_WORKERS == 0 else None, 
+                                           input_file=os.path.abspath(INPUT_FILENAME), 
+                                           number_channels=N_CHANNELS, 
+                                           n_acc=N_ACC, 
+                                           precision=PRECISION, 
+                                           products_type=OUTPUT_TYPE, 
+                                           frequencies=FREQUENCIES.digest(), 
+                                           baselines=BASELINE_SELECTION.digest(), 
+                                           fengine=str(BACKEND.fengine) if BACKEND.time_domain else 'none', 
+                                           packets=ANALYSED_PACKETS)
+    STATE = None
+
+    if RESUME:
+        if N_WORKERS > 0:
+            logger.critical("Runs with -j are not checkpointed and cannot be resumed; exiting.")
+            sys.exit(2)
 
-    OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'w')    
+        if os.path.isfile(OUTPUT_FILENAME):
+            with h5py.File(OUTPUT_FILENAME, 'r') as EXISTING_FILE:
+                if EXISTING_FILE.attrs.get('complete', False):
+                    logger.info("Target file '{0:s}' is complete; nothing to resume.".format(OUTPUT_FILENAME))
+                    sys.exit()
+            try:
+                STATE = CHECKPOINTER.load()
+            except ValueError as err:
+                logger.critical("{0:s} Exiting.".format(str(err)))
+                sys.exit(2)
+
+        if STATE is None:
+            logger.warning("No checkpoint for '{0:s}'; starting from the beginning.".format(OUTPUT_FILENAME))
+
+    if STATE is not None:
+        #Records after the checkpoint's write_index are overwritten as the run continues.
+        OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'r+')
+        OUTPUT_FILE.attrs['resume_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        OUTPUT_HANDLER = OUTPUT_FILE['correlations']
+        logger.info("Resuming '{0:s}' from checkpoint of {1:s}.".format(OUTPUT_FILENAME, STATE['save_date']))
+    else:
+        if os.path.isfile(OUTPUT_FILENAME):
+            logger.info("Target file '{0:s}' exists; overwriting.".format(OUTPUT_FILENAME))
+            os.remove(OUTPUT_FILENAME)
+            logger.info("Deleted '{0:s}'".format(OUTPUT_FILENAME))
+        CHECKPOINTER.remove()
+
+        OUTPUT_FILE = h5py.File(OUTPUT_FILENAME, 'w')    
+            
+        OUTPUT_FILE.attrs['process_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        OUTPUT_FILE.attrs['number_accumulations'] = N_ACC
         
-    OUTPUT_FILE.attrs['process_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-    OUTPUT_FILE.attrs['number_accumulations'] = N_ACC
-    
-    #Assign attributes to new data file
-    for k in INPUT_FILE.attrs.keys():
-        OUTPUT_FILE.attrs[k] = INPUT_FILE.attrs[k] 
-
-    OUTPUT_FILE.attrs['Truncated_analysis'] = bool(N_TO_ANALYSE is not None and N_TO_ANALYSE > 0)        
-
-    COMP_TYPE = np.dtype([('index', 'int64'), 
-                          ('timestamp', '|S30'), 
-                          ('products', 'complex64', (NUMBER_CORRELATIONS, 1024)),
-                          #('frame_indices', 'int32', (N_ACC, )),
-                          ('frame_numbers', 'uint32', (N_ACC, )),                          
-                         ])
-
-    OUTPUT_HANDLER = OUTPUT_FILE.create_dataset("correlations", 
-                                                (MAX_FRAMES,), 
-                                                dtype=COMP_TYPE, 
-                                                maxshape=(MAX_FRAMES,), 
-                                                compression="gzip", 
-                                                compression_opts=9)
+        #Assign attributes to new data file
+        for k in INPUT_FILE.attrs.keys():
+            OUTPUT_FILE.attrs[k] = INPUT_FILE.attrs[k] 
+
+        OUTPUT_FILE.attrs['Truncated_analysis'] = bool(N_TO_ANALYSE is not None and N_TO_ANALYSE > 0)        
+        OUTPUT_FILE.attrs['complete'] = False
+
+        OUTPUT_FILE.attrs['accumulator_precision'] = PRECISION
+        OUTPUT_FILE.attrs['products_type'] = OUTPUT_TYPE
+        if BACKEND.time_domain:
+            OUTPUT_FILE.attrs['pfb_taps'] = BACKEND.fengine.taps
+            OUTPUT_FILE.attrs['pfb_window'] = BACKEND.fengine.window
+
+        COMP_TYPE = acc.correlation_dtype(N_CHANNELS, N_ACC, OUTPUT_TYPE, len(FREQUENCIES), len(BASELINE_SELECTION))
+
+        OUTPUT_HANDLER = h5output.create_dataset(OUTPUT_FILE, "correlations", 
+                                                 (EXPECTED_ACCUMULATIONS,), 
+                                                 dtype=COMP_TYPE, 
+                                                 maxshape=(None,), 
+                                                 profile=OUTPUT_PROFILE, 
+                                                 chunk_records=CHUNK_RECORDS)
+        FREQUENCIES.write_attrs(OUTPUT_HANDLER)
+        BASELINE_SELECTION.write_attrs(OUTPUT_HANDLER)
+
+    logger.info("Output profile: {0:s}, {1:d} accumulation(s) per chunk."\
+        .format(OUTPUT_FILE.attrs['output_profile'], OUTPUT_HANDLER.chunks[0]))
+
+    #With -j, only the output writes happen in this process and are timed.
+    PROFILER = profiling.Profiler(enabled=PROFILE_FILENAME is not None or PROFILE_INTERVAL is not None, 
+                                  log_interval=PROFILE_INTERVAL, logger=logger)
+    OUTPUT_WRITER = h5output.BatchWriter(OUTPUT_HANDLER, 
+                                         start_index=STATE['write_index'] if STATE is not None else 0, 
+                                         profiler=PROFILER)
+
+
+    if N_WORKERS > 0:
+        logger.info("Running pipeline with {0:d} correlator processes.".format(N_WORKERS))
+
+        def open_blocks():
+            '''
+            Open the input file in the reader process and iterate over its packets.
+            '''
+            stop = N_TO_ANALYSE if N_TO_ANALYSE is not None and N_TO_ANALYSE > 0 else TOT_PACKETS
+            packet_table = h5py.File(INPUT_FILENAME, "r")['ADC_Timestream_Data']
+            return packet_reader.iterate_hdf5_blocks(packet_table, BLOCK_SIZE, stop=stop)
+
+        (CORRELATION_TOTAL, COMPLETED_FRAMES, INCOMPLETE_FRAMES, FORGOTTEN_PACKETS) = \
+            pipeline.run_pipeline(open_blocks, OUTPUT_WRITER, N_CHANNELS, N_ACC, N_WORKERS, BACKEND.name, FREQUENCIES, 
+                                  BASELINE_SELECTION)
+
+        logger.info("Final completed frames: {0:d}".format(COMPLETED_FRAMES))
+        logger.info("Number of incomplete frames: {0:d}".format(INCOMPLETE_FRAMES))
+        logger.info("Number of forgotten packets: {0:d}".format(FORGOTTEN_PACKETS))
+    else:
+        CORRELATION_TOTAL = parse_raw_data(INPUT_FILE, OUTPUT_WRITER, 
+                                           N_CHANNELS, N_TO_ANALYSE, N_ACC, BLOCK_SIZE, PROFILER, 
+                                           CHECKPOINTER, STATE, BACKEND, PRECISION, OUTPUT_TYPE, FREQUENCIES, 
+                                           BASELINE_SELECTION)
 
 
-    CORRELATION_TOTAL = parse_raw_data(INPUT_FILE, OUTPUT_HANDLER, 
-                                       N_CHANNELS, N_TO_ANALYSE, N_ACC)
+    CORRELATION_TOTAL = OUTPUT_WRITER.close()
 
+    if PROFILE_FILENAME is not None:
+        PROFILER.write_json(PROFILE_FILENAME, 
+                            input_file=INPUT_FILENAME, 
+                            packets=int(ANALYSED_PACKETS), 
+                            input_bytes=int(ANALYSED_PACKETS) * packet_reader.PACKET_DTYPE.itemsize, 
+                            accumulations=CORRELATION_TOTAL, 
+                            workers=N_WORKERS)
 
     OUTPUT_FILE.attrs['number_correlations'] = CORRELATION_TOTAL
     OUTPUT_FILE.attrs['true_number_entries'] = CORRELATION_TOTAL
-    OUTPUT_HANDLER.resize((CORRELATION_TOTAL,))
+
+    if LEVELS:
+        reintegrate.build_pyramid(OUTPUT_FILE, LEVELS)
+
+    OUTPUT_FILE.attrs['complete'] = True
 
     logger.info("Number of accumulations in output file: {0:d}".format(CORRELATION_TOTAL))
 #    print "Printing first three entries: "
@@ -382,6 +542,7 @@ if __name__ == "__main__":
     #print OUTPUT_FILE
     INPUT_FILE.close()    
     OUTPUT_FILE.close()
+    CHECKPOINTER.remove()
     logger.info("----------------------------------------")
     logger.info("Run time: {0:.3f}".format(time.time() - START_TIME))
     logger.info("Number accumulations: {0:d}".format(CORRELATION_TOTAL))
@@ -0,0 +1,172 @@
+import time
+import json
+
+STAGES = ('read', 'decode', 'assembly', 'accumulate', 'correlate', 'write')
+
+
+class _NullStage(object):
+
+    '''
+    Context manager that does nothing; returned by a disabled Profiler.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    '''
+    Context manager timing one entry into a profiler stage.
+    '''
+
+    __slots__ = ('profiler', 'name', 'items')
+
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.profiler._enter(self.name, self.items)
+        return self
+
+    def __exit__(self, *args):
+        self.profiler._exit()
+        return False
+
+
+class Profiler(object):
+
+    '''
+    Accumulate wall time, entries and item counts for each stage of a run.
+
+    Stages nest: time spent in an inner stage is charged to the inner stage
+    only, so the stage times add up to the profiled wall time. Time outside
+    any stage is reported as unattributed.
+
+    A disabled profiler hands out a no-op context manager, so instrumented
+    code costs one method call per stage entry when profiling is off.
+
+    params:
+        enabled: collect timings.
+        log_interval: seconds between periodic summaries sent to logger.
+        logger: logging.Logger for the periodic summaries.
+    '''
+
+    def __init__(self, enabled=True, log_interval=None, logger=None):
+
+        self.enabled = enabled
+        self.log_interval = log_interval
+        self.logger = logger
+
+        self.seconds = dict((name, 0.) for name in STAGES)
+        self.calls = dict((name, 0) for name in STAGES)
+        self.items = dict((name, 0) for name in STAGES)
+
+        self.start_time = time.time()
+        self.last_log = self.start_time
+        self.stack = [] #names of the open stages, innermost last
+        self.mark = self.start_time #time from which the innermost stage is charged
+
+    def stage(self, name, items=0):
+        '''
+        Return a context manager timing a stage; items counts e.g. packets or frames.
+        '''
+
+        if not self.enabled:
+            return _NULL_STAGE
+
+        return _Stage(self, name, items)
+
+    def timed(self, iterable, name, items=len):
+        '''
+        Yield from an iterable, charging the time spent waiting for each
+        element to a stage (e.g. 'read' for a block iterator).
+        '''
+
+        iterator = iter(iterable)
+
+        while True:
+            with self.stage(name):
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    return
+            if self.enabled:
+                self.items[name] += items(element)
+            yield element
+
+    def _enter(self, name, items):
+        '''
+        Charge the time so far to the enclosing stage and open a new one.
+        '''
+
+        now = time.time()
+
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.mark
+
+        if name not in self.seconds:
+            self.seconds[name] = 0.
+            self.calls[name] = 0
+            self.items[name] = 0
+
+        self.calls[name] += 1
+        self.items[name] += items
+        self.stack.append(name)
+        self.mark = now
+
+    def _exit(self):
+        '''
+        Charge the time so far to the innermost stage and close it.
+        '''
+
+        now = time.time()
+        self.seconds[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+        if self.log_interval and now - self.last_log > self.log_interval:
+            self.last_log = now
+            if self.logger is not None:
+                self.logger.info(json.dumps(self.summary(), sort_keys=True))
+
+    def summary(self):
+        '''
+        Return a dictionary of the timings collected so far.
+        '''
+
+        wall = time.time() - self.start_time
+        stages = {}
+
+        for name in self.seconds:
+            stages[name] = {'seconds': self.seconds[name],
+                            'calls': self.calls[name],
+                            'items': self.items[name],
+                            'fraction': self.seconds[name] / wall if wall > 0 else 0.,
+                            'items_per_second': self.items[name] / self.seconds[name] if self.seconds[name] > 0 else 0.}
+
+        return {'wall_seconds': wall,
+                'unattributed_seconds': wall - sum(self.seconds.values()),
+                'stages': stages}
+
+    def write_json(self, filename, **extra):
+        '''
+        Write the summary, with any extra top-level fields, as JSON to a file
+        ('-' for standard output).
+        '''
+
+        summary = self.summary()
+        summary.update(extra)
+        text = json.dumps(summary, indent=2, sort_keys=True)
+
+        if filename == '-':
+            print text
+        else:
+            with open(filename, 'w') as file_handle:
+                file_handle.write(text + "\n")
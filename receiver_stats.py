@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import mmap
+import getopt
+
+import numpy as np
+
+STATS_MAGIC = 0x54415453
+STATS_VERSION = 1
+STATS_ANTENNAS = 16
+
+#Layout of the stats file published by the receivers (receiverStats in streamer/receiver_stats.h).
+STATS_DTYPE = np.dtype([('magic', '<u4'),
+                        ('version', '<u4'),
+                        ('sequence', '<u8'),
+                        ('start_time', '<f8'),
+                        ('update_time', '<f8'),
+                        ('packet_rate', '<f8'),
+                        ('byte_rate', '<f8'),
+                        ('packets', '<u8'),
+                        ('bytes', '<u8'),
+                        ('kernel_drops', '<u8'),
+                        ('skipped', '<u8'),
+                        ('out_of_order', '<u8'),
+                        ('ring_overruns', '<u8'),
+                        ('packets_written', '<u8'),
+                        ('antenna_packets', '<u8', STATS_ANTENNAS)])
+
+SEQUENCE_OFFSET = STATS_DTYPE.fields['sequence'][1]
+
+
+class ReceiverStats(object):
+
+    '''
+    Read-only view of the live counters a receiver publishes in its stats file.
+
+    The receiver updates the file under a sequence lock, so snapshot() copies
+    the record until the sequence number is even and unchanged across the copy.
+    '''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        with open(filename, 'rb') as file_handle:
+            if os.fstat(file_handle.fileno()).st_size < STATS_DTYPE.itemsize:
+                raise IOError("'{0:s}' is not a receiver stats file.".format(filename))
+            self.map = mmap.mmap(file_handle.fileno(), STATS_DTYPE.itemsize, access=mmap.ACCESS_READ)
+
+        header = self.snapshot()
+        if header['magic'] != STATS_MAGIC or header['version'] != STATS_VERSION:
+            self.close()
+            raise IOError("'{0:s}' is not a version {1:d} receiver stats file.".format(filename, STATS_VERSION))
+
+    def _sequence(self):
+        '''
+        Return the current sequence number of the stats record.
+        '''
+        return np.frombuffer(self.map, dtype='<u8', count=1, offset=SEQUENCE_OFFSET)[0]
+
+    def snapshot(self, retries=1000):
+        '''
+        Return a consistent copy of the stats record as a STATS_DTYPE scalar.
+        '''
+
+        for _ in xrange(retries):
+            sequence = self._sequence()
+            if sequence % 2 == 0:
+                record = np.frombuffer(self.map[:STATS_DTYPE.itemsize], dtype=STATS_DTYPE)[0]
+                if self._sequence() == sequence:
+                    return record
+            time.sleep(0)
+
+        raise IOError("Unable to read a consistent snapshot of '{0:s}'.".format(self.filename))
+
+    def close(self):
+        '''
+        Unmap the stats file.
+        '''
+        self.map.close()
+
+
+def format_stats(record):
+    '''
+    Return a one-line summary of a stats record.
+    '''
+
+    age = time.time() - record['update_time']
+    antennas = np.nonzero(record['antenna_packets'])[0]
+
+    return "packets {0:d} ({1:.0f}/s, {2:.2f} MB/s)  kernel drops {3:d}  ring overruns {4:d}  "\
+           "out of order {5:d}  skipped {6:d}  written {7:d}  antennas {8:s}  updated {9:.1f} s ago"\
+        .format(int(record['packets']), record['packet_rate'], record['byte_rate'] / 1e6,
+                int(record['kernel_drops']), int(record['ring_overruns']), int(record['out_of_order']),
+                int(record['skipped']), int(record['packets_written']),
+                "/".join(str(int(record['antenna_packets'][i])) for i in antennas), age)
+
+
+def monitor(filename, interval=2., count=None):
+    '''
+    Print a summary of a receiver's stats file every interval seconds.
+    '''
+
+    stats = ReceiverStats(filename)
+
+    try:
+        printed = 0
+        while count is None or printed < count:
+            print format_stats(stats.snapshot())
+            sys.stdout.flush()
+            printed += 1
+            if count is None or printed < count:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.close()
+
+
+def usage():
+    '''
+    Usage function.
+    '''
+
+    print "Usage: {0:s} <stats file>\n\
+         \t -h/--help: This message.\n\
+         \t -i/--interval: Seconds between reports.\n\
+         \t -n/--count: Number of reports (default: until interrupted).".format(sys.argv[0])
+
+
+if __name__ == "__main__":
+
+    INTERVAL = 2.
+    COUNT = None
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:], "hi:n:", ["help", "interval=", "count="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt, arg in OPTS:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-i", "--interval"):
+            INTERVAL = float(arg)
+        elif opt in ("-n", "--count"):
+            COUNT = int(arg)
+
+    if len(ARGS) != 1:
+        usage()
+        sys.exit(2)
+
+    monitor(ARGS[0], INTERVAL, COUNT)
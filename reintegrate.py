@@ -0,0 +1,399 @@
+'''
+Build coarser integrations from a correlation output by summing consecutive
+records of its 'correlations' dataset.
+
+A capture correlated once at a fine base cadence (a small --nacc) can be
+reintegrated to any multiple of that cadence without decoding it again.
+Each output record sums factor consecutive input records: index and
+timestamp are those of the first record, and frame_numbers lists the
+frames of all of them, so the time bookkeeping of the output is exact.
+Products of integer output types (see accumulator.OUTPUT_TYPES) are summed
+exactly and quantized again.
+
+The coarser datasets are written either to separate files, or as a pyramid
+of 'correlations_x<factor>' datasets in the input file itself.
+'''
+
+# pylint: disable=C0103, W1202, line-too-long
+
+import os
+import sys
+import time
+import getopt
+import logging
+from datetime import datetime
+
+import numpy as np
+import h5py
+
+import accumulator as acc
+import h5output
+
+BLOCK_RECORDS = 64 #input records read at a time
+
+logger = logging.getLogger(__name__) # pylint: disable=locally-disabled, invalid-name
+
+
+def level_name(factor):
+    '''
+    Return the name of the pyramid dataset of a reintegration factor.
+    '''
+    return "correlations_x{0:d}".format(factor)
+
+
+def reintegrated_filename(filename, factor):
+    '''
+    Return the separate output file of a reintegration factor.
+    '''
+
+    source_filename = os.path.split(filename)
+    return os.path.join(source_filename[0], "x{0:d}_{1:s}".format(factor, source_filename[1]))
+
+
+def level_dtype(dtype, factor):
+    '''
+    Return the record dtype of a 'correlations' dataset with factor times as many frames per record.
+    '''
+
+    fields = []
+    for name in dtype.names:
+        shape = dtype[name].shape
+        if name == 'frame_numbers':
+            shape = (shape[0] * factor, )
+        fields.append((name, dtype[name].base, shape))
+
+    return np.dtype(fields)
+
+
+def number_records(dataset):
+    '''
+    Return the number of valid records of a 'correlations' dataset, which
+    may still be growing (see h5output.BatchWriter).
+    '''
+    return min(dataset.shape[0], int(dataset.attrs.get('number_records', dataset.shape[0])))
+
+
+def frame_step(first, second):
+    '''
+    Return the absolute step between two uint32 frame numbers, allowing for wrapping.
+    '''
+    return abs((int(second) - int(first) + 2**31) % 2**32 - 2**31)
+
+
+class Reintegrator(object):
+
+    '''
+    Sum groups of factor consecutive 'correlations' records and stage the
+    sums in writer (an h5output.BatchWriter of a level_dtype(..., factor) dataset).
+
+    With max_gap, a group is not continued across two records whose last
+    and first frame numbers are more than max_gap apart: the records of the
+    partial group are dropped and a new group starts after the gap.
+    '''
+
+    def __init__(self, factor, writer, max_gap=None):
+
+        dtype = writer.dataset.dtype
+
+        self.factor = factor
+        self.writer = writer
+        self.max_gap = max_gap
+        self.output = dtype['products'].base.name if 'scale' in dtype.names else 'complex64'
+        self.n_acc = dtype['frame_numbers'].shape[0] // factor #frames per input record
+
+        self.sums = np.zeros(dtype['products'].shape[:2], dtype=np.complex128)
+        self.frame_numbers = np.zeros(dtype['frame_numbers'].shape, dtype=np.uint32)
+        self.filled = 0 #input records in the current group
+        self.dropped = 0 #input records dropped at gaps
+        self.last_frame = None
+        self.timestamp = ""
+        self.index = -1
+
+    def add(self, record, products):
+        '''
+        Add an input record, with its products decoded to complex values.
+        '''
+
+        frame_numbers = record['frame_numbers']
+
+        if self.filled > 0 and self.max_gap is not None \
+            and frame_step(self.last_frame, frame_numbers[0]) > self.max_gap:
+            self.dropped += self.filled
+            self.reset()
+
+        if self.filled == 0:
+            self.index = record['index']
+            self.timestamp = record['timestamp']
+
+        self.sums += products
+        self.frame_numbers[self.filled * self.n_acc:(self.filled + 1) * self.n_acc] = frame_numbers
+        self.last_frame = frame_numbers[-1]
+        self.filled += 1
+
+        if self.filled == self.factor:
+            self.write()
+            self.reset()
+
+    def write(self):
+        '''
+        Stage the summed group in the writer.
+        '''
+
+        record = self.writer.next_record()
+        record['index'] = self.index
+        record['timestamp'] = self.timestamp
+
+        if self.output == 'complex64':
+            record['products'] = self.sums
+        else:
+            record['products'], record['scale'] = acc.quantize(self.sums, self.output)
+
+        record['frame_numbers'] = self.frame_numbers
+        self.writer.commit()
+
+    def reset(self):
+        '''
+        Start a new group.
+        '''
+
+        self.sums[...] = 0
+        self.frame_numbers[:] = 0
+        self.filled = 0
+
+
+def reintegrate(source, writers, max_gap=None, block_records=BLOCK_RECORDS):
+    '''
+    Reintegrate a 'correlations' dataset to several factors in one pass.
+
+    params:
+        source: input 'correlations' dataset.
+        writers: dictionary of factor: h5output.BatchWriter of the output dataset.
+        max_gap: see Reintegrator.
+
+    returns a dictionary of factor: Reintegrator, holding the records dropped
+    at gaps and the records left over after the last full group.
+    '''
+
+    reintegrators = dict((factor, Reintegrator(factor, writer, max_gap)) for factor, writer in writers.items())
+
+    total = number_records(source)
+
+    for start in xrange(0, total, block_records):
+        records = source[start:min(start + block_records, total)]
+        products = acc.decode_products(records)
+
+        for record, record_products in zip(records, products):
+            for reintegrator in reintegrators.values():
+                reintegrator.add(record, record_products)
+
+    for reintegrator in reintegrators.values():
+        reintegrator.writer.close()
+
+    return reintegrators
+
+
+def _create_level(group, name, source, factor, profile, chunk_records=1):
+    '''
+    Create the dataset of one reintegration factor and return its BatchWriter.
+    '''
+
+    if name in group:
+        del group[name]
+
+    dataset = h5output.create_dataset(group, name,
+                                      (max(1, number_records(source) // factor), ),
+                                      dtype=level_dtype(source.dtype, factor),
+                                      maxshape=(None, ),
+                                      profile=profile,
+                                      chunk_records=chunk_records)
+    #Attributes describing the products, e.g. the frequency channels, apply to every level.
+    for key, value in source.attrs.items():
+        if key != 'number_records':
+            dataset.attrs[key] = value
+    dataset.attrs['integration_factor'] = factor
+    dataset.attrs['output_profile'] = profile
+
+    return h5output.BatchWriter(dataset)
+
+
+def _summarize(dataset, reintegrator, n_acc):
+    '''
+    Record the bookkeeping of a finished level in its dataset attributes.
+    '''
+
+    dataset.attrs['number_accumulations'] = n_acc * reintegrator.factor
+    dataset.attrs['dropped_records'] = reintegrator.dropped
+    dataset.attrs['left_over_records'] = reintegrator.filled
+
+    logger.info("x{0:d}: {1:d} records of {2:d} frames; {3:d} input records dropped at gaps, {4:d} left over."\
+        .format(reintegrator.factor, dataset.shape[0], n_acc * reintegrator.factor,
+                reintegrator.dropped, reintegrator.filled))
+
+
+def build_pyramid(file_handle, factors, profile=None, max_gap=None):
+    '''
+    Add a 'correlations_x<factor>' dataset for each factor to an open
+    correlation output, replacing existing levels.
+
+    returns the names of the level datasets.
+    '''
+
+    source = file_handle['correlations']
+    n_acc = int(file_handle.attrs['number_accumulations'])
+
+    #The file attributes describe the base dataset; the levels record their own profile.
+    file_profile = file_handle.attrs.get('output_profile', h5output.DEFAULT_PROFILE)
+    chunk_records = file_handle.attrs.get('chunk_records', 1)
+
+    if profile is None:
+        profile = file_profile
+
+    writers = dict((factor, _create_level(file_handle, level_name(factor), source, factor, profile))
+                   for factor in factors)
+    file_handle.attrs['output_profile'] = file_profile
+    file_handle.attrs['chunk_records'] = chunk_records
+
+    reintegrators = reintegrate(source, writers, max_gap)
+
+    for factor in factors:
+        _summarize(file_handle[level_name(factor)], reintegrators[factor], n_acc)
+
+    file_handle.attrs['pyramid_levels'] = sorted(factors)
+
+    return [level_name(factor) for factor in factors]
+
+
+def write_levels(filename, factors, profile=None, max_gap=None):
+    '''
+    Write each reintegration factor of a correlation output to a separate
+    file (see reintegrated_filename), with the attributes of the input file.
+
+    returns the output filenames.
+    '''
+
+    filenames = dict((factor, reintegrated_filename(filename, factor)) for factor in factors)
+
+    with h5py.File(filename, 'r') as source_file:
+        source = source_file['correlations']
+        n_acc = int(source_file.attrs['number_accumulations'])
+
+        if profile is None:
+            profile = source_file.attrs.get('output_profile', h5output.DEFAULT_PROFILE)
+
+        output_files = dict((factor, h5py.File(filenames[factor], 'w')) for factor in factors)
+
+        try:
+            writers = {}
+            for factor, output_file in output_files.items():
+                for key, value in source_file.attrs.items():
+                    output_file.attrs[key] = value
+                output_file.attrs['source_file'] = os.path.abspath(filename)
+                output_file.attrs['reintegration_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+                output_file.attrs['reintegration_factor'] = factor
+
+                writers[factor] = _create_level(output_file, "correlations", source, factor, profile)
+
+            reintegrators = reintegrate(source, writers, max_gap)
+
+            for factor, output_file in output_files.items():
+                _summarize(output_file['correlations'], reintegrators[factor], n_acc)
+                output_file.attrs['number_accumulations'] = n_acc * factor
+                output_file.attrs['number_correlations'] = output_file['correlations'].shape[0]
+                output_file.attrs['true_number_entries'] = output_file['correlations'].shape[0]
+        finally:
+            for output_file in output_files.values():
+                output_file.close()
+
+    return [filenames[factor] for factor in factors]
+
+
+def parse_factors(text):
+    '''
+    Parse a comma-separated list of reintegration factors, e.g. "2,10,100".
+    '''
+
+    factors = sorted(set(int(factor) for factor in text.split(",") if factor.strip()))
+    if not factors or factors[0] < 1:
+        raise ValueError("Reintegration factors must be positive integers: '{0:s}'.".format(text))
+
+    return factors
+
+
+def usage():
+    '''
+    Usage function.
+    '''
+
+    print "Usage: {0:s} [options] <correlation file> <factor>[,<factor>...]\n\
+         \t -h/--help: This message.\n\
+         \t -p/--pyramid: Add 'correlations_x<factor>' datasets to the input file instead of writing x<factor>_ files.\n\
+         \t -g/--max-gap: Largest frame number step within a summed group (default: no limit).\n\
+         \t -o/--output-profile: Output compression (none/lzf/gzip-1/shuffle+lzf/gzip-9; default: that of the input).\n\
+         \t -l/--log: Log level".format(sys.argv[0])
+
+
+if __name__ == "__main__":
+
+    PYRAMID = False
+    MAX_GAP = None
+    OUTPUT_PROFILE = None
+    LOG_LEVEL = "INFO"
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:],
+                                   "hpg:o:l:",
+                                   ["help",
+                                    "pyramid",
+                                    "max-gap=",
+                                    "output-profile=",
+                                    "log=",
+                                   ])
+        FACTORS = parse_factors(ARGS[1]) if len(ARGS) == 2 else None
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+
+    for opt, arg in OPTS:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit(2)
+        elif opt in ("-p", "--pyramid"):
+            PYRAMID = True
+        elif opt in ("-g", "--max-gap"):
+            MAX_GAP = int(arg)
+        elif opt in ("-o", "--output-profile"):
+            OUTPUT_PROFILE = arg
+        elif opt in ("-l", "--log"):
+            LOG_LEVEL = arg
+
+    if FACTORS is None or (OUTPUT_PROFILE is not None and OUTPUT_PROFILE not in h5output.OUTPUT_PROFILES):
+        usage()
+        sys.exit(2)
+
+    numeric_level = getattr(logging, LOG_LEVEL.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % LOG_LEVEL)
+
+    logger.setLevel(numeric_level)
+    ch = logging.StreamHandler()
+    ch.setLevel(numeric_level)
+    ch.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(ch)
+
+    INPUT_FILENAME = ARGS[0]
+    START_TIME = time.time()
+
+    with h5py.File(INPUT_FILENAME, 'r') as INPUT_FILE:
+        if not INPUT_FILE.attrs.get('complete', True):
+            logger.warning("'{0:s}' is incomplete; reintegrating its {1:d} records written so far."\
+                .format(INPUT_FILENAME, number_records(INPUT_FILE['correlations'])))
+
+    if PYRAMID:
+        with h5py.File(INPUT_FILENAME, 'r+') as INPUT_FILE:
+            build_pyramid(INPUT_FILE, FACTORS, OUTPUT_PROFILE, MAX_GAP)
+        logger.info("Pyramid levels added to '{0:s}'.".format(INPUT_FILENAME))
+    else:
+        for OUTPUT_FILENAME in write_levels(INPUT_FILENAME, FACTORS, OUTPUT_PROFILE, MAX_GAP):
+            logger.info("Wrote '{0:s}'.".format(OUTPUT_FILENAME))
+
+    logger.info("Run time: {0:.3f} s".format(time.time() - START_TIME))
@@ -0,0 +1,180 @@
+/*
+* receiver_stats.h - live receiver counters published in a memory-mapped
+* stats file, read by receiver_stats.py.
+*
+* The receiver keeps its counters in a private copy and publishes them to
+* the mapped file under a sequence lock: the sequence number is odd while
+* an update is in progress, so a reader that sees the same even number
+* before and after copying the record has a consistent snapshot. Only one
+* thread may count and publish.
+*/
+
+#ifndef RECEIVER_STATS_H
+#define RECEIVER_STATS_H
+
+#include <stdint.h>
+#include <stddef.h>
+#include <stdio.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <stdatomic.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/time.h>
+
+#define STATS_MAGIC 0x54415453   /* "STAT" */
+#define STATS_VERSION 1
+#define STATS_ANTENNAS 16        /* the antenna number is the low nibble of the first header byte */
+#define STATS_RATE_INTERVAL 1.0  /* seconds between rate updates */
+#define STATS_PUBLISH_PACKETS 64 /* packets between publications in single-threaded mode */
+
+/* layout of the stats file; mirrored by STATS_DTYPE in receiver_stats.py */
+typedef struct receiver_stats
+{
+    uint32_t magic;
+    uint32_t version;
+    uint64_t sequence;          /* seqlock; odd while an update is in progress */
+    double start_time;          /* unix time the receiver started */
+    double update_time;         /* unix time of the last publication */
+    double packet_rate;         /* packets/s over the last rate interval */
+    double byte_rate;           /* bytes/s over the last rate interval */
+    uint64_t packets;           /* timestream packets received */
+    uint64_t bytes;             /* datagram bytes received */
+    uint64_t kernel_drops;      /* datagrams dropped by the kernel (SO_RXQ_OVFL) */
+    uint64_t skipped;           /* datagrams that were not timestream frames */
+    uint64_t out_of_order;      /* packets with a frame number behind the latest seen */
+    uint64_t ring_overruns;     /* datagrams dropped because the packet ring was full */
+    uint64_t packets_written;   /* packets written to disk */
+    uint64_t antenna_packets[STATS_ANTENNAS];
+} receiverStats;
+
+typedef struct stats_publisher
+{
+    receiverStats local;        /* counters, updated by the receiver */
+    receiverStats *shared;      /* mapped stats file; NULL if unavailable */
+    uint32_t latest_timestamp;  /* most recent frame number in sequence */
+    int have_timestamp;
+    double rate_time;           /* time of the last rate update */
+    uint64_t rate_packets;      /* packet and byte counts at rate_time */
+    uint64_t rate_bytes;
+} statsPublisher;
+
+static double stats_now(void) {
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    return now.tv_sec + 1e-6 * now.tv_usec;
+}
+
+/*
+* stats_open - create and map the stats file. Returns 0 on success; on
+* failure the counters are still kept but not published.
+*/
+static int stats_open(statsPublisher *pub, const char *filename) {
+    memset(pub, 0, sizeof(statsPublisher));
+    pub->local.magic = STATS_MAGIC;
+    pub->local.version = STATS_VERSION;
+    pub->local.start_time = pub->rate_time = stats_now();
+
+    int fd = open(filename, O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0 || ftruncate(fd, sizeof(receiverStats)) != 0) {
+        perror("Unable to create stats file");
+        if (fd >= 0)
+            close(fd);
+        return -1;
+    }
+
+    void *mapped = mmap(NULL, sizeof(receiverStats), PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (mapped == MAP_FAILED) {
+        perror("Unable to map stats file");
+        return -1;
+    }
+
+    pub->shared = (receiverStats *) mapped;
+    memcpy(pub->shared, &pub->local, sizeof(receiverStats));
+    return 0;
+}
+
+/*
+* stats_count_packet - count one timestream packet.
+*/
+static inline void stats_count_packet(statsPublisher *pub, int antenna, uint32_t timestamp, size_t bytes) {
+    pub->local.packets++;
+    pub->local.bytes += bytes;
+    pub->local.antenna_packets[antenna % STATS_ANTENNAS]++;
+
+    if (pub->have_timestamp && (int32_t)(timestamp - pub->latest_timestamp) < 0)
+        pub->local.out_of_order++;
+    else
+        pub->latest_timestamp = timestamp;
+    pub->have_timestamp = 1;
+}
+
+/*
+* stats_count_drops - take the kernel drop count from the SO_RXQ_OVFL
+* control message of a received datagram, if present.
+*/
+static inline void stats_count_drops(statsPublisher *pub, struct msghdr *msg) {
+#ifdef SO_RXQ_OVFL
+    for (struct cmsghdr *cmsg = CMSG_FIRSTHDR(msg); cmsg != NULL; cmsg = CMSG_NXTHDR(msg, cmsg)) {
+        if (cmsg->cmsg_level == SOL_SOCKET && cmsg->cmsg_type == SO_RXQ_OVFL) {
+            uint32_t drops;
+            memcpy(&drops, CMSG_DATA(cmsg), sizeof(drops));
+            pub->local.kernel_drops = drops;
+        }
+    }
+#endif
+}
+
+/*
+* stats_enable_drops - ask the kernel to report its drop count with each datagram.
+*/
+static void stats_enable_drops(int sockfd) {
+#ifdef SO_RXQ_OVFL
+    int one = 1;
+    if (setsockopt(sockfd, SOL_SOCKET, SO_RXQ_OVFL, (const void *)&one, sizeof(int)) < 0)
+        perror("SO_RXQ_OVFL unavailable; kernel drops will not be counted");
+#endif
+}
+
+/*
+* stats_publish - update the rates and copy the counters to the stats file.
+*/
+static void stats_publish(statsPublisher *pub) {
+    double now = stats_now();
+
+    if (now - pub->rate_time >= STATS_RATE_INTERVAL) {
+        pub->local.packet_rate = (pub->local.packets - pub->rate_packets) / (now - pub->rate_time);
+        pub->local.byte_rate = (pub->local.bytes - pub->rate_bytes) / (now - pub->rate_time);
+        pub->rate_time = now;
+        pub->rate_packets = pub->local.packets;
+        pub->rate_bytes = pub->local.bytes;
+    }
+    pub->local.update_time = now;
+
+    if (pub->shared == NULL)
+        return;
+
+    uint64_t sequence = pub->shared->sequence;
+    __atomic_store_n(&pub->shared->sequence, sequence + 1, __ATOMIC_RELAXED);
+    atomic_thread_fence(memory_order_release);
+    memcpy((char *) pub->shared + offsetof(receiverStats, start_time),
+           (char *) &pub->local + offsetof(receiverStats, start_time),
+           sizeof(receiverStats) - offsetof(receiverStats, start_time));
+    __atomic_store_n(&pub->shared->sequence, sequence + 2, __ATOMIC_RELEASE);
+}
+
+/*
+* stats_close - publish the final counters and unmap the stats file.
+*/
+static void stats_close(statsPublisher *pub) {
+    stats_publish(pub);
+    if (pub->shared != NULL) {
+        msync(pub->shared, sizeof(receiverStats), MS_SYNC);
+        munmap(pub->shared, sizeof(receiverStats));
+        pub->shared = NULL;
+    }
+}
+
+#endif
@@ -4,6 +4,7 @@
 * originally started from http://www.cs.cmu.edu/afs/cs/academic/class/15213-f99/www/class26/udpserver.c
 */
 
+#define _GNU_SOURCE /* recvmmsg */
 #include <stdio.h>
 #include <unistd.h>
 #include <stdlib.h>
@@ -17,13 +18,67 @@
 #include <arpa/inet.h>
 #include <errno.h>
 #include <signal.h>
+#include <stddef.h>
+#include <stdatomic.h>
+#include <pthread.h>
+#include <sys/uio.h>
 #include "hdf5.h"
 #include "hdf5_hl.h"
+#include "receiver_stats.h"
 
 #include <sys/stat.h>
 
 #define BUFSIZE 32767
 #define nsamples 2048
+#define HEADER_BYTES 9       /* antenna/frame id, stream id, word length, timestamp */
+#define RING_BATCH 64        /* default datagrams per recvmmsg call */
+#define MAX_RING_BATCH 1024
+#define WRITE_RECORDS 2048   /* records gathered before a write in ring mode (~4 MB) */
+#define WRITE_WAIT_POLLS 100 /* 1 ms polls before a partial write */
+#define RING_RCVBUF (64 * 1024 * 1024) /* requested socket receive buffer in ring mode */
+
+typedef struct packet_struct
+{
+    unsigned int   timestamp;
+    int8_t    antenna;
+    int8_t timestream[nsamples];
+    char comp_timestamp[26];
+} singlePacket;
+
+/* the packet records are written packed, without the struct's trailing padding */
+#define RECORD_SIZE (sizeof(singlePacket)-1)
+
+/*
+* packet ring - single-producer, single-consumer ring of packed packet
+* records shared by the receive thread and the writer thread. head and
+* tail count records since the start of the current file; only the
+* receive thread advances head and only the writer thread advances tail,
+* so no locks are needed.
+*/
+typedef struct packet_ring
+{
+    uint8_t *records;       /* size packed records, page aligned */
+    size_t size;            /* number of records */
+    int batch;              /* datagrams per recvmmsg call */
+    int sockfd;
+    FILE *out;
+    statsPublisher *stats;  /* published by the receive thread */
+    size_t to_receive;      /* packets to capture into the current file */
+    atomic_size_t head;     /* records received */
+    atomic_size_t tail;     /* records written */
+    atomic_int receiving;   /* receive thread still running */
+    atomic_int writing;     /* writer thread still running */
+    /* counters, accumulated over all files */
+    atomic_ulong received;  /* timestream packets placed in the ring */
+    atomic_ulong written;   /* packets written to disk */
+    atomic_ulong overruns;  /* datagrams dropped because the ring was full */
+    atomic_ulong skipped;   /* datagrams that were not complete timestream frames */
+    atomic_ulong write_errors;
+    atomic_size_t max_fill; /* peak ring occupancy in records */
+} packetRing;
+
+volatile sig_atomic_t interrupted = 0;
+int ring_mode = 0;
 
 /*
 * error - wrapper for perror
@@ -36,22 +91,216 @@ void error(char *msg) {
 void sig_handler(int sigNumber) {
     if (sigNumber == SIGINT) {
         printf("User interrupted, hopefully exiting nicely...\n");
+        if (ring_mode) {
+            /* let the threads stop and the writer drain the ring */
+            interrupted = 1;
+            return;
+        }
         exit(0);
     }
 }
 
+/*
+* publish_ring_stats - publish the receive thread's counters together with
+* the ring counters.
+*/
+void publish_ring_stats(packetRing *ring) {
+    ring->stats->local.skipped = atomic_load(&ring->skipped);
+    ring->stats->local.ring_overruns = atomic_load(&ring->overruns);
+    ring->stats->local.packets_written = atomic_load(&ring->written);
+    stats_publish(ring->stats);
+}
+
+/*
+* receive_thread - fill the packet ring with recvmmsg. Each datagram's
+* header goes to a scratch buffer and its samples straight into the
+* timestream field of a ring record; the remaining fields are filled in
+* afterwards. When the ring is full, datagrams are still read (so that the
+* kernel buffer does not overflow unseen) and counted as overruns.
+*/
+void *receive_thread(void *arg) {
+    packetRing *ring = (packetRing *) arg;
+    struct mmsghdr msgs[MAX_RING_BATCH];
+    struct iovec iovecs[MAX_RING_BATCH][2];
+    char controls[MAX_RING_BATCH][CMSG_SPACE(sizeof(uint32_t))];
+    uint8_t headers[MAX_RING_BATCH][HEADER_BYTES];
+    uint8_t discard[nsamples];
+    struct timeval curTime;
+    char buffer[80];
+    char currentTime[32];
+    size_t received = 0;
+    
+    while (received < ring->to_receive && !interrupted) {
+        size_t head = atomic_load_explicit(&ring->head, memory_order_relaxed);
+        size_t tail = atomic_load_explicit(&ring->tail, memory_order_acquire);
+        size_t space = ring->size - (head - tail);
+        size_t contiguous = ring->size - head % ring->size;
+        size_t want = ring->batch;
+        int overrun = (space == 0);
+        
+        if (want > ring->to_receive - received)
+            want = ring->to_receive - received;
+        if (!overrun && want > space)
+            want = space;
+        if (!overrun && want > contiguous)
+            want = contiguous;
+        
+        memset(msgs, 0, want * sizeof(struct mmsghdr));
+        for (size_t i = 0; i < want; ++i) {
+            uint8_t *record = ring->records + ((head + i) % ring->size) * RECORD_SIZE;
+            iovecs[i][0].iov_base = headers[i];
+            iovecs[i][0].iov_len = HEADER_BYTES;
+            iovecs[i][1].iov_base = overrun ? discard : record + offsetof(singlePacket, timestream);
+            iovecs[i][1].iov_len = nsamples;
+            msgs[i].msg_hdr.msg_iov = iovecs[i];
+            msgs[i].msg_hdr.msg_iovlen = 2;
+            msgs[i].msg_hdr.msg_control = controls[i];
+            msgs[i].msg_hdr.msg_controllen = sizeof(controls[i]);
+        }
+        
+        int n = recvmmsg(ring->sockfd, msgs, want, MSG_WAITFORONE, NULL);
+        if (n < 0) {
+            if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+                publish_ring_stats(ring);
+                continue; /* receive timeout: check for interruption */
+            }
+            error("ERROR in recvmmsg");
+        }
+        
+        stats_count_drops(ring->stats, &msgs[n-1].msg_hdr);
+        
+        if (overrun) {
+            atomic_fetch_add(&ring->overruns, n);
+            publish_ring_stats(ring);
+            continue;
+        }
+        
+        /* one computer timestamp per batch */
+        gettimeofday(&curTime, NULL);
+        strftime(buffer, 80, "%Y-%m-%d %H:%M:%S", localtime(&curTime.tv_sec));
+        snprintf(currentTime, sizeof(currentTime), "%s.%06d", buffer, (int) curTime.tv_usec);
+        
+        size_t kept = 0;
+        for (int i = 0; i < n; ++i) {
+            uint8_t *header = headers[i];
+            
+            if ((header[0] & 0xF0) != 0xA0 || msgs[i].msg_len < HEADER_BYTES + nsamples) {
+                atomic_fetch_add(&ring->skipped, 1);
+                continue;
+            }
+            
+            uint8_t *record = ring->records + ((head + kept) % ring->size) * RECORD_SIZE;
+            if (kept != (size_t) i) /* close the gap left by a skipped datagram */
+                memmove(record + offsetof(singlePacket, timestream),
+                        ring->records + ((head + i) % ring->size) * RECORD_SIZE + offsetof(singlePacket, timestream),
+                        nsamples);
+            
+            unsigned int timestamp = (uint32_t) (((uint32_t)header[5]<<24) | ((uint32_t)header[6]<<16) | ((uint32_t)header[7]<<8) | header[8]);
+            memcpy(record + offsetof(singlePacket, timestamp), &timestamp, sizeof(timestamp));
+            record[offsetof(singlePacket, antenna)] = header[0] & 0x0F;
+            memcpy(record + offsetof(singlePacket, comp_timestamp), currentTime, 26);
+            stats_count_packet(ring->stats, header[0] & 0x0F, timestamp, msgs[i].msg_len);
+            kept++;
+        }
+        
+        atomic_store_explicit(&ring->head, head + kept, memory_order_release);
+        atomic_fetch_add(&ring->received, kept);
+        received += kept;
+        
+        if (head + kept - tail > atomic_load(&ring->max_fill))
+            atomic_store(&ring->max_fill, head + kept - tail);
+        
+        publish_ring_stats(ring);
+    }
+    
+    atomic_store(&ring->receiving, 0);
+    return NULL;
+}
+
+/*
+* writer_thread - write the packet ring to disk in large slabs of
+* contiguous records, waiting for WRITE_RECORDS records (or for the
+* receive thread to stop) before writing.
+*/
+void *writer_thread(void *arg) {
+    packetRing *ring = (packetRing *) arg;
+    int polls = 0;
+    
+    for (;;) {
+        size_t head = atomic_load_explicit(&ring->head, memory_order_acquire);
+        size_t tail = atomic_load_explicit(&ring->tail, memory_order_relaxed);
+        size_t pending = head - tail;
+        int receiving = atomic_load(&ring->receiving);
+        
+        if (pending == 0 && !receiving)
+            break;
+        
+        if (pending == 0 || (pending < WRITE_RECORDS && receiving && polls < WRITE_WAIT_POLLS)) {
+            usleep(1000);
+            polls++;
+            continue;
+        }
+        polls = 0;
+        
+        size_t contiguous = ring->size - tail % ring->size;
+        size_t count = pending < contiguous ? pending : contiguous;
+        
+        if (fwrite(ring->records + (tail % ring->size) * RECORD_SIZE, RECORD_SIZE, count, ring->out) != count)
+            atomic_fetch_add(&ring->write_errors, 1);
+        
+        atomic_store_explicit(&ring->tail, tail + count, memory_order_release);
+        atomic_fetch_add(&ring->written, count);
+    }
+    
+    fflush(ring->out);
+    atomic_store(&ring->writing, 0);
+    return NULL;
+}
+
+/*
+* ring_capture - capture to_receive packets into out with the receive and
+* writer threads, printing progress every two seconds. Returns the number
+* of packets written.
+*/
+size_t ring_capture(packetRing *ring, FILE *out, size_t to_receive, int loop_number, int file_write_loops) {
+    pthread_t receiver, writer;
+    
+    ring->out = out;
+    ring->to_receive = to_receive;
+    atomic_store(&ring->head, 0);
+    atomic_store(&ring->tail, 0);
+    atomic_store(&ring->receiving, 1);
+    atomic_store(&ring->writing, 1);
+    
+    if (pthread_create(&receiver, NULL, receive_thread, ring) != 0)
+        error("ERROR creating receive thread");
+    if (pthread_create(&writer, NULL, writer_thread, ring) != 0)
+        error("ERROR creating writer thread");
+    
+    int ticks = 0;
+    while (atomic_load(&ring->writing)) {
+        usleep(100000);
+        if (++ticks % 20 == 0) {
+            size_t head = atomic_load(&ring->head);
+            size_t tail = atomic_load(&ring->tail);
+            printf("At: packet number %zu/%zu; file number %d/%d .\n", tail, to_receive, loop_number+1, file_write_loops);
+            printf("Ring fill: %zu/%zu; overruns: %lu; skipped: %lu\n", head - tail, ring->size,
+                   atomic_load(&ring->overruns), atomic_load(&ring->skipped));
+            printf("+++++++++++++++\n");
+        }
+    }
+    
+    pthread_join(receiver, NULL);
+    pthread_join(writer, NULL);
+    publish_ring_stats(ring); /* include the writer's final slab */
+    
+    return atomic_load(&ring->tail);
+}
+
 int main(int argc, char **argv) {
     
     int ntimes = 3600;
     
-    typedef struct packet_struct
-    {
-        unsigned int   timestamp;
-        int8_t    antenna;
-        int8_t timestream[nsamples];
-        char comp_timestamp[26];
-    } singlePacket;
-    
     singlePacket singleTime;
     
     
@@ -93,9 +342,43 @@ int main(int argc, char **argv) {
     
     /*
     * check and use command line arguments
+    * -r <ring packets>: capture through a packet ring with separate
+    *                    receive and writer threads
+    * -b <batch>: datagrams per recvmmsg call in ring mode
+    * -s <stats file>: live counters file (default next to the config file)
     */
+    size_t ring_size = 0;
+    int ring_batch = RING_BATCH;
+    char statsfname[256] = "";
+    int opt;
+    while ((opt = getopt(argc, argv, "r:b:s:")) != -1) {
+        switch (opt) {
+            case 's':
+                snprintf(statsfname, sizeof(statsfname), "%s", optarg);
+                break;
+            case 'r':
+                ring_size = strtoul(optarg, NULL, 10);
+                break;
+            case 'b':
+                ring_batch = atoi(optarg);
+                break;
+            default:
+                argc = 0; /* print usage */
+        }
+    }
+    if (argc > 0) {
+        char *program = argv[0];
+        argc -= optind - 1;
+        argv += optind - 1;
+        argv[0] = program;
+    }
+    
     if (argc < 6 || argc > 7) {
-        fprintf(stderr, "usage: %s <port> <outfile> <number files> <number frames> <number channels> [verbose = 1/0]\n", argv[0]);
+        fprintf(stderr, "usage: %s [-r ring packets] [-b recvmmsg batch] [-s stats file] <port> <outfile> <number files> <number frames> <number channels> [verbose = 1/0]\n", argc > 0 ? argv[0] : "suit_binary_receiver");
+        exit(1);
+    }
+    if (ring_batch < 1 || ring_batch > MAX_RING_BATCH) {
+        fprintf(stderr, "recvmmsg batch must be between 1 and %d\n", MAX_RING_BATCH);
         exit(1);
     }
     int verbose = 0;
@@ -141,6 +424,35 @@ int main(int argc, char **argv) {
         sizeof(serveraddr)) < 0)
     error("ERROR on binding");
     
+    statsPublisher stats;
+    stats_enable_drops(sockfd);
+    
+    /*
+    * ring mode: allocate the packet ring and time out receives so that the
+    * receive thread notices an interruption
+    */
+    packetRing ring;
+    memset(&ring, 0, sizeof(ring));
+    if (ring_size > 0) {
+        ring_mode = 1;
+        ring.size = ring_size;
+        ring.batch = ring_batch;
+        ring.sockfd = sockfd;
+        ring.stats = &stats;
+        if (posix_memalign((void **) &ring.records, 4096, ring_size * RECORD_SIZE) != 0)
+            error("ERROR allocating packet ring");
+        memset(ring.records, 0, ring_size * RECORD_SIZE);
+        
+        struct timeval timeout = {0, 500000};
+        setsockopt(sockfd, SOL_SOCKET, SO_RCVTIMEO, (const void *)&timeout, sizeof(timeout));
+        optval = RING_RCVBUF; /* capped by net.core.rmem_max */
+        setsockopt(sockfd, SOL_SOCKET, SO_RCVBUF, (const void *)&optval, sizeof(int));
+        signal(SIGINT, sig_handler);
+        
+        printf("Packet ring: %zu packets (%zu MB), recvmmsg batch %d\n",
+               ring_size, ring_size * RECORD_SIZE / (1024 * 1024), ring_batch);
+    }
+    
     /*
     * main loop: wait for a datagram, sort and write to disk
     */
@@ -166,6 +478,11 @@ int main(int argc, char **argv) {
     sprintf(outfname, "dataOut/d%s/%s.config", dateBuffer, argv[2]);
     printf("Config file: %s\n", outfname);
     FILE *configHandler = fopen(outfname, "w+");
+    
+    if (statsfname[0] == '\0')
+        sprintf(statsfname, "dataOut/d%s/%s.stats", dateBuffer, argv[2]);
+    printf("Stats file: %s\n", statsfname);
+    stats_open(&stats, statsfname);
     fprintf(configHandler, "Number channels: %d\n", number_channels);
     fprintf(configHandler, "Number frames:  %d\n", number_frames);
     fprintf(configHandler, "Data start time: %s\n", currentTime);
@@ -202,18 +519,42 @@ int main(int argc, char **argv) {
         tic = clock();
         x=0;
         
-        //start data acquisition
-        while(x < tot_packets){
+        if(ring_mode){
+            x = ring_capture(&ring, outDataHandler, tot_packets, loop_number, file_write_loops);
+            
+            //Record the packets actually written if the capture was cut short.
+            if(x < tot_packets){
+                fseek(outDataHandler, 0, SEEK_SET);
+                fwrite(&x, sizeof(int), 1, outDataHandler);
+            }
+            
+            fprintf(configHandler, "Packets written: %d\n", x);
+            printf("Packets written: %d/%d\n", x, tot_packets);
+        }
+        
+        //start data acquisition (single-threaded mode)
+        while(!ring_mode && x < tot_packets){
             
             signal(SIGINT, sig_handler);
             
-            //recvfrom: receive a UDP datagram or read from file
+            //recvmsg: receive a UDP datagram, with the kernel drop count
             memset(buf, 0, BUFSIZE);
-            n = recvfrom(sockfd, buf, BUFSIZE, 0,
-                        (struct sockaddr *) &clientaddr, &clientlen);
+            struct iovec iov = {buf, BUFSIZE};
+            char control[CMSG_SPACE(sizeof(uint32_t))];
+            struct msghdr msg;
+            memset(&msg, 0, sizeof(msg));
+            msg.msg_name = &clientaddr;
+            msg.msg_namelen = clientlen;
+            msg.msg_iov = &iov;
+            msg.msg_iovlen = 1;
+            msg.msg_control = control;
+            msg.msg_controllen = sizeof(control);
+            n = recvmsg(sockfd, &msg, 0);
             
             if (n < 0)
-                error("ERROR in recvfrom");
+                error("ERROR in recvmsg");
+            
+            stats_count_drops(&stats, &msg);
             
             if(verbose)
                 printf("number of bytes received: %d\n", n);
@@ -257,6 +598,11 @@ int main(int argc, char **argv) {
                 
                 x+=1;
                 
+                stats_count_packet(&stats, ant_channel, timestamp, n);
+                stats.local.packets_written++;
+                if(x % STATS_PUBLISH_PACKETS == 0)
+                    stats_publish(&stats);
+                
                 if(verbose){
                     printf("current time: %s \n", currentTime);
                     printf("%hhX, %hX, %hX, %X \n", ant_channel, stream_id, word_length, timestamp);
@@ -294,6 +640,9 @@ int main(int argc, char **argv) {
                 
                 
             }
+            else{
+                stats.local.skipped++;
+            }
             
             
             
@@ -301,9 +650,29 @@ int main(int argc, char **argv) {
         
 
        fclose(outDataHandler);
+       stats_publish(&stats);
+       
+       if(interrupted)
+           break;
 
     }
 
+    if(ring_mode){
+        printf("Packets received: %lu\n", atomic_load(&ring.received));
+        printf("Packets written: %lu\n", atomic_load(&ring.written));
+        printf("Ring overruns: %lu\n", atomic_load(&ring.overruns));
+        printf("Skipped datagrams: %lu\n", atomic_load(&ring.skipped));
+        printf("Write errors: %lu\n", atomic_load(&ring.write_errors));
+        printf("Peak ring fill: %zu/%zu\n", atomic_load(&ring.max_fill), ring.size);
+        fprintf(configHandler, "Ring overruns: %lu\n", atomic_load(&ring.overruns));
+        fprintf(configHandler, "Skipped datagrams: %lu\n", atomic_load(&ring.skipped));
+        fprintf(configHandler, "Write errors: %lu\n", atomic_load(&ring.write_errors));
+        fprintf(configHandler, "Peak ring fill: %zu/%zu\n", atomic_load(&ring.max_fill), ring.size);
+        free(ring.records);
+    }
+    
+    stats_close(&stats);
+
     printf("Cleaning up...");
     fclose(configHandler);
     printf("Done.\n");
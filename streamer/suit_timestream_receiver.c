@@ -19,6 +19,7 @@
 #include <signal.h>
 #include "hdf5.h"
 #include "hdf5_hl.h"
+#include "receiver_stats.h"
 
 #define BUFSIZE 32767
 #define nsamples 2048
@@ -113,9 +114,28 @@ int main(int argc, char **argv) {
     
     /*
      * check and use command line arguments
+     * -s <stats file>: live counters file (default dataOut/d<date>/<outfile>.stats)
      */
+    char statsfname[256] = "";
+    int opt;
+    while ((opt = getopt(argc, argv, "s:")) != -1) {
+        switch (opt) {
+            case 's':
+                snprintf(statsfname, sizeof(statsfname), "%s", optarg);
+                break;
+            default:
+                argc = 0; /* print usage */
+        }
+    }
+    if (argc > 0) {
+        char *program = argv[0];
+        argc -= optind - 1;
+        argv += optind - 1;
+        argv[0] = program;
+    }
+
     if (argc < 6 || argc > 7) {
-        fprintf(stderr, "usage: %s <port> <outfile> <number files> <number frames> <number channels> [verbose = 1/0]\n", argv[0]);
+        fprintf(stderr, "usage: %s [-s stats file] <port> <outfile> <number files> <number frames> <number channels> [verbose = 1/0]\n", argc > 0 ? argv[0] : "suit_timestream_receiver");
         exit(1);
     }
     int verbose = 0;
@@ -164,6 +184,13 @@ int main(int argc, char **argv) {
              sizeof(serveraddr)) < 0)
         error("ERROR on binding");
 
+    statsPublisher stats;
+    stats_enable_drops(sockfd);
+    if (statsfname[0] == '\0')
+        sprintf(statsfname, "dataOut/d%s/%s.stats", dateBuffer, argv[2]);
+    printf("Stats file: %s\n", statsfname);
+    stats_open(&stats, statsfname);
+
     /*
      * main loop: wait for a datagram, sort and write to disk
      */
@@ -267,10 +294,21 @@ int main(int argc, char **argv) {
              */
             memset(buf, 0, BUFSIZE);
 
-            n = recvfrom(sockfd, buf, BUFSIZE, 0,
-                         (struct sockaddr *) &clientaddr, &clientlen);
+            struct iovec iov = {buf, BUFSIZE};
+            char control[CMSG_SPACE(sizeof(uint32_t))];
+            struct msghdr msg;
+            memset(&msg, 0, sizeof(msg));
+            msg.msg_name = &clientaddr;
+            msg.msg_namelen = clientlen;
+            msg.msg_iov = &iov;
+            msg.msg_iovlen = 1;
+            msg.msg_control = control;
+            msg.msg_controllen = sizeof(control);
+            n = recvmsg(sockfd, &msg, 0);
             if (n < 0)
-                error("ERROR in recvfrom");
+                error("ERROR in recvmsg");
+
+            stats_count_drops(&stats, &msg);
 
             if(verbose)
                 printf("number of bytes received: %d\n", n);
@@ -320,6 +358,12 @@ int main(int argc, char **argv) {
 
                 x+=1;
 
+                stats_count_packet(&stats, ant_channel, timestamp, n);
+                if (err >= 0)
+                    stats.local.packets_written++;
+                if(x % STATS_PUBLISH_PACKETS == 0)
+                    stats_publish(&stats);
+
                 if(verbose)
                       printf("%hhX, %hX, %hX, %X \n", ant_channel, stream_id, word_length, timestamp);
                       //printf("%d %d\n", lastPrint_sec, curTime.tv_sec);
@@ -355,6 +399,9 @@ int main(int argc, char **argv) {
                 }   
 
             }
+            else {
+                stats.local.skipped++;
+            }
 
     
 
@@ -367,7 +414,10 @@ int main(int argc, char **argv) {
 
         err = H5PTclose(ptable);
         H5Fclose(fid);
+        stats_publish(&stats);
         printf("Done.\n");
     }
 
+    stats_close(&stats);
+
 }